@@ -57,6 +57,9 @@ class cmd_update(Command):
             make_option('--ignore-suggests',
                         action='store_true', dest='ignore_suggests', default=False,
                         help=_('ignore all soft-dependencies')),
+            make_option('--force-update',
+                        action='store_true', dest='force_update', default=False,
+                        help=_('fetch repositories even if fetched recently')),
             ])
 
     def run(self, config, options, args, help=None):
@@ -93,6 +96,9 @@ class cmd_updateone(Command):
             make_option('-D', metavar='DATE-SPEC',
                         action='store', dest='sticky_date', default=None,
                         help=_('set a sticky date when checking out modules')),
+            make_option('--force-update',
+                        action='store_true', dest='force_update', default=False,
+                        help=_('fetch repositories even if fetched recently')),
             ])
 
     def run(self, config, options, args, help=None):
@@ -191,6 +197,9 @@ class cmd_build(BuildCommand):
             make_option('-n', '--no-network',
                         action='store_true', dest='nonetwork', default=False,
                         help=_('skip version control update')),
+            make_option('--force-update',
+                        action='store_true', dest='force_update', default=False,
+                        help=_('fetch repositories even if fetched recently')),
             make_option('-q', '--quiet',
                         action='store_true', dest='quiet', default=False,
                         help=_('quiet (no output)')),
@@ -299,6 +308,9 @@ class cmd_buildone(BuildCommand):
             make_option('-n', '--no-network',
                         action='store_true', dest='nonetwork', default=False,
                         help=_('skip version control update')),
+            make_option('--force-update',
+                        action='store_true', dest='force_update', default=False,
+                        help=_('fetch repositories even if fetched recently')),
             make_option('-q', '--quiet',
                         action='store_true', dest='quiet', default=False,
                         help=_('quiet (no output)')),
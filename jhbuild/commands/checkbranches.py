@@ -17,21 +17,35 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import sys
+import json
+import threading
 from optparse import make_option
+from multiprocessing.pool import ThreadPool
 
 import jhbuild.moduleset
 from jhbuild.commands import Command, register_command
-from jhbuild.utils.cmds import get_output
-from jhbuild.errors import CommandError
+from jhbuild.utils import mirrorprobe
+from jhbuild.versioncontrol.git import get_remote_refs
 
 class cmd_checkbranches(Command):
-    doc = N_('Check modules in GNOME Git repository have the correct branch definition')
+    doc = N_('Check modules in Git repositories have the correct branch definition')
     name = 'checkbranches'
-    
+
+    # how many repositories are queried at the same time
+    max_queries = 16
+
     def __init__(self):
         Command.__init__(self, [
             make_option('-b', '--branch', metavar = 'BRANCH',
-                    action = 'store', dest = 'branch', default = None)])
+                    action = 'store', dest = 'branch', default = None),
+            make_option('--max-per-host', metavar = 'N', type = 'int',
+                    action = 'store', dest = 'max_per_host', default = 4,
+                    help = _('query at most N repositories of a host at once')),
+            make_option('--json',
+                    action = 'store_true', dest = 'json', default = False,
+                    help = _('print the results as JSON')),
+            ])
 
     def run(self, config, options, args, help=None):
         if options.branch:
@@ -47,24 +61,60 @@ class cmd_checkbranches(Command):
 
         module_set = jhbuild.moduleset.load(config)
         module_list = module_set.get_module_list(args or config.modules)
+        checks = []
         for mod in module_list:
             if mod.type in ('meta', 'tarball'):
                 continue
             if not mod.branch or not mod.branch.repository.__class__.__name__ == 'GitRepository':
                 continue
-            if not 'git.gnome.org' in mod.branch.repository.href:
-                continue
             if mod.branch.branch:
                 # there is already a branch defined
                 continue
+            uri = mod.branch.unmirrored_module or mod.branch.module
+            checks.append((mod.name, uri))
+
+        # limit the number of concurrent queries to each host
+        host_locks = {}
+        for name, uri in checks:
+            host = mirrorprobe.parse_host(uri)
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(
+                        max(1, options.max_per_host))
 
+        def list_heads(uri):
+            with host_locks[mirrorprobe.parse_host(uri)]:
+                return get_remote_refs(uri)
+
+        uris = sorted(set(uri for name, uri in checks))
+        refs = {}
+        if uris:
+            pool = ThreadPool(min(len(uris), self.max_queries))
             try:
-                if get_output(['git', 'ls-remote',
-                        'https://git.gnome.org/browse/%s' % mod.name,
-                        'refs/heads/%s' % branch]):
-                    uprint(_('%(module)s is missing branch definition for %(branch)s') % {'module': mod.name, 'branch': branch})
-            except CommandError:
-                pass
+                refs = dict(zip(uris, pool.map(list_heads, uris)))
+            finally:
+                pool.close()
+                pool.join()
+
+        results = []
+        for name, uri in checks:
+            if refs[uri] is None:
+                status = 'error'
+            elif 'refs/heads/%s' % branch in refs[uri]:
+                status = 'missing'
+            else:
+                status = 'ok'
+            results.append({'module': name, 'repository': uri,
+                            'branch': branch, 'status': status})
+
+        if options.json:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+            return
+        for result in results:
+            if result['status'] == 'missing':
+                uprint(_('%(module)s is missing branch definition for %(branch)s') % result)
+            elif result['status'] == 'error':
+                uprint(_('%(module)s: could not list branches of %(repository)s') % result)
 
 
 register_command(cmd_checkbranches)
@@ -0,0 +1,64 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   cleandebug.py: remove debug files no installed module refers to
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import logging
+from optparse import make_option
+
+import jhbuild.moduleset
+from jhbuild.commands import Command, register_command
+from jhbuild.errors import FatalError
+from jhbuild.utils import fileutils
+
+
+class cmd_cleandebug(Command):
+    doc = N_('Remove debug files no installed module refers to')
+
+    name = 'cleandebug'
+    usage_args = N_('[ options ... ]')
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('-n', '--dry-run',
+                        action='store_true', dest='dry_run', default=False,
+                        help=_('only list the debug files to remove')),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        module_set = jhbuild.moduleset.load(config)
+        unreferenced = module_set.packagedb.find_unreferenced_debug_files()
+        if unreferenced is None:
+            raise FatalError(_('Not removing any debug file'))
+
+        if options.dry_run:
+            for path in sorted(unreferenced):
+                uprint(path)
+            return 0
+
+        num_deleted = 0
+        for (path, was_deleted, error_string) in fileutils.remove_files_and_dirs(unreferenced, config, allow_nonempty_dirs=True):
+            if was_deleted:
+                logging.info(_('Deleted: %(file)r') % {'file': path})
+                num_deleted += 1
+            elif error_string is not None:
+                logging.warn(_("Failed to delete %(file)r: %(msg)s") % {'file': path,
+                                                                         'msg': error_string})
+        logging.info(_('Removed %d unused debug files and directories') % num_deleted)
+
+
+register_command(cmd_cleandebug)
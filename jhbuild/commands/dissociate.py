@@ -0,0 +1,59 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   dissociate.py: make git checkouts independent from the dvcs mirror
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import os
+import logging
+
+import jhbuild.moduleset
+import jhbuild.frontends
+from jhbuild.commands import Command, register_command
+from jhbuild.errors import FatalError
+
+
+class cmd_dissociate(Command):
+    doc = N_('Copy objects borrowed from the dvcs mirror into git checkouts')
+
+    name = 'dissociate'
+    usage_args = N_('[ modules ... ]')
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        module_set = jhbuild.moduleset.load(config)
+        try:
+            module_list = [module_set.get_module(modname, ignore_case=True)
+                           for modname in args]
+        except KeyError as e:
+            raise FatalError(_("A module called '%s' could not be found.") % e)
+        if not module_list:
+            module_list = module_set.get_module_list(config.modules,
+                                                     config.skip)
+
+        build = jhbuild.frontends.get_buildscript(config, module_list,
+                                                  module_set=module_set)
+        for module in module_list:
+            branch = getattr(module, 'branch', None)
+            if not hasattr(branch, 'dissociate'):
+                continue
+            if not os.path.exists(branch.get_checkoutdir()):
+                continue
+            if branch.dissociate(build):
+                logging.info(_('%s no longer uses objects of the dvcs mirror')
+                             % module.name)
+
+
+register_command(cmd_dissociate)
@@ -0,0 +1,75 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   rollback.py: restore the previous install of modules
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import time
+import logging
+from optparse import make_option
+
+import jhbuild.moduleset
+import jhbuild.frontends
+from jhbuild.commands import Command, register_command
+from jhbuild.errors import FatalError
+
+
+class cmd_rollback(Command):
+    doc = N_('Restore the previous install of modules')
+
+    name = 'rollback'
+    usage_args = N_('[ options ... ] modules ...')
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('-l', '--list',
+                        action='store_true', dest='list', default=False,
+                        help=_('only list the install snapshots')),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        if not args:
+            self.parser.error(_('This command requires a module parameter.'))
+
+        module_set = jhbuild.moduleset.load(config)
+        packagedb = module_set.packagedb
+
+        if options.list:
+            for modname in args:
+                for snapshotdir, entry in reversed(packagedb.get_snapshots(modname)):
+                    uprint('%s %s %s' % (modname, entry.version,
+                                         time.strftime('%Y-%m-%d %H:%M:%S',
+                                                       time.localtime(entry.metadata['installed-date']))))
+            return 0
+
+        for modname in args:
+            if not packagedb.get_snapshots(modname):
+                raise FatalError(_('No install snapshot of module %(mod)r, see the install_snapshots setting') % {'mod': modname})
+
+        for modname in args:
+            try:
+                entry = packagedb.rollback(modname)
+            except EnvironmentError as e:
+                raise FatalError(_('Failed to restore %(mod)s, its snapshot is kept to try again: %(msg)s')
+                                 % {'mod': modname, 'msg': str(e)})
+            logging.info(_('Restored %(mod)s to version %(version)s') % {'mod': modname,
+                                                                         'version': entry.version})
+
+        build = jhbuild.frontends.get_buildscript(config, args, module_set=module_set)
+        return build.run_triggers(args)
+
+
+register_command(cmd_rollback)
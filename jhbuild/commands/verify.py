@@ -0,0 +1,105 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   verify.py: check the installed files against the package database
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import logging
+from optparse import make_option
+
+import jhbuild.moduleset
+import jhbuild.frontends
+from jhbuild.commands import Command, register_command
+from jhbuild.errors import FatalError
+
+
+class cmd_verify(Command):
+    doc = N_('Check installed files against the package database')
+
+    name = 'verify'
+    usage_args = N_('[ options ... ] [ modules ... ]')
+
+    def __init__(self):
+        Command.__init__(self, [
+            make_option('-j', '--jobs', metavar='JOBS',
+                        action='store', type='int', dest='verify_jobs', default=None,
+                        help=_('number of files to check at the same time')),
+            make_option('--orphans',
+                        action='store_true', dest='orphans', default=False,
+                        help=_('also list files no installed module refers to')),
+            make_option('--reinstall',
+                        action='store_true', dest='reinstall', default=False,
+                        help=_('build and install again the modules with damaged files, '
+                               'from their sources on disk')),
+            ])
+
+    def run(self, config, options, args, help=None):
+        config.set_from_cmdline_options(options)
+        module_set = jhbuild.moduleset.load(config)
+        packagedb = module_set.packagedb
+
+        packages = packagedb.get_packages()
+        if args:
+            for modname in args:
+                if modname not in packages:
+                    raise FatalError(_('Module %(mod)r is not installed') % {'mod': modname})
+            packages = args
+
+        # checking files is mostly waiting for the disk
+        jobs = options.verify_jobs or max(1, config.jobs) * 4
+        damaged = packagedb.verify(packages, jobs)
+        for package in sorted(damaged):
+            missing, modified = damaged[package]
+            for path in sorted(missing):
+                uprint('%s: missing %s' % (package, path))
+            for path in sorted(modified):
+                uprint('%s: modified %s' % (package, path))
+
+        num_orphaned = 0
+        if options.orphans:
+            orphaned = packagedb.find_orphaned_files()
+            if orphaned is None:
+                raise FatalError(_('Could not list orphaned files'))
+            for path in sorted(orphaned):
+                uprint('orphaned %s' % path)
+            num_orphaned = len(orphaned)
+
+        logging.info(_('%(damaged)d of %(total)d modules have missing or modified files, %(orphaned)d files are orphaned') %
+                     {'damaged': len(damaged), 'total': len(packages),
+                      'orphaned': num_orphaned})
+
+        if not damaged:
+            return 0
+        if not options.reinstall:
+            return 1
+
+        module_list = []
+        for package in sorted(damaged):
+            try:
+                module_list.append(module_set.get_module(package))
+            except KeyError:
+                logging.warn(_('Module %(mod)r is not in the module set, not reinstalling it') % {'mod': package})
+        if not module_list:
+            return 1
+        # the package database considers these modules up to date; they are
+        # built from the sources on disk, as with 'buildone --no-network',
+        # rather than updated to another upstream version
+        config.build_policy = 'all'
+        config.nonetwork = True
+        build = jhbuild.frontends.get_buildscript(config, module_list, module_set=module_set)
+        return build.build()
+
+
+register_command(cmd_verify)
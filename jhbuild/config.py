@@ -60,7 +60,10 @@ _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'jhbuildbot_svn_commits_box', 'jhbuildbot_slaves_dir',
                 'jhbuildbot_dir', 'jhbuildbot_mastercfg',
                 'use_local_modulesets', 'ignore_suggests', 'modulesets_dir',
-                'mirror_policy', 'module_mirror_policy', 'dvcs_mirror_dir',
+                'mirror_policy', 'module_mirror_policy', 'mirror_probe_ttl',
+                'dvcs_mirror_dir', 'dvcs_mirror_alternates',
+                'fetch_max_age', 'force_update', 'git_clone_filter',
+                'module_git_clone_filter', 'git_worktree_dir',
                 'shallow_clone', 'build_targets', 'cmakeargs', 'module_cmakeargs',
                 'mesonargs', 'module_mesonargs',
                 'print_command_pattern', 'static_analyzer',
@@ -68,6 +71,9 @@ _known_keys = [ 'moduleset', 'modules', 'skip', 'tags', 'prefix',
                 'static_analyzer_outputdir', 'check_sysdeps', 'system_prefix',
                 'help_website', 'conditions', 'extra_prefixes',
                 'disable_Werror', 'xdg_cache_home', 'exit_on_error',
+                'pristine_cache_dir', 'pristine_cache_hardlinks',
+                'strip_debug_single_pass', 'compress_debug_sections',
+                'install_snapshots',
                 'jhhome', # liuhuan: custom path under which we put modulesets, build, install
                 'modulecmakeargs', # liuhuan: custom package specific cmakeargs
                 'appendmodulecmakeargs' # woody: custom package specific appendcmakeargs
@@ -252,7 +258,7 @@ class Config:
                          'jhbuildbot_slaves_dir', 'jhbuildbot_dir',
                          'jhbuildbot_mastercfg', 'modulesets_dir',
                          'dvcs_mirror_dir', 'static_analyzer_outputdir',
-                         'prefix'):
+                         'pristine_cache_dir', 'git_worktree_dir', 'prefix'):
             if config.get(path_key):
                 config[path_key] = os.path.expanduser(config[path_key])
 
@@ -374,6 +380,8 @@ class Config:
             self.ignore_suggests = True
         if hasattr(options, 'nonetwork') and options.nonetwork:
             self.nonetwork = True
+        if hasattr(options, 'force_update') and options.force_update:
+            self.force_update = True
         if hasattr(options, 'skip'):
             for item in options.skip:
                 self.skip += item.split(',')
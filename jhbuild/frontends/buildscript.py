@@ -98,7 +98,8 @@ class BuildScript:
     def build(self, phases=None):
         '''start the build of the current configuration'''
         self.start_build()
-        
+        self.prefetch_remote_state(phases)
+
         failures = [] # list of modules that couldn't be built
         successes = []
         self.module_num = 0
@@ -270,6 +271,28 @@ class BuildScript:
                                 '(%(rc)s)') % {'command' : displayed_command,
                                                'rc' : err.returncode})
 
+    def prefetch_remote_state(self, phases=None):
+        '''Query the upstream repositories of all git modules to be checked
+        out at once, so that modules which did not change upstream can skip
+        their update, and resolve the sticky date in all of them.'''
+        if self.config.nonetwork:
+            return
+        from jhbuild.versioncontrol.git import GitBranch, prefetch_remote_refs, \
+                prefetch_sticky_dates
+        branches = []
+        for module in self.modulelist:
+            branch = getattr(module, 'branch', None)
+            if not isinstance(branch, GitBranch):
+                continue
+            if 'checkout' in (phases or self.get_build_phases(module)):
+                branches.append(branch)
+        if not branches:
+            return
+        if not self.config.sticky_date:
+            prefetch_remote_refs(branches)
+        elif self.config.sticky_date != 'none':
+            prefetch_sticky_dates(branches, self.config.sticky_date)
+
     def get_build_phases(self, module, targets=None):
         '''returns the list of required phases'''
         if targets:
@@ -327,7 +350,9 @@ class BuildScript:
         pass
     def _end_phase_internal(self, module, phase, error):
         if error is None and phase == 'install':
-            self.run_triggers([module])
+            # triggers already ran for identical files
+            if not self.moduleset.packagedb.outputs_unchanged(module):
+                self.run_triggers([module])
         self.end_phase(module, phase, error)
 
     def message(self, msg, module_num=-1):
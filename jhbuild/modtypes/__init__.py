@@ -36,12 +36,16 @@ import logging
 import collections
 import json
 import hashlib
+from multiprocessing.pool import ThreadPool
 
 from jhbuild.errors import FatalError, CommandError, BuildStateError, \
              SkipToEnd, UndefinedRepositoryError
 from jhbuild.utils.sxml import sxml
 from jhbuild.commands.sanitycheck import inpath
 import jhbuild.utils.fileutils as fileutils
+from jhbuild.utils import mirrorprobe
+from jhbuild.utils import elfutils
+from jhbuild.utils import packagedb
 
 _module_types = {}
 def register_module_type(name, parse_func):
@@ -164,14 +168,30 @@ def get_branch(node, repositories, default_repo, config):
                 _('No repository for module id=%(module)s. Either set branch/repo or default repository.'
                   % {'module': name}))
 
+    fallback_repos = []
     if repo.mirrors:
         mirror_type = config.mirror_policy
         if name in config.module_mirror_policy:
             mirror_type = config.module_mirror_policy[name]
-        if mirror_type in repo.mirrors:
+        if mirror_type == 'fastest':
+            # the mirrors are only probed when the module gets checked out,
+            # see DownloadableModule.select_fastest_mirror()
+            fallback_repos = [repo.mirrors[kind]
+                              for kind in sorted(repo.mirrors)]
+        elif mirror_type in repo.mirrors:
             repo = repo.mirrors[mirror_type]
 
-    return repo.branch_from_xml(name, childnode, repositories, default_repo)
+    branch = repo.branch_from_xml(name, childnode, repositories, default_repo)
+    if fallback_repos:
+        branch.fallback_branches = []
+        for fallback_repo in fallback_repos:
+            try:
+                branch.fallback_branches.append(fallback_repo.branch_from_xml(
+                        name, childnode, repositories, default_repo))
+            except (FatalError, TypeError):
+                # the <branch> element doesn't suit this mirror type
+                pass
+    return branch
 
 
 class Package:
@@ -225,183 +245,278 @@ class Package:
         os.makedirs(destdir)
         return destdir
 
-    def _clean_la_files_in_dir(self, buildscript, path):
-        for name in os.listdir(path):
-            subpath = os.path.join(path, name)
-            if os.path.isdir(subpath) and not os.path.islink(subpath):
-                self._clean_la_files_in_dir(buildscript, subpath)
-            elif name.endswith('.la'):
-                    try:
-                        logging.info(_('Deleting .la file: %r') % (subpath, ))
-                        os.unlink(subpath)
-                    except OSError:
-                        pass
-
-    def _clean_la_files(self, buildscript, installroot):
+    def _clean_la_files(self, filetable):
         """This method removes all .la files. See bug 654013."""
-        assert os.path.isabs(installroot)
-        assert os.path.isabs(buildscript.config.prefix)
-        prefixdir = os.path.join(installroot, buildscript.config.prefix[1:])
-        if os.path.isdir(prefixdir) and not os.path.islink(prefixdir):
-            self._clean_la_files_in_dir(self, prefixdir)
-
-    def _clean_texinfo_dir_files(self, buildscript, installroot):
-        """This method removes GNU Texinfo dir files."""
-        assert os.path.isabs(installroot)
-        assert os.path.isabs(buildscript.config.prefix)
-        prefixdir = os.path.join(installroot, buildscript.config.prefix[1:])
-        if os.path.isdir(prefixdir):
-            dirfile = os.path.join(prefixdir, 'share/info/dir')
-            if os.path.isfile(dirfile):
+        for entry in list(filetable):
+            if entry.kind != 'dir' and entry.path.endswith('.la'):
+                path = os.path.join(filetable.root, entry.path)
                 try:
-                    logging.info(_('Deleting dir file: %r') % (dirfile, ))
-                    os.unlink(dirfile)
+                    logging.info(_('Deleting .la file: %r') % (path, ))
+                    os.unlink(path)
+                    filetable.remove(entry.path)
                 except OSError:
                     pass
 
-    def _process_install_files(self, installroot, curdir, prefix, errors):
-        """Strip the prefix from all files in the install root, and move
-them into the prefix."""
-        assert os.path.isdir(installroot) and os.path.isabs(installroot)
-        assert os.path.isdir(curdir) and os.path.isabs(curdir)
-        assert os.path.isdir(prefix) and os.path.isabs(prefix)
+    def _clean_texinfo_dir_files(self, filetable):
+        """This method removes GNU Texinfo dir files."""
+        relpath = os.path.join('share', 'info', 'dir')
+        dirfile = os.path.join(filetable.root, relpath)
+        if filetable.get(relpath) is not None and os.path.isfile(dirfile):
+            try:
+                logging.info(_('Deleting dir file: %r') % (dirfile, ))
+                os.unlink(dirfile)
+                filetable.remove(relpath)
+            except OSError:
+                pass
+
+    def _process_install_files(self, filetable, prefix, errors, jobs=1):
+        """Move all files of the install root into the prefix.
 
-        if prefix.endswith('/'):
-            prefix = prefix[:-1]
+Directories which do not exist in the prefix yet are renamed as a whole,
+other files are moved by a pool of JOBS threads once all the directories
+have been created."""
+        assert os.path.isdir(filetable.root) and os.path.isabs(filetable.root)
+        assert os.path.isdir(prefix) and os.path.isabs(prefix)
 
         num_copied = 0
-        names = os.listdir(curdir)
-        for filename in names:
-            src_path = os.path.join(curdir, filename)
-            assert src_path.startswith(installroot)
-            dest_path = src_path[len(installroot):]
+        # directories which could not be created, with their contents
+        skipped = set()
+        # directories which were moved with all their contents
+        moved = set()
+        moves = []
+        for entry in filetable:
+            parent = os.path.dirname(entry.path)
+            if parent in moved:
+                moved.add(entry.path)
+                if entry.kind != 'dir':
+                    num_copied += 1
+                continue
+            if parent in skipped:
+                skipped.add(entry.path)
+                continue
+            src_path = os.path.join(filetable.root, entry.path)
+            dest_path = os.path.join(prefix, entry.path)
+            if entry.kind != 'dir':
+                moves.append((entry.kind, src_path, dest_path))
+                continue
             try:
-                if os.path.islink(src_path):
-                    linkto = os.readlink(src_path)
-                    if os.path.islink(dest_path) or os.path.isfile(dest_path):
+                if os.path.exists(dest_path):
+                    if not os.path.isdir(dest_path):
                         os.unlink(dest_path)
-                    os.symlink(linkto, dest_path)
-                    os.unlink(src_path)
-                    num_copied += 1
-                elif os.path.isdir(src_path):
-                    if os.path.exists(dest_path):
-                        if not os.path.isdir(dest_path):
-                            os.unlink(dest_path)
-                            os.mkdir(dest_path)
-                    else:
                         os.mkdir(dest_path)
-                    num_copied += self._process_install_files(installroot,
-                                                              src_path, prefix,
-                                                              errors)
+                elif not os.path.lexists(dest_path):
                     try:
-                        os.rmdir(src_path)
+                        os.rename(src_path, dest_path)
+                        moved.add(entry.path)
+                        continue
                     except OSError:
-                        # files remaining in buildroot, errors reported below
-                        pass
+                        # across filesystems, move the contents one by one
+                        os.mkdir(dest_path)
                 else:
-                    try:
-                        fileutils.rename(src_path, dest_path)
-                        num_copied += 1
-                    except OSError as e:
-                        errors.append("%s: '%s'" % (str(e), dest_path))
+                    os.mkdir(dest_path)
             except OSError as e:
+                skipped.add(entry.path)
                 errors.append(str(e))
+
+        cloner = fileutils.TreeCloner()
+        def move(item):
+            kind, src_path, dest_path = item
+            try:
+                if kind == 'link':
+                    linkto = os.readlink(src_path)
+                    if os.path.islink(dest_path) or os.path.isfile(dest_path):
+                        os.unlink(dest_path)
+                    os.symlink(linkto, dest_path)
+                    os.unlink(src_path)
+                    return None
+                try:
+                    fileutils.move_file(src_path, dest_path, cloner)
+                except (IOError, OSError) as e:
+                    return "%s: '%s'" % (str(e), dest_path)
+            except OSError as e:
+                return str(e)
+            return None
+
+        if moves:
+            if jobs > 1 and len(moves) > 1:
+                pool = ThreadPool(min(len(moves), jobs))
+                try:
+                    results = pool.map(move, moves)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = map(move, moves)
+            for error in results:
+                if error is None:
+                    num_copied += 1
+                else:
+                    errors.append(error)
+
+        # directories come before their contents in the table
+        for entry in reversed(list(filetable)):
+            if entry.kind == 'dir' and entry.path not in moved:
+                try:
+                    os.rmdir(os.path.join(filetable.root, entry.path))
+                except OSError:
+                    # files remaining in buildroot, errors reported below
+                    pass
         return num_copied
 
 
-    def _strip_debug_symbols(self, destdir_prefix, installroot):
+    def _strip_debug_symbols(self, filetable, installroot, config):
         assert self.supports_stripping_debug_symbols
-
-        for filename in fileutils.accumulate_dirtree_contents(destdir_prefix):
+        destdir_prefix = filetable.root
+
+        # debug files are stored by build-id as debuggers expect, so
+        # identical binaries share them; binaries sharing a debug file are
+        # handled by the same job
+        binaries = collections.OrderedDict()
+        for entry in list(filetable):
+            if entry.kind != 'file':
+                continue
+            filename = entry.path
             dirname, basename = os.path.split(filename)
-            fullfilename = os.path.join(destdir_prefix, dirname, basename)
-            if not os.path.isfile(fullfilename) or os.path.islink(fullfilename):
+            fullfilename = os.path.join(destdir_prefix, filename)
+            if not entry.is_executable() and 'so' not in basename.split(os.path.extsep):
                 continue
-            if not os.access(fullfilename, os.X_OK) and 'so' not in basename.split(os.path.extsep):
-                continue
-            fileinfo = ''
-            try:
-                fileinfo = subprocess.check_output(['file', '-b', fullfilename]).strip()
-            except Exception:
-                pass
-            if not fileinfo.startswith('ELF ') or not fileinfo.endswith(', not stripped'):
+            elf = elfutils.read_elf(fullfilename)
+            if elf is None or elf.is_stripped():
                 continue
 
-            # make sure file is writable
-            os.chmod(fullfilename, os.stat(fullfilename).st_mode | stat.S_IWUSR)
+            build_id = elf.get_build_id()
+            if build_id:
+                debugfilename = os.path.join(packagedb.build_id_debug_dir, build_id[:2],
+                                             build_id[2:] + '.debug')
+            else:
+                debugfilename = os.path.join('debug', dirname, basename + '.debug')
 
             # first create the /opt/debug/dirname
-            fulldebugdirname = os.path.join(destdir_prefix, 'debug', dirname)
+            fulldebugdirname = os.path.join(destdir_prefix, os.path.dirname(debugfilename))
             if not os.path.exists(fulldebugdirname):
                 os.makedirs(fulldebugdirname)
-            fulldebugfilename = os.path.join(fulldebugdirname, basename + '.debug')
+                filetable.add(os.path.dirname(debugfilename))
+            binaries.setdefault(debugfilename, []).append(filename)
 
-            # strip
+        if not binaries:
+            return
+
+        def split(item):
+            debugfilename, filenames = item
+            changed = []
+            for filename in filenames:
+                changed.extend(self._split_debug_file(destdir_prefix, installroot, filename, debugfilename,
+                                                      config.strip_debug_single_pass,
+                                                      config.compress_debug_sections))
+            return changed
+
+        # objcopy runs are independent from one debug file to another
+        pool = ThreadPool(min(len(binaries), max(1, config.jobs)))
+        try:
+            results = pool.map(split, binaries.items())
+        finally:
+            pool.close()
+            pool.join()
+
+        for changed in results:
+            for filename in changed:
+                if os.path.lexists(os.path.join(destdir_prefix, filename)):
+                    filetable.add(filename)
+                else:
+                    filetable.remove(filename)
+
+    def _split_debug_file(self, destdir_prefix, installroot, filename, debugfilename,
+                          single_pass=False, compress=False):
+        """Returns the files of DESTDIR_PREFIX which were changed."""
+        dirname, basename = os.path.split(filename)
+        fullfilename = os.path.join(destdir_prefix, filename)
+        fulldebugfilename = os.path.join(destdir_prefix, debugfilename)
+        fulldebuglinkname = os.path.join(destdir_prefix, dirname, basename + '.debug')
+        by_build_id = debugfilename.startswith(packagedb.build_id_debug_dir + os.sep)
+
+        # make sure file is writable
+        os.chmod(fullfilename, os.stat(fullfilename).st_mode | stat.S_IWUSR)
+
+        compress_args = []
+        if compress is True:
+            compress_args = ['--compress-debug-sections']
+        elif compress:
+            compress_args = ['--compress-debug-sections=%s' % compress]
+
+        # the debug file of this build-id may have been split already, for
+        # an identical binary of this module or of a previous install
+        split_needed = not os.path.exists(fulldebugfilename)
+        installeddebugfilename = os.path.join(installroot, debugfilename)
+        if split_needed and by_build_id and os.path.isfile(installeddebugfilename):
             try:
-                subprocess.check_call(['objcopy', '--only-keep-debug', fullfilename, fulldebugfilename])
+                fileutils.TreeCloner().clone_file(installeddebugfilename, fulldebugfilename)
+                split_needed = False
+            except (IOError, OSError):
+                fileutils.ensure_unlinked(fulldebugfilename)
+
+        debuglinkname = os.path.join(dirname, basename + '.debug')
+        changed = [filename, debugfilename, debuglinkname]
+
+        # create a /opt/dirname/basename.debug link to the debug file; a
+        # relative link already resolves in DESTDIR, so that the debug link
+        # of the binary can be given its name
+        if os.path.lexists(fulldebuglinkname):
+            os.remove(fulldebuglinkname)
+        if by_build_id:
+            os.symlink(os.path.relpath(fulldebugfilename, os.path.dirname(fulldebuglinkname)),
+                       fulldebuglinkname)
+            debuglink = fulldebuglinkname
+        else:
+            debuglink = fulldebugfilename
+
+        # strip
+        try:
+            if split_needed:
+                subprocess.check_call(['objcopy', '--only-keep-debug'] + compress_args + [fullfilename, fulldebugfilename])
+            if single_pass:
+                subprocess.check_call(['objcopy', '--strip-all', '--discard-all', '--preserve-dates',
+                                       '--remove-section', '.gnu_debuglink',
+                                       '--add-gnu-debuglink', debuglink, fullfilename])
+            else:
                 subprocess.check_call(['objcopy', '--remove-section', '.gnu_debuglink', fullfilename])
-                subprocess.check_call(['objcopy', '--add-gnu-debuglink', fulldebugfilename, fullfilename])
+                subprocess.check_call(['objcopy', '--add-gnu-debuglink', debuglink, fullfilename])
                 subprocess.check_call(['objcopy', '--strip-all', '--discard-all', '--preserve-dates', fullfilename])
-            except Exception:
-                continue
-
-            # create a /opt/dirname/basename.debug link to /opt/debug/dirname/basename.debug
-            fulldebuglinkname = os.path.join(destdir_prefix, dirname, basename + '.debug')
-            if os.path.exists(fulldebuglinkname):
+        except Exception:
+            if by_build_id:
                 os.remove(fulldebuglinkname)
-            os.symlink(os.path.join(installroot, 'debug', dirname, basename + '.debug'), fulldebuglinkname)
+            return changed
 
+        if not by_build_id:
+            os.symlink(os.path.join(installroot, debugfilename), fulldebuglinkname)
+        return changed
 
-    def _find_executables(self, destdir_prefix):
+    def _find_executables(self, filetable):
         executables = []
         # filter out files to strip
-        for filename in fileutils.accumulate_dirtree_contents(destdir_prefix):
-            dirname, basename = os.path.split(filename)
-            fullfilename = os.path.join(destdir_prefix, dirname, basename)
-            if not os.path.isfile(fullfilename) or os.path.islink(fullfilename):
+        for entry in filetable:
+            if entry.kind != 'file':
                 continue
-            if not os.access(fullfilename, os.X_OK) and 'so' not in basename.split(os.path.extsep):
+            filename = entry.path
+            if not entry.is_executable() and 'so' not in os.path.basename(filename).split(os.path.extsep):
                 continue
             if filename.endswith('.debug'):
                 continue
-            fileinfo = ''
-            try:
-                fileinfo = subprocess.check_output(['file', '-b', fullfilename]).strip()
-            except Exception:
-                pass
-            if not fileinfo.startswith('ELF '):
+            if elfutils.read_elf(os.path.join(filetable.root, filename)) is None:
                 continue
             executables.append(filename)
         return executables
 
-    def _find_executable_dependencies(self, fullfilename, destdir_prefix, installroot, librarypaths):
-        env = os.environ.copy()
-        env['LD_LIBRARY_PATH'] = ':'.join([
+    def _find_executable_dependencies(self, fullfilename, destdir_prefix, installroot, librarypaths, resolver, cache=False):
+        librarypath = [
             os.path.join(destdir_prefix, 'lib'),
             os.path.join(os.path.join(installroot, 'lib')),
-        ] + librarypaths)
-        lines = []
-        try:
-            lines = subprocess.check_output(['ldd', fullfilename], env=env).splitlines()
-        except Exception:
-            pass
-
-        found = []
-        notfound = []
-        for line in lines:
-            if '=>' not in line:
-                continue
-            lib, rest = map(lambda x: x.strip(), line.split('=>'))
-            if 'not found' in rest:
-                notfound.append(lib)
-                continue
-            found.append(rest.split()[0])
+        ] + librarypaths
+        return resolver.find_dependencies(fullfilename, librarypath, cache=cache)
 
-        return found, notfound
-
-    def _find_executable_system_dependencies(self, destdir_prefix, installroot):
+    def _find_executable_system_dependencies(self, filetable, installroot, resolver):
         notfounds = {}
-        executables = self._find_executables(destdir_prefix)
+        destdir_prefix = filetable.root
+        executables = self._find_executables(filetable)
         fullexecutables = set(os.path.join(destdir_prefix, filename) for filename in executables)
         librarypaths = sorted(set(os.path.dirname(fullfilename) for fullfilename in fullexecutables))
 
@@ -414,7 +529,9 @@ them into the prefix."""
         while executablequeue:
             # dequeue and find dependency
             fullfilename = executablequeue.pop()
-            found, notfound = self._find_executable_dependencies(fullfilename, destdir_prefix, installroot, librarypaths)
+            # dependencies of libraries outside of this module are cached
+            found, notfound = self._find_executable_dependencies(fullfilename, destdir_prefix, installroot, librarypaths,
+                                                                 resolver, cache=fullfilename not in fullexecutables)
 
             if fullfilename in fullexecutables:
                 filename = fullfilename[len(destdir_prefix) + len(os.path.sep):]
@@ -455,8 +572,6 @@ them into the prefix."""
     def process_install(self, buildscript, revision):
         assert self.supports_install_destdir
         destdir = self.get_destdir(buildscript)
-        self._clean_la_files(buildscript, destdir)
-        self._clean_texinfo_dir_files(buildscript, destdir)
 
         prefix_without_drive = os.path.splitdrive(buildscript.config.prefix)[1]
         stripped_prefix = prefix_without_drive[1:]
@@ -466,9 +581,16 @@ them into the prefix."""
         broken_name = destdir + '-broken'
         destdir_prefix = os.path.join(destdir, stripped_prefix)
 
+        # a single walk of DESTDIR, shared by the steps below
+        filetable = fileutils.FileTable(destdir_prefix)
+        self._clean_la_files(filetable)
+        self._clean_texinfo_dir_files(filetable)
+
         # simon: dump sysdeps
         logging.info(_('Finding system dependencies ...'))
-        systemdependencies, notfounds, rdependencies = self._find_executable_system_dependencies(destdir_prefix, buildscript.config.prefix)
+        resolver = elfutils.get_resolver(buildscript.config)
+        systemdependencies, notfounds, rdependencies = self._find_executable_system_dependencies(filetable, buildscript.config.prefix, resolver)
+        resolver.write_cache()
         if notfounds:
             broken = set()
             missing = set()
@@ -491,17 +613,23 @@ them into the prefix."""
         # simon: strip debug info before install
         if self.supports_stripping_debug_symbols:
             logging.info(_('Stripping debug symbols ...'))
-            self._strip_debug_symbols(destdir_prefix, buildscript.config.prefix)
+            self._strip_debug_symbols(filetable, buildscript.config.prefix, buildscript.config)
 
-        new_contents = fileutils.accumulate_dirtree_contents(destdir_prefix)
+        new_contents = filetable.get_contents()
+        checksums = filetable.get_checksums(buildscript.config.jobs)
         errors = []
 
         if os.path.isdir(destdir_prefix):
             destdir_install = True
+            if buildscript.config.install_snapshots:
+                logging.info(_('Saving a snapshot of the previous install ...'))
+                buildscript.moduleset.packagedb.snapshot(self.name,
+                                                         buildscript.config.install_snapshots)
             logging.info(_('Moving temporary DESTDIR %r into build prefix') % (destdir, ))
-            num_copied = self._process_install_files(destdir, destdir_prefix,
+            num_copied = self._process_install_files(filetable,
                                                      buildscript.config.prefix,
-                                                     errors)
+                                                     errors,
+                                                     buildscript.config.jobs)
             # Now the destdir should have a series of empty directories:
             # $JHBUILD_PREFIX/_jhbuild/root-foo/$JHBUILD_PREFIX
             # Remove them one by one to clean the tree to the state we expect,
@@ -550,6 +678,9 @@ them into the prefix."""
 
             for filename in new_contents:
                 to_delete.discard (os.path.join(self.config.prefix, filename))
+            # debug files may be shared with other modules, see cleandebug
+            to_delete = set(path for path in to_delete
+                            if not packagedb.is_shared_file(self.config, path))
 
             if to_delete:
                 # paranoid double-check
@@ -572,12 +703,15 @@ them into the prefix."""
                 branch = {self.branch.repomodule: revision}
                 logging.info(_('Installed branch: %s') % json.dumps(branch))
 
-            buildscript.moduleset.packagedb.add(self.name, revision or '',
-                                                new_contents,
-                                                self.configure_cmd,
-                                                systemdependencies,
-                                                branch,
-                                                self.module_hash)
+            unchanged = buildscript.moduleset.packagedb.add(self.name, revision or '',
+                                                            new_contents,
+                                                            self.configure_cmd,
+                                                            systemdependencies,
+                                                            branch,
+                                                            self.module_hash,
+                                                            checksums)
+            if unchanged:
+                logging.info(_('Installed files are identical to the previous install'))
 
         if errors:
             raise CommandError(_('Install encountered errors: %(num)d '
@@ -641,7 +775,8 @@ them into the prefix."""
         if buildscript.config.build_policy == 'updated-deps':
             install_date = buildscript.moduleset.packagedb.installdate(self.name)
             for dep in self.dependencies:
-                install_date_dep = buildscript.moduleset.packagedb.installdate(dep)
+                # reinstalling identical files does not update a dependency
+                install_date_dep = buildscript.moduleset.packagedb.outputsdate(dep)
                 if install_date_dep > install_date:
                     # a dependency has been updated
                     return None
@@ -804,10 +939,52 @@ class DownloadableModule:
         self.checkout(buildscript)
     do_checkout.error_phases = [PHASE_FORCE_CHECKOUT]
 
+    mirror_selected = False
+
+    def select_fastest_mirror(self):
+        """Make the fastest of the repository and its mirrors the branch to
+        check out from, the others being kept to fall back to."""
+        if self.mirror_selected or not self.branch.fallback_branches:
+            return
+        self.mirror_selected = True
+        if self.config.nonetwork:
+            return
+        branches = [self.branch] + list(self.branch.fallback_branches)
+        repositories = mirrorprobe.sort_repositories(
+                self.config, [branch.repository for branch in branches])
+        branches = [branches[[b.repository for b in branches].index(repo)]
+                    for repo in repositories]
+        self.branch = branches[0]
+        self.branch.fallback_branches = branches[1:]
+        for branch in branches[1:]:
+            branch.fallback_branches = ()
+
+    def checkout_with_fallback(self, buildscript, force=False):
+        """Check out or update the module, retrying from the next mirror when
+        this fails."""
+        self.select_fastest_mirror()
+        while True:
+            try:
+                if force:
+                    self.branch.force_checkout(buildscript)
+                else:
+                    self.branch.checkout(buildscript)
+                return
+            except CommandError:
+                if not self.branch.fallback_branches:
+                    raise
+                # try again from the next fastest mirror
+                mirrorprobe.mark_failed(self.config, self.branch.repository)
+                fallback_branches = self.branch.fallback_branches
+                self.branch = fallback_branches[0]
+                self.branch.fallback_branches = fallback_branches[1:]
+                logging.warning(_('Checkout failed, retrying from mirror %s')
+                                % mirrorprobe.get_repository_uri(self.branch.repository))
+
     def checkout(self, buildscript):
-        srcdir = self.get_srcdir(buildscript)
         buildscript.set_action(_('Checking out'), self)
-        self.branch.checkout(buildscript)
+        self.checkout_with_fallback(buildscript)
+        srcdir = self.get_srcdir(buildscript)
         # did the checkout succeed?
         if not os.path.exists(srcdir):
             raise BuildStateError(_('source directory %s was not created') % srcdir)
@@ -833,7 +1010,7 @@ class DownloadableModule:
         except:
             pass
         buildscript.set_action(_('Checking out'), self)
-        self.branch.force_checkout(buildscript)
+        self.checkout_with_fallback(buildscript, force=True)
     do_force_checkout.error_phases = [PHASE_FORCE_CHECKOUT]
     do_force_checkout.label = N_('wipe directory and start over')
     do_force_checkout.needs_confirmation = True
@@ -255,10 +255,59 @@ def compare_version(version, minver):
             minver[i] = int(part)
     return version >= minver
 
+def find_program(program, extra_env=None):
+    '''Return the full path of PROGRAM, looked up in the PATH of
+    extra_env if set or of the environment otherwise, or None if it
+    could not be found.'''
+    if os.path.dirname(program):
+        if os.path.isfile(program):
+            return os.path.abspath(program)
+        return None
+    path = None
+    if extra_env:
+        path = extra_env.get('PATH')
+    if path is None:
+        path = os.environ.get('PATH', '')
+    for dir in path.split(os.pathsep):
+        prog = os.path.abspath(os.path.join(dir, program))
+        if os.path.isfile(prog):
+            return prog
+        # also check for cmd.exe on Windows
+        if sys.platform.startswith('win') and os.path.isfile(prog + '.exe'):
+            return prog + '.exe'
+    return None
+
+# output of version commands, keyed by command and by path and modification
+# time of the program, so that a tool upgraded while jhbuild runs is probed
+# again
+_version_output_cache = {}
+
+def get_version_output(cmd, extra_env=None):
+    '''Return the output of the version command CMD, or None if it failed.
+    Each program is only run once per process.'''
+    if isinstance(cmd, (str, unicode)):
+        key = (cmd,)
+        program = cmd.split()[0]
+    else:
+        key = tuple(cmd)
+        program = cmd[0]
+    prog = find_program(program, extra_env)
+    if prog is not None:
+        try:
+            key = key + (prog, os.stat(prog).st_mtime)
+        except OSError:
+            pass
+    if key not in _version_output_cache:
+        try:
+            data = get_output(cmd, extra_env=extra_env)
+        except:
+            data = None
+        _version_output_cache[key] = data
+    return _version_output_cache[key]
+
 def check_version(cmd, regexp, minver, extra_env=None):
-    try:
-        data = get_output(cmd, extra_env=extra_env)
-    except:
+    data = get_version_output(cmd, extra_env=extra_env)
+    if data is None:
         return False
     match = re.match(regexp, data, re.MULTILINE)
     if not match:
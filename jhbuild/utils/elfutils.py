@@ -0,0 +1,578 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   elfutils.py: minimal reader of ELF headers and section tables
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Inspection of installed binaries without spawning 'file' or 'ldd' for
+each of them.  Only the ELF header, the section table and the few sections
+we are interested in are read.  Shared library dependencies are resolved
+the way the dynamic loader does:
+    - DT_RPATH of the object and of the objects that loaded it, unless the
+      object has a DT_RUNPATH,
+    - the given LD_LIBRARY_PATH,
+    - DT_RUNPATH of the object,
+    - /etc/ld.so.cache, then the default library directories.
+The dependencies of libraries outside of the build can be kept in a cache
+file, and are then only resolved again when one of them changes.
+'''
+
+import os
+import re
+import json
+import struct
+import logging
+import collections
+
+from jhbuild.utils import fileutils
+
+ELFMAG = '\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ET_REL = 1
+ET_EXEC = 2
+ET_DYN = 3
+ET_CORE = 4
+
+SHT_SYMTAB = 2
+SHT_DYNAMIC = 6
+SHT_NOTE = 7
+SHT_NOBITS = 8
+
+SHN_XINDEX = 0xffff
+
+NT_GNU_BUILD_ID = 3
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+# e_type .. e_shstrndx, following e_ident
+_header_formats = {
+    ELFCLASS32: 'HHIIIIIHHHHHH',
+    ELFCLASS64: 'HHIQQQIHHHHHH',
+    }
+
+# sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, ...
+_section_formats = {
+    ELFCLASS32: 'IIIIIIIIII',
+    ELFCLASS64: 'IIQQQQIIQQ',
+    }
+
+# d_tag, d_val
+_dynamic_formats = {
+    ELFCLASS32: 'iI',
+    ELFCLASS64: 'qQ',
+    }
+
+_byteorders = {
+    ELFDATA2LSB: '<',
+    ELFDATA2MSB: '>',
+    }
+
+
+class ElfSection:
+    def __init__(self, name, type, offset, size, link):
+        self.name = name
+        self.type = type
+        self.offset = offset
+        self.size = size
+        self.link = link
+
+
+class ElfFile:
+    '''Headers of an ELF file.  Construct it with read_elf(), which returns
+    None for files that are not ELF.'''
+
+    def __init__(self, fp):
+        ident = fp.read(16)
+        if len(ident) < 16 or ident[:4] != ELFMAG:
+            raise ValueError('not an ELF file')
+        self.elfclass = ord(ident[4])
+        if self.elfclass not in _header_formats or \
+                ord(ident[5]) not in _byteorders:
+            raise ValueError('unsupported ELF class or data encoding')
+        self.byteorder = _byteorders[ord(ident[5])]
+        self.fp = fp
+
+        (self.type, self.machine, version, entry, phoff, shoff, flags,
+         ehsize, phentsize, phnum, shentsize, shnum,
+         shstrndx) = self._unpack(_header_formats[self.elfclass])
+        self.phoff, self.phentsize, self.phnum = phoff, phentsize, phnum
+
+        self.sections = []
+        if shoff and shentsize:
+            self._read_sections(shoff, shentsize, shnum, shstrndx)
+        self._build_id = False
+        self._dynamic = None
+
+    def _unpack(self, format, offset=None):
+        format = self.byteorder + format
+        if offset is not None:
+            self.fp.seek(offset)
+        data = self.fp.read(struct.calcsize(format))
+        if len(data) < struct.calcsize(format):
+            raise ValueError('truncated ELF file')
+        return struct.unpack(format, data)
+
+    def read_data(self, offset, size):
+        self.fp.seek(offset)
+        data = self.fp.read(size)
+        if len(data) < size:
+            raise ValueError('truncated ELF file')
+        return data
+
+    def _read_sections(self, shoff, shentsize, shnum, shstrndx):
+        format = _section_formats[self.elfclass]
+        headers = []
+        first = self._unpack(format, shoff)
+        # with more than 0xff00 sections, the real numbers are kept in the
+        # first section header
+        if shnum == 0:
+            shnum = first[5]
+        if shstrndx == SHN_XINDEX:
+            shstrndx = first[6]
+        for i in range(shnum):
+            headers.append(self._unpack(format, shoff + i * shentsize))
+
+        names = ''
+        if shstrndx < len(headers):
+            strtab = headers[shstrndx]
+            names = self.read_data(strtab[4], strtab[5])
+        for header in headers:
+            end = names.find('\0', header[0])
+            if end < 0:
+                end = len(names)
+            self.sections.append(ElfSection(names[header[0]:end], header[1],
+                                            header[4], header[5], header[6]))
+
+    def get_section(self, name):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def get_build_id(self):
+        '''Return the GNU build-id as an hexadecimal string, or None.'''
+        if self._build_id is False:
+            self._build_id = None
+            section = self.get_section('.note.gnu.build-id')
+            if section is not None and section.type == SHT_NOTE:
+                data = self.read_data(section.offset, section.size)
+                pos = 0
+                while pos + 12 <= len(data):
+                    namesz, descsz, type = struct.unpack(
+                            self.byteorder + 'III', data[pos:pos + 12])
+                    pos += 12
+                    name = data[pos:pos + namesz].rstrip('\0')
+                    pos += (namesz + 3) & ~3
+                    desc = data[pos:pos + descsz]
+                    pos += (descsz + 3) & ~3
+                    if type == NT_GNU_BUILD_ID and name == 'GNU':
+                        self._build_id = desc.encode('hex')
+                        break
+        return self._build_id
+
+    def _read_dynamic(self):
+        self._dynamic = {}
+        for section in self.sections:
+            if section.type == SHT_DYNAMIC:
+                break
+        else:
+            return
+        if section.link >= len(self.sections):
+            return
+        strtab = self.sections[section.link]
+        strings = self.read_data(strtab.offset, strtab.size)
+        format = self.byteorder + _dynamic_formats[self.elfclass]
+        entsize = struct.calcsize(format)
+        data = self.read_data(section.offset, section.size)
+        for pos in range(0, len(data) - entsize + 1, entsize):
+            tag, value = struct.unpack(format, data[pos:pos + entsize])
+            if tag == DT_NULL:
+                break
+            if tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH):
+                end = strings.find('\0', value)
+                if end < 0:
+                    end = len(strings)
+                self._dynamic.setdefault(tag, []).append(strings[value:end])
+
+    def is_dynamic(self):
+        return bool(self._dynamic)
+
+    def get_needed(self):
+        '''Return the DT_NEEDED entries, in order.'''
+        return self._dynamic.get(DT_NEEDED, [])
+
+    def get_soname(self):
+        return self._dynamic.get(DT_SONAME, [None])[0]
+
+    def get_rpath(self):
+        return self._dynamic.get(DT_RPATH, [None])[0]
+
+    def get_runpath(self):
+        return self._dynamic.get(DT_RUNPATH, [None])[0]
+
+    def has_symtab(self):
+        for section in self.sections:
+            if section.type == SHT_SYMTAB:
+                return True
+        return False
+
+    def has_debug_info(self):
+        for section in self.sections:
+            if section.type != SHT_NOBITS and (
+                    section.name.startswith('.debug_') or
+                    section.name.startswith('.zdebug_')):
+                return True
+        return False
+
+    def is_stripped(self):
+        '''Whether there is nothing left to strip, what 'file' reports as
+        "stripped".'''
+        return not self.has_symtab() and not self.has_debug_info()
+
+
+class CachedElfFile(ElfFile):
+    '''The parts of an ElfFile needed to resolve dependencies, as kept in a
+    cache file.'''
+
+    def __init__(self, data):
+        self.elfclass = data['class']
+        self.machine = data['machine']
+        self.type = data['type']
+        self.sections = []
+        self._build_id = None
+        self._dynamic = dict((tag, values) for tag, values in data['dynamic'])
+
+    @staticmethod
+    def serialize(elf):
+        return {'class': elf.elfclass,
+                'machine': elf.machine,
+                'type': elf.type,
+                'dynamic': sorted(elf._dynamic.items())}
+
+
+def read_elf(filename):
+    '''Return an ElfFile for FILENAME, or None if it is not an ELF file or
+    could not be read.'''
+    try:
+        fp = open(filename, 'rb')
+    except (IOError, OSError):
+        return None
+    try:
+        elf = ElfFile(fp)
+        # read what we need while the file is open
+        elf.get_build_id()
+        elf._read_dynamic()
+        elf.fp = None
+        return elf
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+    finally:
+        fp.close()
+
+
+def parse_ld_so_cache(data):
+    '''Return a dictionary mapping library names to the list of paths
+    listed for them in the contents of an ld.so.cache file.'''
+    entries = {}
+    old_magic = 'ld.so-1.7.0'
+    new_magic = 'glibc-ld.so.cache1.1'
+    start = 0
+    if data.startswith(old_magic):
+        nlibs, = struct.unpack('=I', data[12:16])
+        # the new format, if present, follows the old entries
+        start = 16 + nlibs * 12
+        start = (start + 7) & ~7
+        if not data.startswith(new_magic, start):
+            strings = 16 + nlibs * 12
+            for i in range(nlibs):
+                flags, key, value = struct.unpack(
+                        '=iII', data[16 + i * 12:28 + i * 12])
+                entries.setdefault(_get_string(data, strings + key), []).append(
+                        _get_string(data, strings + value))
+            return entries
+    if not data.startswith(new_magic, start):
+        raise ValueError('unknown ld.so.cache format')
+    nlibs, = struct.unpack('=I', data[start + 20:start + 24])
+    for i in range(nlibs):
+        offset = start + 48 + i * 24
+        flags, key, value = struct.unpack('=iII', data[offset:offset + 12])
+        entries.setdefault(_get_string(data, start + key), []).append(
+                _get_string(data, start + value))
+    return entries
+
+def _get_string(data, offset):
+    end = data.find('\0', offset)
+    if end < 0:
+        end = len(data)
+    return data[offset:end]
+
+
+# the dynamic loader is always loaded already, ldd does not list it as a
+# dependency
+_dynamic_loader_re = re.compile(r'^ld(-linux[\w.-]*|64|-musl-[\w.-]+)?\.so(\.\d+)*$')
+
+
+class DependencyResolver:
+    '''Finds the shared libraries an ELF object would be loaded with, as
+    listed by ldd.  Parsed objects and lookups in the system directories
+    are remembered, so that system libraries are only resolved once.'''
+
+    ld_so_cache = '/etc/ld.so.cache'
+
+    def __init__(self, cachefile=None):
+        self.cachefile = cachefile
+        self.objects = {}
+        self.system_libraries = {}
+        self.cache_entries = None
+        self.libraries = {}
+        self.closures = {}
+        self.cache_changed = False
+        self.shadowing_names = (None, None)
+        self.read_cache()
+
+    def get_file_key(self, filename):
+        '''Return what identifies the contents of FILENAME, or None if
+        it does not exist.'''
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def read_cache(self):
+        self.libraries = {}
+        self.closures = {}
+        if not self.cachefile:
+            return
+        try:
+            data = json.load(open(self.cachefile))
+        except (IOError, ValueError):
+            return
+        # resolving system libraries depends on ld.so.cache
+        if isinstance(data, dict) and \
+                data.get('ld.so.cache') == self.get_file_key(self.ld_so_cache):
+            self.libraries = data.get('libraries', {})
+            self.closures = data.get('closures', {})
+
+    def write_cache(self):
+        if not self.cachefile or not self.cache_changed:
+            return
+        data = {'ld.so.cache': self.get_file_key(self.ld_so_cache),
+                'libraries': self.libraries,
+                'closures': self.closures}
+        try:
+            fileutils.mkdir_with_parents(os.path.dirname(self.cachefile))
+            writer = fileutils.SafeWriter(self.cachefile)
+            json.dump(data, writer.fp)
+            writer.commit()
+            self.cache_changed = False
+        except (IOError, OSError) as e:
+            logging.warning(_('could not save library dependencies (%s)') % e)
+
+    def get_object(self, filename, cache=False):
+        '''Return the parsed ElfFile of FILENAME, or None.  With CACHE, what
+        is needed to resolve its dependencies is kept in the cache file.'''
+        key = self.get_file_key(filename)
+        if key is None:
+            return None
+        entry = self.objects.get(filename)
+        if entry is None or entry[0] != key:
+            library = self.libraries.get(filename)
+            if cache and library is not None and library['key'] == key:
+                entry = (key, CachedElfFile(library))
+            else:
+                entry = (key, read_elf(filename))
+                if cache and entry[1] is not None:
+                    library = CachedElfFile.serialize(entry[1])
+                    library['key'] = key
+                    self.libraries[filename] = library
+                    self.cache_changed = True
+            self.objects[filename] = entry
+        return entry[1]
+
+    def get_cache_entries(self):
+        if self.cache_entries is None:
+            try:
+                with open(self.ld_so_cache, 'rb') as fp:
+                    self.cache_entries = parse_ld_so_cache(fp.read())
+            except (IOError, ValueError, struct.error):
+                self.cache_entries = {}
+        return self.cache_entries
+
+    def get_default_dirs(self, elf):
+        if elf.elfclass == ELFCLASS64:
+            return ['/lib64', '/usr/lib64', '/lib', '/usr/lib']
+        return ['/lib', '/usr/lib']
+
+    def _expand_path(self, path, origin):
+        dirs = []
+        for dirname in path.split(':'):
+            if not dirname:
+                continue
+            dirname = dirname.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+            if len(dirname) > 1:
+                dirname = dirname.rstrip('/')
+            dirs.append(dirname)
+        return dirs
+
+    def _is_compatible(self, elf, lib):
+        return lib is not None and lib.type == ET_DYN and \
+               lib.elfclass == elf.elfclass and lib.machine == elf.machine
+
+    def _search_dirs(self, name, dirs, elf, cache=False):
+        for dirname in dirs:
+            filename = os.path.join(dirname, name)
+            lib = self.get_object(filename, cache)
+            if self._is_compatible(elf, lib):
+                return filename, lib
+        return None
+
+    def _search_system(self, name, elf):
+        key = (name, elf.elfclass, elf.machine)
+        if key not in self.system_libraries:
+            result = None
+            for filename in self.get_cache_entries().get(name, []):
+                lib = self.get_object(filename, cache=True)
+                if self._is_compatible(elf, lib):
+                    result = (filename, lib)
+                    break
+            else:
+                result = self._search_dirs(name, self.get_default_dirs(elf),
+                                           elf, cache=True)
+            self.system_libraries[key] = result
+        return self.system_libraries[key]
+
+    def resolve(self, name, elf, rpath_dirs, runpath_dirs, library_path):
+        '''Return a (filename, ElfFile) tuple for the library NAME needed by
+        ELF, or None if it cannot be found.'''
+        if '/' in name:
+            lib = self.get_object(name)
+            if self._is_compatible(elf, lib):
+                return name, lib
+            return None
+        return self._search_dirs(name, rpath_dirs, elf) or \
+               self._search_dirs(name, library_path, elf) or \
+               self._search_dirs(name, runpath_dirs, elf) or \
+               self._search_system(name, elf)
+
+    def _find_closure(self, filename, library_path, cache=False):
+        elf = self.get_object(filename, cache)
+        if elf is None or not elf.is_dynamic():
+            return [], [], []
+
+        found = []
+        notfound = []
+        names = []
+        seen = set()
+        # entries are (filename, ElfFile, DT_RPATH dirs of the loaders)
+        queue = collections.deque([(filename, elf, [])])
+        while queue:
+            objname, obj, loader_rpath_dirs = queue.popleft()
+            origin = os.path.dirname(objname)
+            if obj.get_runpath() is not None:
+                inherited_dirs = loader_rpath_dirs
+                rpath_dirs = []
+                runpath_dirs = self._expand_path(obj.get_runpath(), origin)
+            else:
+                inherited_dirs = self._expand_path(obj.get_rpath() or '',
+                                                   origin) + loader_rpath_dirs
+                rpath_dirs = inherited_dirs
+                runpath_dirs = []
+            for name in obj.get_needed():
+                if name in seen or _dynamic_loader_re.match(name):
+                    continue
+                seen.add(name)
+                names.append(name)
+                result = self.resolve(name, elf, rpath_dirs, runpath_dirs,
+                                      library_path)
+                if result is None:
+                    notfound.append(name)
+                    continue
+                libname, lib = result
+                found.append(libname)
+                if lib.get_soname():
+                    seen.add(lib.get_soname())
+                queue.append((libname, lib, inherited_dirs))
+        return found, notfound, names
+
+    def _get_shadowing_names(self, library_path):
+        # names of the files in LIBRARY_PATH, which would take precedence
+        # over system libraries
+        key = [(dirname, self.get_file_key(dirname)) for dirname in library_path]
+        if self.shadowing_names[0] != key:
+            names = set()
+            for dirname in library_path:
+                try:
+                    names.update(os.listdir(dirname))
+                except OSError:
+                    pass
+            self.shadowing_names = (key, names)
+        return self.shadowing_names[1]
+
+    def _is_valid_closure(self, filename, closure):
+        if closure.get('key') != self.get_file_key(filename):
+            return False
+        for libname, key in closure['members']:
+            if self.get_file_key(libname) != key:
+                return False
+        return True
+
+    def find_dependencies(self, filename, library_path=[], cache=False):
+        '''Return the (found, notfound) dependencies of FILENAME: paths of
+        all the libraries it would be loaded with, and names of those which
+        could not be found, in the order of ldd.
+
+        With CACHE, the dependencies are resolved without LIBRARY_PATH and
+        kept in the cache file, and only used when none of them could have
+        been found in LIBRARY_PATH instead.  This is meant for libraries
+        outside of the build.'''
+        library_path = [d.rstrip('/') or '/' for d in library_path if d]
+        if not cache:
+            return self._find_closure(filename, library_path)[:2]
+
+        closure = self.closures.get(filename)
+        if closure is None or not self._is_valid_closure(filename, closure):
+            found, notfound, names = self._find_closure(filename, [], cache)
+            closure = {'key': self.get_file_key(filename),
+                       'found': found,
+                       'notfound': notfound,
+                       'names': names,
+                       'members': [(libname, self.get_file_key(libname))
+                                   for libname in found]}
+            self.closures[filename] = closure
+            self.cache_changed = True
+        if library_path and not self._get_shadowing_names(
+                library_path).isdisjoint(closure['names']):
+            return self._find_closure(filename, library_path)[:2]
+        return list(closure['found']), list(closure['notfound'])
+
+
+_resolver = None
+def get_resolver(config):
+    '''Return the DependencyResolver of this build, which caches the
+    dependencies of system libraries under top_builddir.'''
+    global _resolver
+    if _resolver is None:
+        cachefile = os.path.join(config.top_builddir, 'elfdeps.json')
+        _resolver = DependencyResolver(cachefile)
+    return _resolver
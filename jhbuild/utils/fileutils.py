@@ -22,6 +22,23 @@
 import os
 import sys
 import errno
+import shutil
+import stat
+import mmap
+import hashlib
+import collections
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 def _accumulate_dirtree_contents_recurse(path, contents):
     names = os.listdir(path)
@@ -51,6 +68,152 @@ in the returned list is relative to the root path."""
         contents[i] = subpath[pathlen:]
     return contents
 
+# files from this size on are hashed through a memory map
+_hash_mmap_size = 1024 * 1024
+
+def hash_file(path):
+    """Return the SHA-1 digest of the contents of the file at PATH, or of
+the target of the symbolic link at PATH."""
+    digest = hashlib.sha1()
+    if os.path.islink(path):
+        digest.update(os.readlink(path))
+        return digest.hexdigest()
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size >= _hash_mmap_size:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except EnvironmentError:
+                pass
+            else:
+                try:
+                    digest.update(data)
+                finally:
+                    data.close()
+                return digest.hexdigest()
+        while True:
+            data = fp.read(1024 * 1024)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+class FileEntry(object):
+    """A file of a FileTable, with the result of a single lstat() call."""
+
+    __slots__ = ('path', 'kind', 'mode', 'size', 'ino', 'mtime')
+
+    def __init__(self, path, st):
+        self.path = path
+        if stat.S_ISDIR(st.st_mode):
+            self.kind = 'dir'
+        elif stat.S_ISLNK(st.st_mode):
+            self.kind = 'link'
+        elif stat.S_ISREG(st.st_mode):
+            self.kind = 'file'
+        else:
+            self.kind = 'other'
+        self.mode = st.st_mode
+        self.size = st.st_size
+        self.ino = st.st_ino
+        self.mtime = st.st_mtime
+
+    def is_executable(self):
+        return bool(self.mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+
+class FileTable(object):
+    """The files and directories under ROOT, found by a single walk, so that
+the steps processing a tree share it instead of walking and stat()ing it
+again.  Paths are relative to ROOT, and directories come before their
+contents.  Steps which change the tree keep the table up to date with
+add() and remove()."""
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = collections.OrderedDict()
+        self._scan('')
+
+    def _scan(self, relpath):
+        dirpath = os.path.join(self.root, relpath)
+        try:
+            if scandir is not None:
+                children = [(entry.name, entry.stat(follow_symlinks=False))
+                            for entry in scandir(dirpath)]
+            else:
+                children = [(name, os.lstat(os.path.join(dirpath, name)))
+                            for name in os.listdir(dirpath)]
+        except OSError:
+            return
+        for name, st in children:
+            path = os.path.join(relpath, name)
+            entry = FileEntry(path, st)
+            self.entries[path] = entry
+            if entry.kind == 'dir':
+                self._scan(path)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, relpath):
+        return self.entries.get(relpath)
+
+    def add(self, relpath):
+        """Record the file at RELPATH, and its parent directories."""
+        parent = os.path.dirname(relpath)
+        if parent and parent not in self.entries:
+            self.add(parent)
+        self.entries[relpath] = FileEntry(relpath,
+                                          os.lstat(os.path.join(self.root, relpath)))
+
+    def remove(self, relpath):
+        self.entries.pop(relpath, None)
+
+    def get_checksums(self, jobs=1):
+        """Return a dictionary of the files and symbolic links, giving their
+[size, permissions, SHA-1 digest].  Files are read by JOBS threads."""
+        entries = [entry for entry in self if entry.kind in ('file', 'link')]
+        paths = [os.path.join(self.root, entry.path) for entry in entries]
+        if jobs > 1 and len(paths) > 1:
+            pool = ThreadPool(min(len(paths), jobs))
+            try:
+                digests = pool.map(hash_file, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = map(hash_file, paths)
+        checksums = {}
+        for entry, digest in zip(entries, digests):
+            checksums[entry.path] = [entry.size, stat.S_IMODE(entry.mode), digest]
+        return checksums
+
+    def get_contents(self):
+        """Return the files and empty directories, as
+accumulate_dirtree_contents() does."""
+        parents = set(os.path.dirname(path) for path in self.entries)
+        contents = []
+        for entry in self:
+            if entry.kind != 'dir':
+                contents.append(entry.path)
+            elif entry.path not in parents:
+                contents.append(entry.path + os.sep)
+        return contents
+
+def move_file(src, dst, cloner=None):
+    """Rename SRC to DST, replacing it.  If they are on different
+filesystems, SRC is cloned with CLONER next to DST and then renamed."""
+    try:
+        rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = dst + '.jhbuild-tmp'
+        (cloner or TreeCloner()).clone_file(src, tmp)
+        rename(tmp, dst)
+        os.unlink(src)
+
 def remove_files_and_dirs(file_paths, config, allow_nonempty_dirs=False):
     """Given a list of file paths in any order, attempt to delete
 them.  The main intelligence in this function is removing files
@@ -146,6 +309,133 @@ def mkdir_with_parents(filename):
         if e.errno != errno.EEXIST or not os.path.isdir(filename):
             raise
 
+# ioctl request sharing the data blocks of a file with another one
+# (Linux, on btrfs, xfs and other copy-on-write capable filesystems)
+FICLONE = 0x40049409
+
+def reflink_file(src, dst):
+    """Create DST as a copy-on-write clone of the regular file SRC.
+
+Returns False if the filesystem does not support it, in which case DST is
+left as an empty file."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    src_fp = open(src, 'rb')
+    try:
+        dst_fp = open(dst, 'wb')
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except IOError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                           errno.ENOTTY, errno.ENOSYS, errno.EPERM):
+                return False
+            raise
+        finally:
+            dst_fp.close()
+    finally:
+        src_fp.close()
+    return True
+
+class TreeCloner(object):
+    """Copies files and directory trees, sharing file data with the source
+using reflinks where the filesystem supports it, falling back to hard links
+if allowed or to plain copies otherwise.
+
+Hard links share the inode, so they must only be used when neither side is
+modified in place."""
+
+    def __init__(self, hardlink=False):
+        self.hardlink = hardlink
+        self.can_reflink = True
+
+    def clone_file(self, src, dst):
+        if self.can_reflink:
+            if reflink_file(src, dst):
+                shutil.copystat(src, dst)
+                return
+            self.can_reflink = False
+        if self.hardlink:
+            try:
+                ensure_unlinked(dst)
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+                self.hardlink = False
+        shutil.copy2(src, dst)
+
+    def clone_tree(self, srcdir, dstdir):
+        """Recursively copy SRCDIR to DSTDIR, which must not exist."""
+        os.mkdir(dstdir)
+        for name in os.listdir(srcdir):
+            src_path = os.path.join(srcdir, name)
+            dst_path = os.path.join(dstdir, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isdir(src_path):
+                self.clone_tree(src_path, dst_path)
+            else:
+                self.clone_file(src_path, dst_path)
+        shutil.copystat(srcdir, dstdir)
+
+    def _remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+    def sync_tree(self, srcdir, dstdir):
+        """Make DSTDIR a copy of SRCDIR, only copying the files whose size
+or modification time differ and removing those no longer in SRCDIR.
+
+Returns the number of files and symbolic links that were copied."""
+        if os.path.lexists(dstdir) and \
+                (os.path.islink(dstdir) or not os.path.isdir(dstdir)):
+            os.unlink(dstdir)
+        if not os.path.exists(dstdir):
+            os.mkdir(dstdir)
+
+        num_copied = 0
+        names = set(os.listdir(srcdir))
+        for name in os.listdir(dstdir):
+            if name not in names:
+                self._remove(os.path.join(dstdir, name))
+
+        for name in names:
+            src_path = os.path.join(srcdir, name)
+            dst_path = os.path.join(dstdir, name)
+            src_st = os.lstat(src_path)
+            try:
+                dst_st = os.lstat(dst_path)
+            except OSError:
+                dst_st = None
+
+            if stat.S_ISDIR(src_st.st_mode):
+                num_copied += self.sync_tree(src_path, dst_path)
+                continue
+
+            if dst_st is not None:
+                if stat.S_ISLNK(src_st.st_mode):
+                    if (stat.S_ISLNK(dst_st.st_mode) and
+                            os.readlink(dst_path) == os.readlink(src_path)):
+                        continue
+                elif (stat.S_ISREG(dst_st.st_mode) and
+                        dst_st.st_size == src_st.st_size and
+                        int(dst_st.st_mtime) == int(src_st.st_mtime)):
+                    continue
+                # replace rather than overwrite, the destination may be
+                # read-only or share its data with another file
+                self._remove(dst_path)
+
+            if stat.S_ISLNK(src_st.st_mode):
+                os.symlink(os.readlink(src_path), dst_path)
+            else:
+                self.clone_file(src_path, dst_path)
+            num_copied += 1
+        shutil.copystat(srcdir, dstdir)
+        return num_copied
+
 class SafeWriter(object):
     def __init__(self, filename):
         self.filename = filename
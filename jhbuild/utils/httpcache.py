@@ -35,6 +35,7 @@ import urlparse
 import time
 import rfc822
 import StringIO
+import threading
 try:
     import gzip
 except ImportError:
@@ -83,6 +84,7 @@ class Cache:
         if not os.path.exists(self.cachedir):
             os.makedirs(self.cachedir)
         self.entries = {}
+        self.lock = threading.RLock()
 
     def read_cache(self):
         self.entries = {}
@@ -175,8 +177,9 @@ class Cache:
         now = time.time()
 
         # is the file cached and not expired?
-        self.read_cache()
-        entry = self.entries.get(uri)
+        with self.lock:
+            self.read_cache()
+            entry = self.entries.get(uri)
         if entry and (age != 0 or nonetwork):
             if (nonetwork or now <= entry.expires):
                 return os.path.join(self.cachedir, entry.local)
@@ -193,6 +196,7 @@ class Cache:
             if entry.etag:
                 request.add_header('If-None-Match', entry.etag)
 
+        data = None
         try:
             response = urllib2.urlopen(request)
 
@@ -205,38 +209,43 @@ class Cache:
                     data = ''
 
             expires = response.headers.get('Expires')
-            
-            # add new content to cache
-            entry = CacheEntry(uri, self._make_filename(uri),
-                               response.headers.get('Last-Modified'),
-                               response.headers.get('ETag'))
-            filename = os.path.join(self.cachedir, entry.local)
-            fp = open(filename, 'wb')
-            fp.write(data)
-            fp.close()
         except urllib2.HTTPError as e:
             if e.code == 304: # not modified; update validated
                 expires = e.hdrs.get('Expires')
-                filename = os.path.join(self.cachedir, entry.local)
             else:
                 raise
 
-        # set expiry date
-        entry.expires = _parse_date(expires)
-        if entry.expires <= now: # ignore expiry times that have already passed
-            if age is None:
-                age = self.default_age
-            entry.expires = now + age
+        # the index and file names are shared with other threads loading
+        # files at the same time
+        with self.lock:
+            if data is not None:
+                # add new content to cache
+                entry = CacheEntry(uri, self._make_filename(uri),
+                                   response.headers.get('Last-Modified'),
+                                   response.headers.get('ETag'))
+                fp = open(os.path.join(self.cachedir, entry.local), 'wb')
+                fp.write(data)
+                fp.close()
+            filename = os.path.join(self.cachedir, entry.local)
+
+            # set expiry date
+            entry.expires = _parse_date(expires)
+            if entry.expires <= now: # ignore expiry times that have already passed
+                if age is None:
+                    age = self.default_age
+                entry.expires = now + age
 
-        # save cache
-        self.entries[uri] = entry
-        self.write_cache()
+            # save cache
+            self.entries[uri] = entry
+            self.write_cache()
         return filename
 
 _cache = None
+_cache_lock = threading.Lock()
 def load(uri, nonetwork=False, age=None):
     '''Downloads the file associated with the URI, and returns a local
     file name for contents.'''
     global _cache
-    if not _cache: _cache = Cache()
+    with _cache_lock:
+        if not _cache: _cache = Cache()
     return _cache.load(uri, nonetwork=nonetwork, age=age)
@@ -0,0 +1,195 @@
+# jhbuild - a tool to ease building collections of source packages
+#
+#   mirrorprobe.py: pick the fastest mirror of a repository
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+'''Ordering of a repository and its <mirror> elements by measured latency,
+used by the 'fastest' mirror policy.  Strategies include:
+    - HTTP(S) hosts are timed with a HEAD request, other hosts with a TCP
+      connection to the port of the URI scheme.
+    - results are kept per host in a cache file, and only measured again
+      once older than mirror_probe_ttl.
+    - hosts which failed to answer, or on which a checkout failed, are
+      marked unhealthy and ordered last.
+'''
+
+import os
+import time
+import json
+import socket
+import logging
+import urllib2
+import urlparse
+import threading
+from multiprocessing.pool import ThreadPool
+
+from jhbuild.utils import fileutils
+
+_default_ports = {
+    'http': 80,
+    'https': 443,
+    'ftp': 21,
+    'git': 9418,
+    'ssh': 22,
+    'git+ssh': 22,
+    'svn': 3690,
+    'svn+ssh': 22,
+    'bzr': 4155,
+    'bzr+ssh': 22,
+    }
+
+def get_repository_uri(repository):
+    return getattr(repository, 'href', None)
+
+def parse_host(uri):
+    '''Return a (scheme, host, port) tuple for the server of URI, or None
+    for local repositories.'''
+    if not uri:
+        return None
+    parts = urlparse.urlsplit(uri)
+    scheme = parts.scheme
+    if scheme in ('', 'file'):
+        # scp-like syntax, user@host:path
+        if scheme == '' and ':' in uri and not uri.startswith('/'):
+            host = uri.split(':', 1)[0].split('@')[-1]
+            return ('ssh', host, 22)
+        return None
+    host = parts.hostname
+    if not host:
+        return None
+    port = parts.port or _default_ports.get(scheme)
+    if port is None:
+        return None
+    return (scheme, host, port)
+
+
+class MirrorProber:
+    # how many hosts are probed at the same time
+    max_probes = 8
+
+    def __init__(self, cachefile, ttl, timeout=5):
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.orders = {}
+        self.read_cache()
+
+    def read_cache(self):
+        try:
+            self.hosts = json.load(open(self.cachefile))
+        except (IOError, ValueError):
+            self.hosts = {}
+
+    def write_cache(self):
+        try:
+            fileutils.mkdir_with_parents(os.path.dirname(self.cachefile))
+            writer = fileutils.SafeWriter(self.cachefile)
+            json.dump(self.hosts, writer.fp, sort_keys=True, indent=4)
+            writer.commit()
+        except (IOError, OSError) as e:
+            logging.warning(_('could not save mirror latencies (%s)') % e)
+
+    def _host_key(self, host):
+        return '%s:%s' % (host[1], host[2])
+
+    def probe(self, uri):
+        '''Return the time taken to reach the server of URI, in seconds, or
+        None if it could not be reached.'''
+        scheme, hostname, port = parse_host(uri)
+        start = time.time()
+        try:
+            if scheme in ('http', 'https'):
+                request = urllib2.Request(uri)
+                request.get_method = lambda: 'HEAD'
+                try:
+                    urllib2.urlopen(request, timeout=self.timeout).close()
+                except urllib2.HTTPError:
+                    # the server answered, that is all we want to know
+                    pass
+            else:
+                socket.create_connection((hostname, port),
+                                         timeout=self.timeout).close()
+        except (socket.error, urllib2.URLError, EnvironmentError):
+            return None
+        return time.time() - start
+
+    def get_latency(self, uri, nonetwork=False):
+        host = parse_host(uri)
+        if host is None:
+            return 0.0
+        key = self._host_key(host)
+        with self.lock:
+            entry = self.hosts.get(key)
+        if entry and (nonetwork or time.time() < entry['time'] + self.ttl):
+            return entry['latency']
+        if nonetwork:
+            return None
+        latency = self.probe(uri)
+        with self.lock:
+            self.hosts[key] = {'latency': latency, 'time': time.time()}
+        return latency
+
+    def mark_failed(self, uri):
+        host = parse_host(uri)
+        if host is None:
+            return
+        with self.lock:
+            self.hosts[self._host_key(host)] = {'latency': None,
+                                                'time': time.time()}
+            self.orders.clear()
+            self.write_cache()
+
+    def sort_repositories(self, repositories, nonetwork=False):
+        '''Return REPOSITORIES ordered from the fastest to the slowest to
+        reach; unreachable ones come last, in their original order.'''
+        uris = tuple(get_repository_uri(repo) for repo in repositories)
+        if uris not in self.orders:
+            pool = ThreadPool(min(len(uris), self.max_probes))
+            try:
+                latencies = pool.map(
+                        lambda uri: self.get_latency(uri, nonetwork), uris)
+            finally:
+                pool.close()
+                pool.join()
+            with self.lock:
+                self.write_cache()
+            indexes = range(len(uris))
+            healthy = sorted([i for i in indexes if latencies[i] is not None],
+                             key=lambda i: latencies[i])
+            unhealthy = [i for i in indexes if latencies[i] is None]
+            self.orders[uris] = healthy + unhealthy
+        return [repositories[i] for i in self.orders[uris]]
+
+
+_prober = None
+def get_prober(config):
+    global _prober
+    if _prober is None:
+        cachefile = os.path.join(config.xdg_cache_home, 'jhbuild',
+                                 'mirrors.json')
+        _prober = MirrorProber(cachefile, config.mirror_probe_ttl)
+    return _prober
+
+def sort_repositories(config, repositories):
+    '''Order a repository and its mirrors by how fast they answer.'''
+    return get_prober(config).sort_repositories(repositories,
+                                                nonetwork=config.nonetwork)
+
+def mark_failed(config, repository):
+    '''Record that REPOSITORY failed, so that its mirrors get used instead.'''
+    get_prober(config).mark_failed(get_repository_uri(repository))
@@ -19,11 +19,14 @@
 
 import os
 import sys
+import stat
+import shutil
 import time
 import logging
 import errno
 import xml.dom.minidom as DOM
 import json
+from multiprocessing.pool import ThreadPool
 try:
     import hashlib
 except ImportError:
@@ -38,6 +41,36 @@ from StringIO import StringIO
 
 from jhbuild.utils import fileutils
 
+# debug files named after the build-id of binaries, which may be shared by
+# several packages; they are only removed once no package refers to them
+build_id_debug_dir = os.path.join('debug', '.build-id')
+
+def is_shared_file(config, path):
+    path = os.path.join(config.prefix, path)
+    return path.startswith(os.path.join(config.prefix, build_id_debug_dir) + os.sep)
+
+def _check_installed_file(path, checksum):
+    '''Return 'missing' or 'modified' if the file at PATH does not match
+    CHECKSUM, the [size, permissions, digest] recorded when it was installed,
+    or None if it does.  Without CHECKSUM, only its existence is checked.'''
+    try:
+        st = os.lstat(path.rstrip(os.sep))
+    except OSError:
+        return 'missing'
+    if path.endswith(os.sep):
+        return None if stat.S_ISDIR(st.st_mode) else 'modified'
+    if checksum is None:
+        return None
+    size, mode, digest = checksum
+    if st.st_size != size or stat.S_IMODE(st.st_mode) != mode:
+        return 'modified'
+    try:
+        if fileutils.hash_file(path) != digest:
+            return 'modified'
+    except EnvironmentError:
+        return 'modified'
+    return None
+
 def _parse_isotime(string):
     if string[-1] != 'Z':
         return time.mktime(time.strptime(string, '%Y-%m-%dT%H:%M:%S'))
@@ -113,6 +146,21 @@ class PackageEntry:
 
     branch = property(get_branch, set_branch)
 
+    _checksums = None
+    def get_checksums(self):
+        if self._checksums is not None:
+            return self._checksums
+        if not os.path.exists(os.path.join(self.dirname, 'checksums', self.package)):
+            return None
+        with open(os.path.join(self.dirname, 'checksums', self.package), 'r') as f:
+            self._checksums = json.load(f)
+        return self._checksums
+
+    def set_checksums(self, value):
+        self._checksums = value
+
+    checksums = property(get_checksums, set_checksums)
+
     def write(self):
         # write info file
         fileutils.mkdir_with_parents(os.path.join(self.dirname, 'info'))
@@ -133,6 +181,16 @@ class PackageEntry:
         writer.fp.write('\n'.join(self.manifest).encode('utf-8', 'backslashreplace') + '\n')
         writer.commit()
 
+        # write checksums
+        if self.checksums is not None:
+            fileutils.mkdir_with_parents(os.path.join(self.dirname, 'checksums'))
+            writer = fileutils.SafeWriter(os.path.join(self.dirname, 'checksums', self.package))
+            json.dump(self.checksums, writer.fp, sort_keys=True)
+            writer.fp.write('\n')
+            writer.commit()
+        else:
+            fileutils.ensure_unlinked(os.path.join(self.dirname, 'checksums', self.package))
+
         # write sysdeps
         fileutils.mkdir_with_parents(os.path.join(self.dirname, 'sysdeps'))
         writer = fileutils.SafeWriter(os.path.join(self.dirname, 'sysdeps', self.package))
@@ -158,11 +216,16 @@ class PackageEntry:
         # remove branch file
         fileutils.ensure_unlinked(os.path.join(self.dirname, 'branch', self.package))
 
+        # remove checksums
+        fileutils.ensure_unlinked(os.path.join(self.dirname, 'checksums', self.package))
+
     def to_xml(self):
         entry_node = ET.Element('entry', {'package': self.package,
                                           'version': self.version})
         if 'installed-date' in self.metadata:
             entry_node.attrib['installed'] = _format_isotime(self.metadata['installed-date'])
+        if 'outputs-date' in self.metadata:
+            entry_node.attrib['outputs-changed'] = _format_isotime(self.metadata['outputs-date'])
         if 'configure-hash' in self.metadata:
             entry_node.attrib['configure-hash'] = self.metadata['configure-hash']
         if 'module-hash' in self.metadata:
@@ -179,6 +242,9 @@ class PackageEntry:
         installed_string = node.attrib['installed']
         if installed_string:
             metadata['installed-date'] = _parse_isotime(installed_string)
+        outputs_string = node.attrib.get('outputs-changed')
+        if outputs_string:
+            metadata['outputs-date'] = _parse_isotime(outputs_string)
         configure_hash = node.attrib.get('configure-hash')
         if configure_hash:
             metadata['configure-hash'] = configure_hash
@@ -237,14 +303,29 @@ class PackageDB:
         '''Return entry if package is installed, otherwise return None.'''
         return PackageEntry.open(self.dirname, package)
 
-    def add(self, package, version, contents, configure_cmd = None, systemdependencies = None, branch = None, module_hash = None):
-        '''Add a module to the install cache.'''
+    def get_packages(self):
+        '''Return the names of the installed packages.'''
+        try:
+            names = os.listdir(os.path.join(self.dirname, 'info'))
+        except OSError:
+            return []
+        return sorted(name for name in names if not name.endswith('.tmp'))
+
+    def add(self, package, version, contents, configure_cmd = None, systemdependencies = None, branch = None, module_hash = None, checksums = None):
+        '''Add a module to the install cache.
+
+        Returns True if CHECKSUMS show the installed files are identical to
+        those of the previous install.'''
         entry = self.get(package)
         if entry:
             metadata = entry.metadata
         else:
             metadata = {}
         metadata['installed-date'] = time.time() # now
+        unchanged = (entry is not None and checksums is not None and
+                     entry.checksums == checksums)
+        if not unchanged or 'outputs-date' not in metadata:
+            metadata['outputs-date'] = metadata['installed-date']
         if configure_cmd:
             metadata['configure-hash'] = hashlib.md5(configure_cmd).hexdigest()
         if module_hash:
@@ -253,7 +334,9 @@ class PackageDB:
         pkg.manifest = contents
         pkg.systemdependencies = systemdependencies or []
         pkg.branch = branch or {}
+        pkg.checksums = checksums
         pkg.write()
+        return unchanged
 
     def check(self, package, version=None, module_hash=None):
         '''Check whether a particular module is installed.'''
@@ -277,6 +360,21 @@ class PackageDB:
             return None
         return entry.metadata['installed-date']
 
+    def outputsdate(self, package):
+        '''Get the date the installed files of a module last changed.'''
+        entry = self.get(package)
+        if entry is None:
+            return None
+        return entry.metadata.get('outputs-date', entry.metadata['installed-date'])
+
+    def outputs_unchanged(self, package):
+        '''Check whether the last install of a module left its installed
+        files identical.'''
+        entry = self.get(package)
+        if entry is None or 'outputs-date' not in entry.metadata:
+            return False
+        return entry.metadata['outputs-date'] < entry.metadata['installed-date']
+
     def uninstall(self, package_name):
         '''Remove a module from the install cache.'''
         entry = self.get(package_name)
@@ -291,7 +389,9 @@ class PackageDB:
         # Skip files that aren't in the prefix; otherwise we
         # may try to remove the user's ~ or something
         # (presumably we'd fail, but better not to try)
-        to_delete = fileutils.filter_files_by_prefix(self.config, entry.manifest)
+        to_delete = [path for path in
+                     fileutils.filter_files_by_prefix(self.config, entry.manifest)
+                     if not is_shared_file(self.config, path)]
 
         # Don't warn on non-empty directories; we want to allow multiple
         # modules to share the same directory.  We could improve this by
@@ -306,3 +406,220 @@ class PackageDB:
                                                                          'msg': error_string})
 
         entry.remove()
+
+    def verify(self, packages, jobs=1):
+        '''Check the installed files of PACKAGES against their manifests,
+        using JOBS threads.
+
+        Returns a dictionary giving a (missing, modified) tuple of paths for
+        each package with files that are missing or no longer match their
+        checksums.'''
+        prefix = os.path.join(self.config.prefix, '')
+        checks = []
+        for package in packages:
+            entry = self.get(package)
+            if entry is None:
+                continue
+            if entry.manifest is None:
+                logging.error(_("no manifest for '%s', can't verify.") % (package,))
+                continue
+            checksums = entry.checksums or {}
+            for path in fileutils.filter_files_by_prefix(self.config, entry.manifest):
+                checks.append((package, path, checksums.get(path[len(prefix):])))
+        if not checks:
+            return {}
+
+        pool = ThreadPool(min(len(checks), max(1, jobs)))
+        try:
+            results = pool.map(lambda check: _check_installed_file(*check[1:]),
+                               checks)
+        finally:
+            pool.close()
+            pool.join()
+
+        damaged = {}
+        for (package, path, checksum), result in zip(checks, results):
+            if result is None:
+                continue
+            missing, modified = damaged.setdefault(package, ([], []))
+            if result == 'missing':
+                missing.append(path)
+            else:
+                modified.append(path)
+        return damaged
+
+    def find_orphaned_files(self):
+        '''Return the files of the prefix which no installed package
+        refers to, or None if that cannot be known.'''
+        referenced = set()
+        for package in self.get_packages():
+            entry = self.get(package)
+            if entry is None:
+                continue
+            if entry.manifest is None:
+                logging.error(_("no manifest for '%s', can't tell which files are installed.") % (package,))
+                return None
+            referenced.update(fileutils.filter_files_by_prefix(self.config, entry.manifest))
+
+        # the build directory and the package database are not installed
+        skipped = set([self.dirname, self.config.top_builddir])
+        orphaned = []
+        for base, dirnames, filenames in os.walk(self.config.prefix):
+            for dirname in dirnames[:]:
+                path = os.path.join(base, dirname)
+                if path in skipped:
+                    dirnames.remove(dirname)
+                elif os.path.islink(path):
+                    # os.walk() does not enter symbolic links
+                    filenames.append(dirname)
+            for filename in filenames:
+                path = os.path.join(base, filename)
+                if path not in referenced:
+                    orphaned.append(path)
+        return orphaned
+
+    def _get_snapshot_numbers(self, package):
+        try:
+            names = os.listdir(os.path.join(self.dirname, 'snapshots', package))
+        except OSError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def get_snapshots(self, package):
+        '''Return the install snapshots of a package, oldest first, as a
+        list of (directory, entry) tuples.'''
+        snapshots = []
+        for number in self._get_snapshot_numbers(package):
+            snapshotdir = os.path.join(self.dirname, 'snapshots', package, str(number))
+            entry = PackageEntry.open(snapshotdir, package)
+            if entry is not None:
+                snapshots.append((snapshotdir, entry))
+        return snapshots
+
+    def snapshot(self, package, retain):
+        '''Keep the installed files and the entry of a package, so that
+        rollback() can restore them; only the RETAIN most recent snapshots
+        are kept.'''
+        entry = self.get(package)
+        if entry is None or entry.manifest is None:
+            return
+        numbers = self._get_snapshot_numbers(package)
+        snapshotdir = os.path.join(self.dirname, 'snapshots', package,
+                                   str((numbers or [0])[-1] + 1))
+        tmpdir = snapshotdir + '.tmp'
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+
+        # installs replace files rather than modify them, so the snapshot
+        # can share them with the prefix
+        cloner = fileutils.TreeCloner(hardlink=True)
+        prefix = os.path.join(self.config.prefix, '')
+        for path in fileutils.filter_files_by_prefix(self.config, entry.manifest):
+            dest = os.path.join(tmpdir, 'files', path[len(prefix):])
+            if path.endswith(os.sep):
+                fileutils.mkdir_with_parents(dest)
+                continue
+            fileutils.mkdir_with_parents(os.path.dirname(dest))
+            try:
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path), dest)
+                else:
+                    cloner.clone_file(path, dest)
+            except EnvironmentError as e:
+                logging.warn(_("Failed to save %(file)r in snapshot: %(msg)s") % {'file': path,
+                                                                                    'msg': str(e)})
+
+        saved = PackageEntry(package, entry.version, entry.metadata, tmpdir)
+        saved.manifest = entry.manifest
+        saved.systemdependencies = entry.systemdependencies
+        saved.branch = entry.branch
+        saved.checksums = entry.checksums
+        saved.write()
+        os.rename(tmpdir, snapshotdir)
+
+        for olddir, oldentry in self.get_snapshots(package)[:-retain]:
+            shutil.rmtree(olddir)
+
+    def rollback(self, package):
+        '''Restore the installed files and the entry of a package from its
+        most recent snapshot.  Returns the restored entry, or None if there
+        is no snapshot.
+
+        The snapshot is only removed once everything was restored, so that
+        the rollback can be run again if it fails midway.'''
+        snapshots = self.get_snapshots(package)
+        if not snapshots:
+            return None
+        snapshotdir, saved = snapshots[-1]
+
+        prefix = os.path.join(self.config.prefix, '')
+        restored = fileutils.filter_files_by_prefix(self.config, saved.manifest)
+        # as in snapshot(), the prefix may share the files of the snapshot
+        cloner = fileutils.TreeCloner(hardlink=True)
+        for path in restored:
+            if path.endswith(os.sep):
+                fileutils.mkdir_with_parents(path)
+                continue
+            src = os.path.join(snapshotdir, 'files', path[len(prefix):])
+            if not os.path.lexists(src):
+                logging.warn(_("%(file)r is not in the snapshot") % {'file': path})
+                continue
+            fileutils.mkdir_with_parents(os.path.dirname(path))
+            # each file is replaced at once, never left half written
+            tmp = path + '.jhbuild-tmp'
+            fileutils.ensure_unlinked(tmp)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), tmp)
+            else:
+                cloner.clone_file(src, tmp)
+            fileutils.rename(tmp, path)
+
+        # remove the files installed since
+        entry = self.get(package)
+        if entry is not None and entry.manifest is not None:
+            to_delete = [path for path in
+                         fileutils.filter_files_by_prefix(self.config, entry.manifest)
+                         if not is_shared_file(self.config, path)]
+            to_delete = set(to_delete).difference(restored)
+            for (path, was_deleted, error_string) in fileutils.remove_files_and_dirs(to_delete, self.config, allow_nonempty_dirs=True):
+                if was_deleted:
+                    logging.info(_("Deleted: %(file)r") % {'file': path})
+                elif error_string is not None:
+                    logging.warn(_("Failed to delete %(file)r: %(msg)s") % {'file': path,
+                                                                             'msg': error_string})
+
+        # the installed files changed now, modules using them may need to
+        # be built again
+        metadata = saved.metadata
+        metadata['installed-date'] = metadata['outputs-date'] = time.time()
+        pkg = PackageEntry(package, saved.version, metadata, self.dirname)
+        pkg.manifest = saved.manifest
+        pkg.systemdependencies = saved.systemdependencies
+        pkg.branch = saved.branch
+        pkg.checksums = saved.checksums
+        pkg.write()
+        shutil.rmtree(snapshotdir)
+        return pkg
+
+    def find_unreferenced_debug_files(self):
+        '''Return the files of the build-id debug directory which no
+        installed package refers to, or None if that cannot be known.'''
+        referenced = set()
+        for package in self.get_packages():
+            entry = self.get(package)
+            if entry is None:
+                continue
+            if entry.manifest is None:
+                logging.error(_("no manifest for '%s', can't tell which debug files are used.") % (package,))
+                return None
+            referenced.update(fileutils.filter_files_by_prefix(self.config, entry.manifest))
+
+        debugdir = os.path.join(self.config.prefix, build_id_debug_dir)
+        if not os.path.isdir(debugdir):
+            return []
+        unreferenced = []
+        for filename in fileutils.accumulate_dirtree_contents(debugdir):
+            path = os.path.join(debugdir, filename)
+            if path not in referenced:
+                unreferenced.append(path)
+        return unreferenced
@@ -17,22 +17,160 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import collections
+import subprocess
 import tarfile
 import zipfile
 import os.path
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from jhbuild.utils.cmds import has_command
 from jhbuild.errors import CommandError
 from jhbuild.utils import fileutils
 
 
-def unpack_tar_file(localfile, target_directory):
-    pkg = tarfile.open(localfile, 'r|*')
-    pkg.extractall(target_directory)
+# Commands that decompress a file to stdout, by archive extension, in order
+# of preference.  Multi-threaded implementations are listed first.
+_decompressors = {
+    '.gz':   [['pigz', '-dc'], ['gzip', '-dc']],
+    '.bz2':  [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bunzip2', '-dc']],
+    '.xz':   [['xz', '-T0', '-dc'], ['xzcat', '-d']],
+    '.lzma': [['lzcat', '-d']],
+    '.zst':  [['zstd', '-dc']],
+}
+_decompressors['.tgz'] = _decompressors['.gz']
+_decompressors['.tbz2'] = _decompressors['.bz2']
+_decompressors['.txz'] = _decompressors['.xz']
+_decompressors['.tzst'] = _decompressors['.zst']
+
+# upper bound on the amount of file data read from the archive but not yet
+# written to disk by the extraction threads
+_max_pending_size = 64 * 1024 * 1024
+
+
+def get_decompressor(ext):
+    """Return the preferred decompression command for files with extension
+    @ext, as an argument list, or None if no suitable program is installed.
+    """
+    for cmd in _decompressors.get(ext, []):
+        if has_command(cmd[0]):
+            return cmd
+    return None
+
+
+def _write_tar_member(pkg, member, data, path):
+    fp = open(path, 'wb')
+    try:
+        fp.write(data)
+    finally:
+        fp.close()
+    try:
+        pkg.chown(member, path)
+        pkg.chmod(member, path)
+        pkg.utime(member, path)
+    except tarfile.ExtractError:
+        pass
+
+
+def unpack_tar_file(localfile, target_directory, jobs=1, fileobj=None):
+    """
+    Extract the tar archive @localfile (or the uncompressed tar stream
+    @fileobj) to @target_directory.  The archive is read sequentially and the
+    contents of regular files are written by a pool of @jobs threads while
+    the following members are being decoded.
+    """
+    if fileobj is not None:
+        pkg = tarfile.open(fileobj=fileobj, mode='r|')
+    else:
+        pkg = tarfile.open(localfile, 'r|*')
+
+    pool = None
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+    pending = collections.deque()
+    pending_size = 0
+    # the write in progress for each path, so that members are applied in
+    # the order of the archive when they refer to the same path
+    writes = {}
+    directories = []
+
+    def get_key(path):
+        dirname, basename = os.path.split(path)
+        return os.path.join(os.path.realpath(dirname), basename)
+
+    def wait_for(path):
+        result = writes.pop(get_key(path), None)
+        if result is not None:
+            result.get()
+
+    try:
+        for member in pkg:
+            path = os.path.join(target_directory, member.name)
+            if pool is not None:
+                wait_for(path)
+                if member.islnk():
+                    # the target of a hard link must be written already
+                    wait_for(os.path.join(target_directory, member.linkname))
+            if member.isdir():
+                # attributes are set once the whole tree is written, as
+                # the permissions may prevent creating files inside
+                fileutils.mkdir_with_parents(path)
+                directories.append(member)
+            elif pool is None or not member.isreg():
+                pkg.extract(member, target_directory)
+            else:
+                fileutils.mkdir_with_parents(os.path.dirname(path))
+                data = pkg.extractfile(member).read()
+                result = pool.apply_async(_write_tar_member,
+                                          (pkg, member, data, path))
+                writes[get_key(path)] = result
+                pending.append((result, member.size))
+                pending_size += member.size
+                while pending_size > _max_pending_size:
+                    result, size = pending.popleft()
+                    result.get()
+                    pending_size -= size
+        for result, size in pending:
+            result.get()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # deepest directories first, like TarFile.extractall()
+    directories.sort(key=lambda member: member.name, reverse=True)
+    for member in directories:
+        path = os.path.join(target_directory, member.name)
+        try:
+            pkg.chown(member, path)
+            pkg.utime(member, path)
+            pkg.chmod(member, path)
+        except tarfile.ExtractError:
+            pass
     pkg.close()
 
 
+def unpack_tar_pipe(decompressor, localfile, target_directory, jobs=1):
+    """
+    Extract the compressed tar archive @localfile to @target_directory,
+    decompressing it with the @decompressor command in a child process.
+    """
+    proc = subprocess.Popen(decompressor + [localfile],
+                            stdout=subprocess.PIPE, close_fds=True)
+    try:
+        unpack_tar_file(localfile, target_directory, jobs=jobs,
+                        fileobj=proc.stdout)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    # checked once extracted, as raising in the finally clause would hide
+    # why the extraction failed
+    if proc.returncode != 0:
+        raise CommandError(_('Error running %s') % ' '.join(decompressor),
+                           proc.returncode)
+
+
 def unpack_zip_file(localfile, target_directory):
     # Attributes are stored in ZIP files in a host-dependent way.
     # The zipinfo.create_system value describes the host OS.
@@ -119,18 +257,12 @@ def unpack_archive(buildscript, localfile, target_directory, checkoutdir=None):
         final_target_directory = target_directory
         target_directory = tempfile.mkdtemp(dir=final_target_directory)
 
+    jobs = max(1, buildscript.config.jobs)
+
     ext = os.path.splitext(localfile)[-1]
-    if ext == '.lzma' and has_command('lzcat') and has_command('tar'):
-        buildscript.execute('lzcat -d "%s" | tar xf -' % localfile,
-                cwd=target_directory)
-    elif ext == '.xz' and has_command('xzcat') and has_command('tar'):
-        buildscript.execute('xzcat -d "%s" | tar xf -' % localfile,
-                cwd=target_directory)
-    elif ext == '.bz2' and has_command('bunzip2') and has_command('tar'):
-        buildscript.execute('bunzip2 -dc "%s" | tar xf -' % localfile,
-                cwd=target_directory)
-    elif ext in ('.gz', '.tgz') and has_command('gzip') and has_command('tar'):
-        buildscript.execute('gzip -dc "%s" | tar xf -' % localfile,
+    decompressor = get_decompressor(ext)
+    if decompressor and has_command('tar'):
+        buildscript.execute('%s "%s" | tar xf -' % (' '.join(decompressor), localfile),
                 cwd=target_directory)
     elif ext == '.zip' and has_command('unzip'):
         # liuhuan: create a directory with the zip file's basename before unziping it to support zipped files without top level directory
@@ -140,8 +272,10 @@ def unpack_archive(buildscript, localfile, target_directory, checkoutdir=None):
                 cwd=target_directory)
     else:
         try:
-            if tarfile.is_tarfile(localfile):
-                unpack_tar_file(localfile, target_directory)
+            if decompressor:
+                unpack_tar_pipe(decompressor, localfile, target_directory, jobs)
+            elif tarfile.is_tarfile(localfile):
+                unpack_tar_file(localfile, target_directory, jobs)
             elif zipfile.is_zipfile(localfile):
                 unpack_zip_file(localfile, target_directory)
             else:
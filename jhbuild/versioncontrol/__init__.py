@@ -26,8 +26,11 @@ __all__ = [
 
 __metaclass__ = type
 
-from jhbuild.errors import FatalError, BuildStateError
+from jhbuild.errors import FatalError, BuildStateError, CommandError
+from jhbuild.utils import fileutils
 import os
+import shutil
+import logging
 
 class Repository:
     """An abstract class representing a collection of modules."""
@@ -71,6 +74,10 @@ class Repository:
 class Branch:
     """An abstract class representing a branch in a repository."""
 
+    # branches of the other mirrors of the repository, to try in order when
+    # checking out from this one fails
+    fallback_branches = ()
+
     def __init__(self, repository, module, checkoutdir):
         self.repository = repository
         self.config = repository.config
@@ -177,9 +184,15 @@ class Branch:
              module = self.checkoutdir
          fromdir = os.path.join(copydir, os.path.basename(module))
          todir = os.path.join(self.config.checkoutroot, os.path.basename(module))
-         if os.path.exists(todir):
-             self._wipedir(buildscript, self.srcdir)
-         buildscript.execute(['cp', '-R', fromdir, todir])
+         # only copy what changed since the last copy, sharing file data
+         # with the copy_dir checkout where the filesystem allows it
+         try:
+             num_copied = fileutils.TreeCloner().sync_tree(fromdir, todir)
+         except (OSError, IOError, shutil.Error) as e:
+             raise CommandError(_('Failed to copy %(from)s to %(to)s: %(err)s')
+                                % {'from': fromdir, 'to': todir, 'err': e})
+         logging.info(_('Copied %(num)d files from %(from)s') %
+                      {'num': num_copied, 'from': fromdir})
 
     def to_sxml(self):
         """Return an sxml representation of this checkout."""
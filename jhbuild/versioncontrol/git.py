@@ -23,12 +23,15 @@ __metaclass__ = type
 
 import os
 import stat
+import hashlib
 import urlparse
-import subprocess
 import re
 import urllib
 import sys
+import time
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
 from jhbuild.errors import FatalError, CommandError
 from jhbuild.utils.cmds import get_output, check_version
@@ -69,10 +72,159 @@ def get_git_mirror_directory(mirror_root, checkoutdir, module):
     else:
         return mirror_dir + '.git'
 
+# branch heads advertised by remote repositories, keyed by URI
+_remote_refs = {}
+_remote_refs_lock = threading.Lock()
+
+def parse_ls_remote(output):
+    """Return a dictionary of refs to commit ids from 'git ls-remote' output."""
+    refs = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            refs[parts[1]] = parts[0]
+    return refs
+
+def get_remote_refs(uri):
+    """Return the branch heads of the repository at URI, or None if they
+    could not be listed.  The repository is only queried once per process."""
+    with _remote_refs_lock:
+        if uri in _remote_refs:
+            return _remote_refs[uri]
+    try:
+        refs = parse_ls_remote(get_output(['git', 'ls-remote', '--heads', uri],
+                                          get_stderr=False,
+                                          extra_env=get_git_extra_env()))
+    except CommandError:
+        refs = None
+    with _remote_refs_lock:
+        _remote_refs[uri] = refs
+    return refs
+
+def forget_remote_refs(uri):
+    """Drop the branch heads listed for URI, they are listed again when next
+    needed."""
+    with _remote_refs_lock:
+        _remote_refs.pop(uri, None)
+
+def prefetch_remote_refs(branches, jobs=8):
+    """List the branch heads of the remote repositories of all BRANCHES at
+    once, with one 'git ls-remote' per repository."""
+    uris = []
+    for branch in branches:
+        uri = branch.get_remote_refs_uri()
+        if uri and uri not in uris and uri not in _remote_refs:
+            uris.append(uri)
+    if not uris:
+        return
+    pool = ThreadPool(min(len(uris), jobs))
+    try:
+        pool.map(get_remote_refs, uris)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_git_dir(checkoutdir):
+    """Return the git directory of a checkout, following the .git file of
+    worktrees."""
+    dotgit = os.path.join(checkoutdir, '.git')
+    if os.path.isfile(dotgit):
+        content = open(dotgit).read().strip()
+        if content.startswith('gitdir:'):
+            return os.path.join(checkoutdir, content[len('gitdir:'):].strip())
+    return dotgit
+
+# commits of sticky dates, keyed by repository, branch and date
+_sticky_date_commits = {}
+
+def resolve_sticky_date(gitdir, ref, date):
+    """Return the last commit of the first-parent history of REF in the
+    repository at GITDIR that is older than DATE, or None."""
+    key = (gitdir, ref, date)
+    commit = _sticky_date_commits.get(key)
+    if commit:
+        return commit
+    git_extra_args = {'cwd': gitdir, 'get_stderr': False,
+                      'extra_env': get_git_extra_env()}
+    try:
+        commit = get_output(['git', 'rev-list', '-1', '--first-parent',
+                             '--before=%s' % date, ref], **git_extra_args).strip()
+        tip = get_output(['git', 'rev-parse', ref], **git_extra_args).strip()
+    except CommandError:
+        return None
+    if not commit:
+        return None
+    # the answer is final once the repository has commits after the date,
+    # otherwise a later fetch may bring newer ones
+    if commit != tip:
+        _sticky_date_commits[key] = commit
+    return commit
+
+def prefetch_sticky_dates(branches, date, jobs=8):
+    """Resolve the sticky date in the repositories of all BRANCHES at once."""
+    sources = []
+    for branch in branches:
+        source = branch.get_sticky_date_source()
+        if source and source not in sources and os.path.isdir(source[0]):
+            sources.append(source)
+    if not sources:
+        return
+    pool = ThreadPool(min(len(sources), jobs))
+    try:
+        pool.map(lambda source: resolve_sticky_date(source[0], source[1], date),
+                 sources)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class GitUnknownBranchNameError(Exception):
     pass
 
 
+class GitState:
+    """A snapshot of the state of a git checkout.
+
+    It is parsed from the output of 'git status --porcelain=v2 --branch',
+    so that a single git process answers for the current commit and branch,
+    its upstream branch and whether the tree has uncommitted changes.
+    """
+
+    def __init__(self, output=''):
+        self.head = None # commit id, None before the first commit
+        self.branch = None # None on a detached head
+        self.upstream = None
+        self.ahead = None # commits not in upstream, None if unknown
+        self.dirty = False
+        self.dirty_submodules = False
+        for line in output.splitlines():
+            if line.startswith('# branch.oid '):
+                oid = line[len('# branch.oid '):].strip()
+                if oid != '(initial)':
+                    self.head = oid
+            elif line.startswith('# branch.head '):
+                head = line[len('# branch.head '):].strip()
+                if head != '(detached)':
+                    self.branch = head
+            elif line.startswith('# branch.upstream '):
+                self.upstream = line[len('# branch.upstream '):].strip()
+            elif line.startswith('# branch.ab '):
+                ahead = line[len('# branch.ab '):].split()[0]
+                self.ahead = int(ahead.lstrip('+'))
+            elif line[:2] in ('1 ', '2 ', 'u '):
+                # the third field describes submodules, 'N...' otherwise
+                if line.split(' ', 3)[2].startswith('S'):
+                    self.dirty_submodules = True
+                else:
+                    self.dirty = True
+
+    def is_dirty(self, ignore_submodules=True):
+        if ignore_submodules:
+            return self.dirty
+        return self.dirty or self.dirty_submodules
+
+
 class GitRepository(Repository):
     """A class representing a GIT repository.
 
@@ -87,13 +239,21 @@ class GitRepository(Repository):
         # allow user to adjust location of branch.
         self.href = config.repos.get(name, href)
 
-    branch_xml_attrs = ['module', 'subdir', 'checkoutdir', 'revision', 'tag']
+    branch_xml_attrs = ['module', 'subdir', 'checkoutdir', 'revision', 'tag',
+                        'clone-filter', 'sparse']
 
     def branch(self, name, module = None, subdir="", checkoutdir = None,
-               revision = None, tag = None):
+               revision = None, tag = None, clone_filter = None, sparse = None):
         if module is None:
             module = name
 
+        # a partial clone filter set in the configuration for the module
+        # wins over the moduleset, which wins over the global setting
+        if name in self.config.module_git_clone_filter:
+            clone_filter = self.config.module_git_clone_filter[name]
+        elif clone_filter is None:
+            clone_filter = self.config.git_clone_filter
+
         mirror_module = None
         if self.config.dvcs_mirror_dir:
             mirror_module = get_git_mirror_directory(
@@ -136,9 +296,12 @@ class GitRepository(Repository):
 
         if mirror_module:
             return GitBranch(self, mirror_module, subdir, checkoutdir,
-                    revision, tag, unmirrored_module=module, repomodule=repomodule)
+                    revision, tag, unmirrored_module=module, repomodule=repomodule,
+                    clone_filter=clone_filter, sparse=sparse)
         else:
-            return GitBranch(self, module, subdir, checkoutdir, revision, tag, repomodule=repomodule)
+            return GitBranch(self, module, subdir, checkoutdir, revision, tag,
+                    repomodule=repomodule, clone_filter=clone_filter,
+                    sparse=sparse)
 
     def to_sxml(self):
         return [sxml.repository(type='git', name=self.name, href=self.href)]
@@ -152,15 +315,22 @@ class GitBranch(Branch):
 
     dirty_branch_suffix = '-dirty'
     repomodule = None
+    _git_state = None
+
+    clone_filter = None
+    sparse = None
 
     def __init__(self, repository, module, subdir, checkoutdir=None,
-                 branch=None, tag=None, unmirrored_module=None, repomodule=None):
+                 branch=None, tag=None, unmirrored_module=None, repomodule=None,
+                 clone_filter=None, sparse=None):
         Branch.__init__(self, repository, module, checkoutdir)
         self.subdir = subdir
         self.branch = branch
         self.tag = tag
         self.unmirrored_module = unmirrored_module
         self.repomodule = repomodule
+        self.clone_filter = clone_filter or None
+        self.sparse = sparse
 
     def get_module_basename(self):
         # prevent basename() from returning empty strings on trailing '/'
@@ -171,16 +341,43 @@ class GitBranch(Branch):
         return name
  
     def srcdir(self):
-        path_elements = [self.checkoutroot]
-        if self.checkoutdir:
-            path_elements.append(self.checkoutdir)
+        if self.use_worktrees():
+            path_elements = [self.get_checkoutdir()]
         else:
-            path_elements.append(self.get_module_basename())
+            path_elements = [self.checkoutroot]
+            if self.checkoutdir:
+                path_elements.append(self.checkoutdir)
+            else:
+                path_elements.append(self.get_module_basename())
         if self.subdir:
             path_elements.append(self.subdir)
         return os.path.join(*path_elements)
     srcdir = property(srcdir)
 
+    def use_worktrees(self):
+        """Return True if the module is checked out as a worktree of a
+        store shared by all configurations."""
+        return bool(self.config.git_worktree_dir) and self.checkout_mode != 'copy'
+
+    def get_store_dir(self):
+        return os.path.join(self.config.git_worktree_dir,
+                (self.checkoutdir or self.get_module_basename()) + '.git')
+
+    def get_checkoutdir(self):
+        if self.use_worktrees():
+            # one worktree per branch, next to the store
+            return os.path.join(self.config.git_worktree_dir,
+                    self.checkoutdir or self.get_module_basename(),
+                    (self.tag or self.branch or 'master').replace('/', '_'))
+        return Branch.get_checkoutdir(self)
+
+    def get_fetch_dir(self):
+        """Return the git directory whose remote-tracking branches are
+        updated by fetches of the checkout."""
+        if self.use_worktrees():
+            return self.get_store_dir()
+        return os.path.join(self.get_checkoutdir(), '.git')
+
     def branchname(self):
         return self.branch
     branchname = property(branchname)
@@ -203,27 +400,104 @@ class GitBranch(Branch):
             return True
         return self.execute_git_predicate(['git', 'rev-parse', branch])
 
+    def get_git_state(self):
+        """Return a GitState for the checkout.
+
+        The state is only read once and then reused, until jhbuild runs a
+        git command that may change it. Raises CommandError if the checkout
+        directory is not a git repository.
+        """
+        if self._git_state is None:
+            if self.check_version_git('2.11'):
+                output = get_output(['git', 'status', '--porcelain=v2',
+                                     '--branch', '--untracked-files=no'],
+                                    cwd=self.get_checkoutdir(), get_stderr=False,
+                                    extra_env=get_git_extra_env())
+                self._git_state = GitState(output)
+            else:
+                self._git_state = self._get_git_state_legacy()
+        return self._git_state
+
+    def _get_git_state_legacy(self):
+        """Build a GitState with individual commands, for git < 2.11."""
+        if not self.execute_git_predicate(
+                ['git', 'rev-parse', '--is-inside-work-tree']):
+            raise CommandError(_('Not a git repository: %s') % self.get_checkoutdir())
+        git_extra_args = {'cwd': self.get_checkoutdir(), 'get_stderr': False,
+                          'extra_env': get_git_extra_env()}
+        state = GitState()
+        try:
+            state.head = get_output(['git', 'rev-parse', 'HEAD'],
+                                    **git_extra_args).strip()
+        except CommandError:
+            pass
+        try:
+            full_branch = get_output(['git', 'symbolic-ref', '-q', 'HEAD'],
+                                     **git_extra_args).strip()
+            # strip refs/heads/ to get the branch name only
+            state.branch = full_branch.replace('refs/heads/', '')
+        except CommandError:
+            pass
+        if state.branch:
+            try:
+                remote = get_output(['git', 'config', '--get',
+                                     'branch.%s.remote' % state.branch],
+                                    **git_extra_args).strip()
+                merge = get_output(['git', 'config', '--get',
+                                    'branch.%s.merge' % state.branch],
+                                   **git_extra_args).strip()
+                # same as branch.upstream of 'git status --porcelain=v2'
+                merge = merge.replace('refs/heads/', '', 1)
+                if remote == '.':
+                    state.upstream = merge
+                else:
+                    state.upstream = '%s/%s' % (remote, merge)
+            except CommandError:
+                pass
+        state.dirty = not self.execute_git_predicate(
+                ['git', 'diff', '--exit-code', '--quiet', '--ignore-submodules',
+                 'HEAD'])
+        state.dirty_submodules = not self.execute_git_predicate(
+                ['git', 'diff', '--exit-code', '--quiet', 'HEAD'])
+        return state
+
+    def _execute_git(self, buildscript, command, **kwargs):
+        """Execute a git command which may change the state of the checkout."""
+        try:
+            return buildscript.execute(command, **kwargs)
+        finally:
+            self._git_state = None
+            if isinstance(command, list) and (command[1:2] in (['fetch'],
+                    ['pull'], ['push']) or command[1:3] == ['remote', 'update']):
+                # the listed branch heads may be older than what was fetched
+                forget_remote_refs(self.unmirrored_module or self.module)
+
     def is_inside_work_tree(self):
-        return self.execute_git_predicate(
-                ['git', 'rev-parse', '--is-inside-work-tree'])
+        try:
+            self.get_git_state()
+        except CommandError:
+            return False
+        return True
 
     def is_tracking_a_remote_branch(self, local_branch):
         if not local_branch:
             return False
+        try:
+            state = self.get_git_state()
+        except CommandError:
+            state = None
+        if state and state.branch == local_branch:
+            return state.upstream is not None
         current_branch_remote_config = 'branch.%s.remote' % local_branch
         return self.execute_git_predicate(
                 ['git', 'config', '--get', current_branch_remote_config])
 
     def is_dirty(self, ignore_submodules=True):
-        submodule_options = []
-        if ignore_submodules:
-            if not self.check_version_git('1.5.6'):
-                raise CommandError(_('Need at least git-1.5.6 from June/08 '
-                        'to operate'))
-            submodule_options = ['--ignore-submodules']
-        return not self.execute_git_predicate(
-                ['git', 'diff', '--exit-code', '--quiet'] + submodule_options
-                + ['HEAD'])
+        try:
+            state = self.get_git_state()
+        except CommandError:
+            return True
+        return state.is_dirty(ignore_submodules)
 
     def check_version_git(self, version_spec):
         return check_version(['git', '--version'], r'git version ([\d.]+)',
@@ -231,17 +505,11 @@ class GitBranch(Branch):
 
     def get_current_branch(self):
         """Returns either a branchname or None if head is detached"""
-        if not self.is_inside_work_tree():
-            raise CommandError(_('Unexpected: Checkoutdir is not a git '
-                    'repository:' + self.get_checkoutdir()))
         try:
-            full_branch = get_output(['git', 'symbolic-ref', '-q', 'HEAD'],
-                            cwd=self.get_checkoutdir(),
-                            extra_env=get_git_extra_env()).strip()
-            # strip refs/heads/ to get the branch name only
-            return full_branch.replace('refs/heads/', '')
+            return self.get_git_state().branch
         except CommandError:
-            return None
+            raise CommandError(_('Unexpected: Checkoutdir is not a git '
+                    'repository:' + self.get_checkoutdir()))
 
     def find_remote_branch_online_if_necessary(self, buildscript,
             remote_name, branch_name):
@@ -250,7 +518,7 @@ class GitBranch(Branch):
         wanted_ref = remote_name + '/' + branch_name
         if self.execute_git_predicate( ['git', 'show-ref', wanted_ref]):
             return True
-        buildscript.execute(['git', 'fetch'], cwd=self.get_checkoutdir(),
+        self._execute_git(buildscript, ['git', 'fetch'], cwd=self.get_checkoutdir(),
                 extra_env=get_git_extra_env())
         return self.execute_git_predicate( ['git', 'show-ref', wanted_ref])
 
@@ -303,9 +571,9 @@ class GitBranch(Branch):
                 if not is_teamcity:
                     raise CommandError(_('Refusing to switch branch on a dirty tree.'))
                 logging.warning(_('Dirty tree, but TEAMCITY_VERSION is present, so reset hard and switch branch'))
-                buildscript.execute(['git', 'reset', '--hard'], cwd=self.get_checkoutdir(), extra_env=get_git_extra_env())
-                buildscript.execute(['git', 'clean', '-ffxd'], cwd=self.get_checkoutdir(), extra_env=get_git_extra_env())
-            buildscript.execute(switch_command, cwd=self.get_checkoutdir(),
+                self._execute_git(buildscript, ['git', 'reset', '--hard'], cwd=self.get_checkoutdir(), extra_env=get_git_extra_env())
+                self._execute_git(buildscript, ['git', 'clean', '-ffxd'], cwd=self.get_checkoutdir(), extra_env=get_git_extra_env())
+            self._execute_git(buildscript, switch_command, cwd=self.get_checkoutdir(),
                     extra_env=get_git_extra_env())
 
     def has_diverged_from_remote_branch(self, branch):
@@ -313,9 +581,11 @@ class GitBranch(Branch):
             'cwd': self.get_checkoutdir(),
             'extra_env': get_git_extra_env(),
         }
+        state = self.get_git_state()
+        if state.upstream == 'origin/' + branch and state.ahead is not None:
+            return state.ahead > 0
         base = get_output(['git', 'merge-base', 'HEAD', 'origin/' + branch], **git_extra_args).strip()
-        head = get_output(['git', 'rev-parse', 'HEAD'], **git_extra_args).strip()
-        return base != head
+        return base != state.head
 
     def rebase_current_branch(self, buildscript):
         """Pull the current branch if it is tracking a remote branch."""
@@ -344,25 +614,25 @@ class GitBranch(Branch):
 
         if is_teamcity:
             logging.warning(_('Hard reset to remote branch, because TEAMCITY_VERSION is present'))
-            buildscript.execute(['git', 'reset', '--hard', 'origin/' + branch], **git_extra_args)
-            buildscript.execute(['git', 'clean', '-ffxd'], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'reset', '--hard', 'origin/' + branch], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'clean', '-ffxd'], **git_extra_args)
             return
 
         stashed = False
         if self.is_dirty(ignore_submodules=True):
             stashed = True
-            buildscript.execute(['git', 'stash', 'save', 'jhbuild-stash'],
+            self._execute_git(buildscript, ['git', 'stash', 'save', 'jhbuild-stash'],
                     **git_extra_args)
 
-        buildscript.execute(['git', 'rebase', 'origin/' + branch],
+        self._execute_git(buildscript, ['git', 'rebase', 'origin/' + branch],
                             **git_extra_args)
 
         if stashed:
             # git stash pop was introduced in 1.5.5,
             if self.check_version_git('1.5.5'):
-                buildscript.execute(['git', 'stash', 'pop'], **git_extra_args)
+                self._execute_git(buildscript, ['git', 'stash', 'pop'], **git_extra_args)
             else:
-                buildscript.execute(['git', 'stash', 'apply', 'jhbuild-stash'],
+                self._execute_git(buildscript, ['git', 'stash', 'apply', 'jhbuild-stash'],
                         **git_extra_args)
 
     def move_to_sticky_date(self, buildscript):
@@ -370,7 +640,6 @@ class GitBranch(Branch):
             quiet = ['-q']
         else:
             quiet = []
-        commit = self._get_commit_from_date()
         branch = 'jhbuild-date-branch'
         branch_cmd = ['git', 'checkout'] + quiet + [branch]
         git_extra_args = {'cwd': self.get_checkoutdir(),
@@ -378,15 +647,20 @@ class GitBranch(Branch):
         if self.config.sticky_date == 'none':
             current_branch = self.get_current_branch()
             if current_branch and current_branch == branch:
-                buildscript.execute(['git', 'checkout'] + quiet + ['master'],
+                self._execute_git(buildscript, ['git', 'checkout'] + quiet + ['master'],
                         **git_extra_args)
             return
+        commit = self._get_commit_from_date()
+        state = self.get_git_state()
+        if (state.branch == branch and state.head == commit
+                and not state.is_dirty()):
+            return
         try:
-            buildscript.execute(branch_cmd, **git_extra_args)
+            self._execute_git(buildscript, branch_cmd, **git_extra_args)
         except CommandError:
             branch_cmd = ['git', 'checkout'] + quiet + ['-b', branch]
-            buildscript.execute(branch_cmd, **git_extra_args)
-        buildscript.execute(['git', 'reset', '--hard', commit], **git_extra_args)
+            self._execute_git(buildscript, branch_cmd, **git_extra_args)
+        self._execute_git(buildscript, ['git', 'reset', '--hard', commit], **git_extra_args)
 
     def get_remote_branches_list(self):
         return [x.strip() for x in get_output(['git', 'branch', '-r'],
@@ -404,35 +678,245 @@ class GitBranch(Branch):
 
         return True
 
+    def get_sticky_date_source(self):
+        """Return the repository and branch in which the sticky date is
+        looked up: the dvcs mirror when there is one, as it is at least as
+        recent as the checkout, or the checkout."""
+        if self.unmirrored_module and self.config.dvcs_mirror_dir:
+            mirror_dir = get_git_mirror_directory(self.config.dvcs_mirror_dir,
+                    self.checkoutdir, self.unmirrored_module)
+            if os.path.isdir(mirror_dir):
+                return (mirror_dir, 'master')
+        return (self.get_checkoutdir(), 'master')
+
     def _get_commit_from_date(self):
-        cmd = ['git', 'log', '--max-count=1', '--first-parent',
-                '--until=%s' % self.config.sticky_date, 'master']
-        cmd_desc = ' '.join(cmd)
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                cwd=self.get_checkoutdir(),
-                                env=get_git_extra_env())
-        stdout = proc.communicate()[0]
-        if not stdout.strip():
-            raise CommandError(_('Command %s returned no output') % cmd_desc)
-        for line in stdout.splitlines():
-            if line.startswith('commit '):
-                commit = line.split(None, 1)[1].strip()
-                return commit
-        raise CommandError(_('Command %s did not include commit line: %r')
-                           % (cmd_desc, stdout))
+        gitdir, ref = self.get_sticky_date_source()
+        commit = resolve_sticky_date(gitdir, ref, self.config.sticky_date)
+        if not commit:
+            raise CommandError(_('No commit of %(ref)s in %(dir)s before %(date)s')
+                               % {'ref': ref, 'dir': gitdir,
+                                  'date': self.config.sticky_date})
+        return commit
 
     def _export(self, buildscript):
         # FIXME: should implement this properly
         self._checkout(buildscript)
 
+    def _get_submodules_id(self, cwd):
+        """Return an identifier of the submodule commits recorded in the
+        checkout and of their configuration, or None if it is unknown."""
+        try:
+            output = get_output(['git', 'ls-files', '--stage'], cwd=cwd,
+                                get_stderr=False, extra_env=get_git_extra_env())
+            gitmodules = open(os.path.join(cwd, '.gitmodules')).read()
+        except (CommandError, IOError):
+            return None
+        md5sum = hashlib.md5(gitmodules)
+        for line in output.splitlines():
+            # submodules are recorded as gitlinks
+            if line.startswith('160000 '):
+                md5sum.update(line)
+        return md5sum.hexdigest()
+
+    def _get_submodule_urls(self, cwd):
+        try:
+            output = get_output(['git', 'config', '-f', '.gitmodules',
+                                 '--get-regexp', r'^submodule\..*\.url$'],
+                                cwd=cwd, get_stderr=False,
+                                extra_env=get_git_extra_env())
+        except CommandError:
+            return []
+        return [line.split(None, 1)[1] for line in output.splitlines()
+                if len(line.split(None, 1)) == 2]
+
+    def _update_submodule_mirrors(self, buildscript, cwd):
+        """Update dvcs mirrors of the submodules of the checkout, and return
+        git options making the submodules use them."""
+        config_opts = []
+        for url in self._get_submodule_urls(cwd):
+            if url.startswith('.'):
+                # relative to the superproject, which is already mirrored
+                continue
+            mirror_dir = get_git_mirror_directory(self.config.dvcs_mirror_dir,
+                    None, url)
+            if os.path.exists(mirror_dir):
+                if self._get_origin_url(mirror_dir) != url:
+                    # a mirror of another repository with the same name
+                    continue
+                if not self.is_fetch_fresh(mirror_dir):
+                    self._execute_git(buildscript, ['git', 'fetch'],
+                            cwd=mirror_dir, extra_env=get_git_extra_env())
+                    self.record_fetch(mirror_dir)
+            else:
+                self._execute_git(buildscript, ['git', 'clone', '--mirror',
+                        url, mirror_dir], extra_env=get_git_extra_env())
+                self.record_fetch(mirror_dir)
+            config_opts.extend(['-c', 'url.%s.insteadOf=%s' % (mirror_dir, url)])
+        return config_opts
+
     def _update_submodules(self, buildscript):
-        if os.path.exists(os.path.join(self.get_checkoutdir(), '.gitmodules')):
-            cmd = ['git', 'submodule', 'init']
-            buildscript.execute(cmd, cwd=self.get_checkoutdir(),
-                    extra_env=get_git_extra_env())
-            cmd = ['git', 'submodule', 'update']
-            buildscript.execute(cmd, cwd=self.get_checkoutdir(),
-                    extra_env=get_git_extra_env())
+        cwd = self.get_checkoutdir()
+        if not os.path.exists(os.path.join(cwd, '.gitmodules')):
+            return
+
+        # skip the update when the recorded submodule commits did not change
+        # since the last one, and the submodules are still checked out there
+        stampfile = os.path.join(get_git_dir(cwd), 'jhbuild-submodules')
+        submodules_id = self._get_submodules_id(cwd)
+        try:
+            dirty = self.get_git_state().dirty_submodules
+        except CommandError:
+            dirty = True
+        if submodules_id and not dirty:
+            try:
+                if open(stampfile).read().strip() == submodules_id:
+                    logging.info(_('submodules of %s did not change')
+                                 % self.get_module_basename())
+                    return
+            except IOError:
+                pass
+
+        config_opts = []
+        if self.config.dvcs_mirror_dir and not self.config.nonetwork:
+            config_opts = self._update_submodule_mirrors(buildscript, cwd)
+        cmd = ['git'] + config_opts + ['submodule', 'update', '--init']
+        jobs = max(1, self.config.jobs)
+        if jobs > 1 and self.check_version_git('2.9'):
+            cmd.extend(['--jobs', str(jobs)])
+        self._execute_git(buildscript, cmd, cwd=cwd,
+                extra_env=get_git_extra_env())
+
+        if submodules_id:
+            try:
+                open(stampfile, 'w').write(submodules_id + '\n')
+            except IOError:
+                pass
+
+    def get_remote_refs_uri(self):
+        """Return the URI of the upstream repository whose branch heads tell
+        whether the module changed, or None if it cannot be queried."""
+        if self.config.nonetwork:
+            return None
+        if self.config.sticky_date:
+            # checkouts at a sticky date are always updated, see
+            # is_unchanged_upstream()
+            return None
+        if self.unmirrored_module:
+            gitdir = get_git_mirror_directory(self.config.dvcs_mirror_dir,
+                    self.checkoutdir, self.unmirrored_module)
+        else:
+            gitdir = self.get_fetch_dir()
+        if self.is_fetch_fresh(gitdir):
+            return None
+        return self.unmirrored_module or self.module
+
+    def is_fetch_fresh(self, gitdir):
+        """Return True if the repository in GITDIR was successfully fetched
+        less than fetch_max_age seconds ago."""
+        if self.config.force_update or not self.config.fetch_max_age:
+            return False
+        try:
+            mtime = os.stat(os.path.join(gitdir, 'jhbuild-last-fetch')).st_mtime
+        except OSError:
+            return False
+        return time.time() - mtime < self.config.fetch_max_age
+
+    def record_fetch(self, gitdir):
+        """Record that the repository in GITDIR was just fetched."""
+        if not os.path.isdir(gitdir):
+            return
+        try:
+            open(os.path.join(gitdir, 'jhbuild-last-fetch'), 'w').close()
+        except IOError:
+            pass
+
+    def _get_origin_url(self, cwd):
+        try:
+            return get_output(['git', 'config', '--get', 'remote.origin.url'],
+                              cwd=cwd, get_stderr=False,
+                              extra_env=get_git_extra_env()).strip()
+        except CommandError:
+            return None
+
+    def get_upstream_commit(self):
+        """Return the commit of the wanted branch in the upstream repository,
+        or None if it is unknown."""
+        if self.tag:
+            return None
+        uri = self.get_remote_refs_uri()
+        if not uri:
+            return None
+        refs = get_remote_refs(uri)
+        if not refs:
+            return None
+        return refs.get('refs/heads/' + (self.branch or 'master'))
+
+    def _get_local_ref(self, ref, cwd):
+        try:
+            return get_output(['git', 'for-each-ref', '--format=%(objectname)',
+                               ref], cwd=cwd, get_stderr=False,
+                              extra_env=get_git_extra_env()).strip() or None
+        except CommandError:
+            return None
+
+    def is_unchanged_upstream(self):
+        """Return True if the checkout is already on the upstream commit of
+        the wanted branch, so that fetching and rebasing can be skipped."""
+        if self.config.sticky_date:
+            return False
+        commit = self.get_upstream_commit()
+        if commit is None:
+            return False
+        try:
+            state = self.get_git_state()
+        except CommandError:
+            return False
+        if (state.branch != (self.branch or 'master') or state.head != commit
+                or state.is_dirty()):
+            return False
+        if self._get_origin_url(self.get_checkoutdir()) != self.module:
+            return False
+        return self._get_local_ref('refs/remotes/origin/' + state.branch,
+                                   self.get_checkoutdir()) == commit
+
+    def get_clone_filter(self):
+        """Return the object filter for partial clones of the module, such as
+        'blob:none', or None for complete clones."""
+        if not self.clone_filter:
+            return None
+        if not self.check_version_git('2.19'):
+            logging.warning(_('git 2.19 is required for partial clones, '
+                              'cloning %s completely') % self.get_module_basename())
+            return None
+        return self.clone_filter
+
+    def get_sparse_patterns(self):
+        """Return the directories of the sparse checkout of the module, or an
+        empty list for a complete checkout."""
+        if not self.sparse:
+            return []
+        patterns = self.sparse.replace(',', ' ').split()
+        if self.subdir and self.subdir not in patterns:
+            patterns.append(self.subdir)
+        if not self.check_version_git('2.25'):
+            logging.warning(_('git 2.25 is required for sparse checkouts, '
+                              'checking out %s completely') % self.get_module_basename())
+            return []
+        return patterns
+
+    def update_sparse_checkout(self, buildscript, cwd):
+        patterns = self.get_sparse_patterns()
+        if not patterns:
+            return
+        try:
+            current = get_output(['git', 'sparse-checkout', 'list'], cwd=cwd,
+                                 get_stderr=False,
+                                 extra_env=get_git_extra_env()).split()
+        except CommandError:
+            current = []
+        if sorted(current) != sorted(patterns):
+            self._execute_git(buildscript, ['git', 'sparse-checkout', 'set',
+                    '--cone'] + patterns, cwd=cwd, extra_env=get_git_extra_env())
 
     def update_dvcs_mirror(self, buildscript):
         if not self.config.dvcs_mirror_dir:
@@ -445,15 +929,31 @@ class GitBranch(Branch):
                 self.checkoutdir, self.unmirrored_module)
 
         if os.path.exists(mirror_dir):
-            buildscript.execute(['git', 'remote', 'set-url', 'origin',
+            if (self._get_origin_url(mirror_dir) == self.unmirrored_module
+                    and self.is_fetch_fresh(mirror_dir)):
+                logging.info(_('mirror of %s was fetched recently')
+                             % self.unmirrored_module)
+                return
+            self._execute_git(buildscript, ['git', 'remote', 'set-url', 'origin',
                     self.unmirrored_module], cwd=mirror_dir,
                     extra_env=get_git_extra_env())
-            buildscript.execute(['git', 'fetch'], cwd=mirror_dir,
-                    extra_env=get_git_extra_env())
+            commit = self.get_upstream_commit()
+            if commit and self._get_local_ref(
+                    'refs/heads/' + (self.branch or 'master'), mirror_dir) == commit:
+                logging.info(_('mirror of %s is up to date') % self.unmirrored_module)
+            else:
+                self._execute_git(buildscript, ['git', 'fetch'], cwd=mirror_dir,
+                        extra_env=get_git_extra_env())
         else:
-            buildscript.execute(
-                    ['git', 'clone', '--mirror', self.unmirrored_module,
-                    mirror_dir], extra_env=get_git_extra_env())
+            extra_opts = []
+            clone_filter = self.get_clone_filter()
+            if clone_filter:
+                extra_opts.append('--filter=' + clone_filter)
+            self._execute_git(buildscript,
+                    ['git', 'clone', '--mirror'] + extra_opts +
+                    [self.unmirrored_module, mirror_dir],
+                    extra_env=get_git_extra_env())
+        self.record_fetch(mirror_dir)
 
     def _checkout(self, buildscript, copydir=None):
 
@@ -466,21 +966,110 @@ class GitBranch(Branch):
 
         self.update_dvcs_mirror(buildscript)
 
-        cmd = ['git', 'clone'] + extra_opts + [self.module]
-        if self.checkoutdir:
-            cmd.append(self.checkoutdir)
+        source = self.module
+        clone_filter = self.get_clone_filter()
+        sparse_patterns = self.get_sparse_patterns()
+        if sparse_patterns:
+            extra_opts.append('--sparse')
+        if clone_filter:
+            extra_opts.append('--filter=' + clone_filter)
+            if self.unmirrored_module and os.path.isdir(self.module):
+                # filters are ignored when cloning a local path directly
+                self._execute_git(buildscript, ['git', 'config',
+                        'uploadpack.allowFilter', 'true'], cwd=self.module,
+                        extra_env=get_git_extra_env())
+                source = 'file://' + self.module
+        elif (self.unmirrored_module and self.config.dvcs_mirror_alternates
+                and os.path.isdir(self.module)):
+            # borrow the objects of the mirror instead of copying them; the
+            # mirror must then never prune objects the checkout may use
+            self._execute_git(buildscript, ['git', 'config', 'gc.pruneExpire',
+                    'never'], cwd=self.module, extra_env=get_git_extra_env())
+            extra_opts.append('--shared')
+
+        if self.use_worktrees():
+            clonedir = self.get_store_dir()
+            if not os.path.exists(clonedir):
+                extra_opts = [x for x in extra_opts if x != '--sparse']
+                self._execute_git(buildscript, ['git', 'clone', '--bare'] +
+                        extra_opts + [source, clonedir],
+                        extra_env=get_git_extra_env())
+                # bare clones have no remote-tracking branches
+                self._execute_git(buildscript, ['git', 'config',
+                        'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'],
+                        cwd=clonedir, extra_env=get_git_extra_env())
+                self._execute_git(buildscript, ['git', 'fetch', 'origin'],
+                        cwd=clonedir, extra_env=get_git_extra_env())
+            else:
+                source = self.module
+                if not self.is_fetch_fresh(clonedir):
+                    self._execute_git(buildscript, ['git', 'fetch', 'origin'],
+                            cwd=clonedir, extra_env=get_git_extra_env())
+            self.record_fetch(clonedir)
+        else:
+            cmd = ['git', 'clone'] + extra_opts + [source]
+            if self.checkoutdir:
+                cmd.append(self.checkoutdir)
 
-        if self.branch is not None:
-            cmd.extend(['-b', self.branch])
+            if self.branch is not None:
+                cmd.extend(['-b', self.branch])
 
-        if copydir:
-            buildscript.execute(cmd, cwd=copydir, extra_env=get_git_extra_env())
-        else:
-            buildscript.execute(cmd, cwd=self.config.checkoutroot,
-                    extra_env=get_git_extra_env())
+            if copydir:
+                self._execute_git(buildscript, cmd, cwd=copydir, extra_env=get_git_extra_env())
+            else:
+                self._execute_git(buildscript, cmd, cwd=self.config.checkoutroot,
+                        extra_env=get_git_extra_env())
+            clonedir = self.get_checkoutdir()
+
+        if source != self.module:
+            # have the checkout use the mirror path, as _update expects,
+            # and fetch objects missing from the partial mirror upstream
+            git_extra_args = {'cwd': clonedir,
+                    'extra_env': get_git_extra_env()}
+            self._execute_git(buildscript, ['git', 'remote', 'set-url',
+                    'origin', self.module], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'remote', 'add', 'upstream',
+                    self.unmirrored_module], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'config',
+                    'remote.upstream.promisor', 'true'], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'config',
+                    'remote.upstream.partialclonefilter', clone_filter],
+                    **git_extra_args)
+
+        if self.use_worktrees():
+            self._add_worktree(buildscript)
 
         self._update(buildscript, copydir=copydir, update_mirror=False)
 
+    def _add_worktree(self, buildscript):
+        store = self.get_store_dir()
+        git_extra_args = {'cwd': store, 'extra_env': get_git_extra_env()}
+        # forget worktrees whose directory was wiped
+        self._execute_git(buildscript, ['git', 'worktree', 'prune'],
+                **git_extra_args)
+        checkoutdir = self.get_checkoutdir()
+        if self.tag:
+            cmd = ['git', 'worktree', 'add', '--detach', checkoutdir, self.tag]
+        else:
+            branch = self.branch or 'master'
+            try:
+                get_output(['git', 'show-ref', '--quiet', '--verify',
+                            'refs/heads/' + branch], **git_extra_args)
+            except CommandError:
+                cmd = ['git', 'worktree', 'add', '--track', '-b', branch,
+                       checkoutdir, 'origin/' + branch]
+            else:
+                cmd = ['git', 'worktree', 'add', checkoutdir, branch]
+                # branches copied by the bare clone do not track origin
+                try:
+                    get_output(['git', 'config', '--get',
+                                'branch.%s.remote' % branch], **git_extra_args)
+                except CommandError:
+                    self._execute_git(buildscript, ['git', 'branch',
+                            '--set-upstream-to=origin/' + branch, branch],
+                            **git_extra_args)
+        self._execute_git(buildscript, cmd, **git_extra_args)
+
 
     def _update(self, buildscript, copydir=None, update_mirror=True):
         cwd = self.get_checkoutdir()
@@ -491,14 +1080,34 @@ class GitBranch(Branch):
                 raise CommandError(_('Failed to update module as it switched to git (you should check for changes then remove the directory).'))
             raise CommandError(_('Failed to update module (missing .git) (you should check for changes then remove the directory).'))
 
+        gitdir = self.get_fetch_dir()
+        if self.is_unchanged_upstream():
+            logging.info(_('%s has not changed upstream, skipping update')
+                         % self.get_module_basename())
+            self.record_fetch(gitdir)
+            if is_teamcity:
+                # still reset and clean the tree
+                self.rebase_current_branch(buildscript)
+            self.update_sparse_checkout(buildscript, cwd)
+            self._update_submodules(buildscript)
+            return
+
         if update_mirror:
             self.update_dvcs_mirror(buildscript)
 
-        buildscript.execute(['git', 'remote', 'set-url', 'origin',
-                self.module], **git_extra_args)
+        # fetches from a dvcs mirror are local, only the mirror itself
+        # is kept from being fetched too often
+        if (not self.unmirrored_module and self._get_origin_url(cwd) == self.module
+                and self.is_fetch_fresh(gitdir)):
+            logging.info(_('%s was fetched recently, not fetching again')
+                         % self.get_module_basename())
+        else:
+            self._execute_git(buildscript, ['git', 'remote', 'set-url', 'origin',
+                    self.module], **git_extra_args)
 
-        buildscript.execute(['git', 'remote', 'update', 'origin'],
-                **git_extra_args)
+            self._execute_git(buildscript, ['git', 'remote', 'update', 'origin'],
+                    **git_extra_args)
+            self.record_fetch(gitdir)
 
         if self.config.sticky_date:
             self.move_to_sticky_date(buildscript)
@@ -507,8 +1116,27 @@ class GitBranch(Branch):
 
         self.rebase_current_branch(buildscript)
 
+        self.update_sparse_checkout(buildscript, cwd)
+
         self._update_submodules(buildscript)
 
+    def get_alternates_file(self):
+        # worktrees share the objects of their store
+        return os.path.join(self.get_fetch_dir(), 'objects', 'info',
+                            'alternates')
+
+    def dissociate(self, buildscript):
+        """Copy the objects borrowed from the dvcs mirror into the checkout,
+        so that it no longer depends on the mirror.  Returns False if the
+        checkout did not borrow objects."""
+        alternates = self.get_alternates_file()
+        if not os.path.exists(alternates):
+            return False
+        self._execute_git(buildscript, ['git', 'repack', '-a', '-d', '-q'],
+                cwd=self.get_fetch_dir(), extra_env=get_git_extra_env())
+        os.remove(alternates)
+        return True
+
     def may_checkout(self, buildscript):
         if buildscript.config.nonetwork and not buildscript.config.dvcs_mirror_dir:
             return False
@@ -521,23 +1149,23 @@ class GitBranch(Branch):
 
     def delete_unknown_files(self, buildscript):
         git_extra_args = {'cwd': self.get_checkoutdir(), 'extra_env': get_git_extra_env()}
-        buildscript.execute(['git', 'clean', '-d', '-f', '-x'], **git_extra_args)
+        self._execute_git(buildscript, ['git', 'clean', '-d', '-f', '-x'], **git_extra_args)
 
     def tree_id(self):
         if not os.path.exists(self.get_checkoutdir()):
             return None
         try:
-            output = get_output(['git', 'rev-parse', 'HEAD'],
-                    cwd = self.get_checkoutdir(), get_stderr=False,
-                    extra_env=get_git_extra_env())
+            state = self.get_git_state()
         except CommandError:
             return None
         except GitUnknownBranchNameError:
             return None
+        if state.head is None:
+            return None
         id_suffix = ''
-        if self.is_dirty():
+        if state.is_dirty():
             id_suffix = self.dirty_branch_suffix
-        return output.strip() + id_suffix
+        return state.head + id_suffix
 
     def to_sxml(self):
         attrs = {}
@@ -547,6 +1175,10 @@ class GitBranch(Branch):
             attrs['checkoutdir'] = self.checkoutdir
         if self.subdir:
             attrs['subdir'] = self.subdir
+        if self.clone_filter:
+            attrs['clone-filter'] = self.clone_filter
+        if self.sparse:
+            attrs['sparse'] = self.sparse
         return [sxml.branch(repo=self.repository.name,
                             module=self.module,
                             tag=self.tree_id(),
@@ -558,6 +1190,15 @@ class GitSvnBranch(GitBranch):
         GitBranch.__init__(self, repository, module, "", checkoutdir, branch="git-svn")
         self.revision = revision
 
+    def use_worktrees(self):
+        return False
+
+    def get_remote_refs_uri(self):
+        return None
+
+    def get_sticky_date_source(self):
+        return None
+
     def may_checkout(self, buildscript):
         return Branch.may_checkout(self, buildscript)
 
@@ -641,10 +1282,10 @@ class GitSvnBranch(GitBranch):
             raise FatalError(_('Cannot get last revision from %s. Check the module location.') % self.module)
 
         if copydir:
-            buildscript.execute(cmd, cwd=copydir,
+            self._execute_git(buildscript, cmd, cwd=copydir,
                     extra_env=get_git_extra_env())
         else:
-            buildscript.execute(cmd, cwd=self.config.checkoutroot,
+            self._execute_git(buildscript, cmd, cwd=self.config.checkoutroot,
                     extra_env=get_git_extra_env())
 
         try:
@@ -656,7 +1297,7 @@ class GitSvnBranch(GitBranch):
                         self.get_checkoutdir(copydir), '.git/info/exclude'), 'a')
             fd.write(s)
             fd.close()
-            buildscript.execute(cmd, cwd=self.get_checkoutdir(copydir),
+            self._execute_git(buildscript, cmd, cwd=self.get_checkoutdir(copydir),
                     extra_env=get_git_extra_env())
         except:
             pass
@@ -683,15 +1324,15 @@ class GitSvnBranch(GitBranch):
         if get_output(['git', 'diff'], **git_extra_args):
             # stash uncommitted changes on the current branch
             stashed = True
-            buildscript.execute(['git', 'stash', 'save', 'jhbuild-stash'],
+            self._execute_git(buildscript, ['git', 'stash', 'save', 'jhbuild-stash'],
                     **git_extra_args)
 
-        buildscript.execute(['git', 'checkout'] + quiet + ['master'],
+        self._execute_git(buildscript, ['git', 'checkout'] + quiet + ['master'],
                 **git_extra_args)
-        buildscript.execute(['git', 'svn', 'rebase'], **git_extra_args)
+        self._execute_git(buildscript, ['git', 'svn', 'rebase'], **git_extra_args)
 
         if stashed:
-            buildscript.execute(['git', 'stash', 'pop'], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'stash', 'pop'], **git_extra_args)
 
         current_revision = get_output(['git', 'svn', 'find-rev', 'HEAD'],
                 **git_extra_args)
@@ -700,7 +1341,7 @@ class GitSvnBranch(GitBranch):
             try:
                 # is known to fail on some versions
                 cmd = "git svn show-ignore >> .git/info/exclude"
-                buildscript.execute(cmd, **git_extra_args)
+                self._execute_git(buildscript, cmd, **git_extra_args)
             except:
                 pass
 
@@ -712,6 +1353,15 @@ class GitCvsBranch(GitBranch):
         GitBranch.__init__(self, repository, module, "", checkoutdir)
         self.revision = revision
 
+    def use_worktrees(self):
+        return False
+
+    def get_remote_refs_uri(self):
+        return None
+
+    def get_sticky_date_source(self):
+        return None
+
     def may_checkout(self, buildscript):
         return Branch.may_checkout(self, buildscript)
 
@@ -735,9 +1385,9 @@ class GitCvsBranch(GitBranch):
         cmd.append(self.module)
 
         if copydir:
-            buildscript.execute(cmd, cwd=copydir, extra_env=get_git_extra_env())
+            self._execute_git(buildscript, cmd, cwd=copydir, extra_env=get_git_extra_env())
         else:
-            buildscript.execute(cmd, cwd=self.config.checkoutroot,
+            self._execute_git(buildscript, cmd, cwd=self.config.checkoutroot,
                     extra_env=get_git_extra_env())
 
     def _update(self, buildscript, copydir=None):
@@ -752,12 +1402,12 @@ class GitCvsBranch(GitBranch):
         if get_output(['git', 'diff'], **git_extra_args):
             # stash uncommitted changes on the current branch
             stashed = True
-            buildscript.execute(['git', 'stash', 'save', 'jhbuild-stash'],
+            self._execute_git(buildscript, ['git', 'stash', 'save', 'jhbuild-stash'],
                     **git_extra_args)
 
         self._checkout(buildscript, copydir=copydir)
 
         if stashed:
-            buildscript.execute(['git', 'stash', 'pop'], **git_extra_args)
+            self._execute_git(buildscript, ['git', 'stash', 'pop'], **git_extra_args)
 
 register_repo_type('git', GitRepository)
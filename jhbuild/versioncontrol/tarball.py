@@ -21,6 +21,7 @@ __all__ = []
 __metaclass__ = type
 
 import os
+import shutil
 try:
     import hashlib
 except ImportError:
@@ -28,6 +29,7 @@ except ImportError:
 import urlparse
 import urllib2
 import logging
+from multiprocessing.pool import ThreadPool
 
 from jhbuild.errors import FatalError, CommandError, BuildStateError
 from jhbuild.versioncontrol import Repository, Branch, register_repo_type
@@ -35,9 +37,47 @@ from jhbuild.utils.cmds import has_command, get_output
 from jhbuild.modtypes import get_branch
 from jhbuild.utils.unpack import unpack_archive
 from jhbuild.utils import httpcache
+from jhbuild.utils import fileutils
 from jhbuild.utils.sxml import sxml
 
 
+# local file names of the patches already located, by (moduleset_uri, patch)
+_patch_locations = {}
+
+# maximum number of patches fetched at the same time
+_max_patch_downloads = 8
+
+def _patch_set_hash(patchfiles):
+    """Return a hash identifying the names, strip levels and contents of
+    a list of (patch, patchstrip, patchfile) tuples."""
+    md5sum = hashlib.md5()
+    for patch, patchstrip, patchfile in patchfiles:
+        md5sum.update('%s\0%d\0' % (patch, patchstrip))
+        fp = open(patchfile, 'rb')
+        md5sum.update(fp.read())
+        fp.close()
+    return md5sum.hexdigest()
+
+def _get_patch_fuzz(patchfile, patchstrip, cwd):
+    """Return the lines of a dry run of @patchfile in @cwd reporting hunks
+    that would be applied with fuzz, prefixed with the name of the patched
+    file."""
+    try:
+        output = get_output(['patch', '--dry-run', '-p%d' % patchstrip,
+                             '-i', patchfile], cwd=cwd)
+    except CommandError:
+        # applying the patch reports the failure
+        return []
+    fuzz = []
+    patched_file = None
+    for line in output.splitlines():
+        if line.startswith('checking file ') or line.startswith('patching file '):
+            patched_file = line.split(' ', 2)[2].strip()
+        elif ' with fuzz ' in line:
+            fuzz.append('%s: %s' % (patched_file, line.strip()))
+    return fuzz
+
+
 class TarballRepository(Repository):
     """A class representing a Tarball repository.
 
@@ -150,8 +190,14 @@ class TarballBranch(Branch):
             localdir = localdir[:-9]
         elif localdir.endswith('.tar.xz'):
             localdir = localdir[:-7]
+        elif localdir.endswith('.tar.zst'):
+            localdir = localdir[:-8]
         elif localdir.endswith('.tgz'):
             localdir = localdir[:-4]
+        elif localdir.endswith('.txz'):
+            localdir = localdir[:-4]
+        elif localdir.endswith('.tzst'):
+            localdir = localdir[:-5]
         elif localdir.endswith('.zip'):
             localdir = localdir[:-4]
         if localdir.endswith('.src'):
@@ -169,6 +215,19 @@ class TarballBranch(Branch):
         return self.version
     branchname = property(branchname)
 
+    def get_pristine_cache_dir(self, patchfiles):
+        """Return the directory holding the sources extracted and patched
+        with @patchfiles, or None if they can't be cached."""
+        if not self.config.pristine_cache_dir or self.quilt:
+            return None
+        # a tarball rolled again under the same version has another hash,
+        # or at least is usually published at another URL
+        md5sum = hashlib.md5(self.source_hash or self.module)
+        md5sum.update(_patch_set_hash(patchfiles))
+        return os.path.join(self.config.pristine_cache_dir,
+                            os.path.basename(self.raw_srcdir),
+                            '%s-%s' % (self.version, md5sum.hexdigest()))
+
     def _check_tarball(self):
         """Check whether the tarball has been downloaded correctly."""
         localfile = self._local_tarball
@@ -225,7 +284,7 @@ class TarballBranch(Branch):
                 os.remove(localfile)
             raise
 
-    def _download_and_unpack(self, buildscript):
+    def _download_and_unpack(self, buildscript, patchfiles):
         localfile = self._local_tarball
         if not os.path.exists(self.config.tarballdir):
             try:
@@ -250,59 +309,137 @@ class TarballBranch(Branch):
             raise BuildStateError(_('could not unpack tarball (expected %s dir)'
                         ) % os.path.basename(self.srcdir))
 
-        if self.patches:
-            self._do_patches(buildscript)
-
-    def _do_patches(self, buildscript):
-        # now patch the working tree
-        for (patch, patchstrip) in self.patches:
-            patchfile = ''
-            if urlparse.urlparse(patch)[0]:
-                # patch name has scheme, get patch from network
+        cachedir = self.get_pristine_cache_dir(patchfiles)
+        fuzz = []
+        if patchfiles:
+            fuzz = self._do_patches(buildscript, patchfiles,
+                                    record_fuzz=cachedir is not None)
+
+        self._store_in_pristine_cache(cachedir, fuzz)
+
+    def _checkout_from_pristine_cache(self, buildscript, cachedir):
+        if not cachedir or not os.path.isdir(cachedir):
+            return False
+        if os.path.exists(self.raw_srcdir):
+            return False
+        logging.info(_('Using pristine sources from %s') % cachedir)
+        cloner = fileutils.TreeCloner(hardlink=self.config.pristine_cache_hardlinks)
+        try:
+            cloner.clone_tree(cachedir, self.raw_srcdir)
+        except (OSError, IOError) as e:
+            logging.warning(_('could not copy pristine sources (%s)') % e)
+            self._wipedir(buildscript, self.raw_srcdir)
+            return False
+        # the patches are not applied again, repeat what they reported
+        if os.path.exists(cachedir + '.fuzz'):
+            for line in open(cachedir + '.fuzz'):
+                logging.warning(_('Patch applied with fuzz: %s') % line.strip())
+        return True
+
+    def _store_in_pristine_cache(self, cachedir, fuzz):
+        if not cachedir or os.path.exists(cachedir):
+            return
+        # the cached copy must not share inodes with the working tree,
+        # which gets modified by the build
+        tmpdir = '%s.tmp-%d' % (cachedir, os.getpid())
+        try:
+            fileutils.mkdir_with_parents(os.path.dirname(cachedir))
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+            fileutils.TreeCloner().clone_tree(self.raw_srcdir, tmpdir)
+            if fuzz:
+                writer = fileutils.SafeWriter(cachedir + '.fuzz')
+                writer.fp.write(''.join(line + '\n' for line in fuzz))
+                writer.commit()
+            else:
+                fileutils.ensure_unlinked(cachedir + '.fuzz')
+            fileutils.rename(tmpdir, cachedir)
+        except (OSError, IOError) as e:
+            logging.warning(_('could not store pristine sources (%s)') % e)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _find_patch(self, buildscript, patch):
+        """Return the local file name of @patch, downloading it if needed."""
+        key = (self.repository.moduleset_uri, patch)
+        if key in _patch_locations:
+            return _patch_locations[key]
+
+        patchfile = ''
+        if urlparse.urlparse(patch)[0]:
+            # patch name has scheme, get patch from network
+            try:
+                patchfile = httpcache.load(patch, nonetwork=buildscript.config.nonetwork)
+            except urllib2.HTTPError as e:
+                raise BuildStateError(_('could not download patch (error: %s)') % e.code)
+            except urllib2.URLError as e:
+                raise BuildStateError(_('could not download patch'))
+        elif self.repository.moduleset_uri:
+            # get it relative to the moduleset uri, either in the same
+            # directory or a patches/ subdirectory
+            for patch_prefix in ('.', 'patches', '../patches'):
+                uri = urlparse.urljoin(self.repository.moduleset_uri,
+                        os.path.join(patch_prefix, patch))
                 try:
-                    patchfile = httpcache.load(patch, nonetwork=buildscript.config.nonetwork)
-                except urllib2.HTTPError as e:
-                    raise BuildStateError(_('could not download patch (error: %s)') % e.code)
-                except urllib2.URLError as e:
-                    raise BuildStateError(_('could not download patch'))
-            elif self.repository.moduleset_uri:
-                # get it relative to the moduleset uri, either in the same
-                # directory or a patches/ subdirectory
-                for patch_prefix in ('.', 'patches', '../patches'):
-                    uri = urlparse.urljoin(self.repository.moduleset_uri,
-                            os.path.join(patch_prefix, patch))
-                    try:
-                        patchfile = httpcache.load(uri, nonetwork=buildscript.config.nonetwork)
-                    except Exception as e:
-                        continue
-                    if not os.path.isfile(patchfile):
-                        continue
+                    patchfile = httpcache.load(uri, nonetwork=buildscript.config.nonetwork)
+                except Exception as e:
+                    continue
+                if not os.path.isfile(patchfile):
+                    continue
+                break
+            else:
+                patchfile = ''
+
+        if not patchfile:
+            # nothing else, use jhbuild provided patches
+            possible_locations = []
+            if self.config.modulesets_dir:
+                possible_locations.append(os.path.join(self.config.modulesets_dir, 'patches'))
+                possible_locations.append(os.path.join(self.config.modulesets_dir, '../patches'))
+            if PKGDATADIR:
+                possible_locations.append(os.path.join(PKGDATADIR, 'patches'))
+            if SRCDIR:
+                possible_locations.append(os.path.join(SRCDIR, 'patches'))
+            for dirname in possible_locations:
+                patchfile = os.path.join(dirname, patch)
+                if os.path.exists(patchfile):
                     break
-                else:
-                    patchfile = ''
-
-            if not patchfile:
-                # nothing else, use jhbuild provided patches
-                possible_locations = []
-                if self.config.modulesets_dir:
-                    possible_locations.append(os.path.join(self.config.modulesets_dir, 'patches'))
-                    possible_locations.append(os.path.join(self.config.modulesets_dir, '../patches'))
-                if PKGDATADIR:
-                    possible_locations.append(os.path.join(PKGDATADIR, 'patches'))
-                if SRCDIR:
-                    possible_locations.append(os.path.join(SRCDIR, 'patches'))
-                for dirname in possible_locations:
-                    patchfile = os.path.join(dirname, patch)
-                    if os.path.exists(patchfile):
-                        break
-                else:
-                    raise CommandError(_('Failed to find patch: %s') % patch)
-
+            else:
+                raise CommandError(_('Failed to find patch: %s') % patch)
+
+        # patchfile can be a relative file
+        patchfile = os.path.abspath(patchfile)
+        _patch_locations[key] = patchfile
+        return patchfile
+
+    def _resolve_patches(self, buildscript):
+        """Return a list of (patch, patchstrip, patchfile) tuples giving
+        the local file for each patch; patches are fetched concurrently."""
+        if not self.patches:
+            return []
+        pool = ThreadPool(min(len(self.patches), _max_patch_downloads))
+        try:
+            patchfiles = pool.map(
+                    lambda patch: self._find_patch(buildscript, patch[0]),
+                    self.patches)
+        finally:
+            pool.close()
+            pool.join()
+        return [(patch, patchstrip, patchfile) for (patch, patchstrip), patchfile
+                in zip(self.patches, patchfiles)]
+
+    def _do_patches(self, buildscript, patchfiles, record_fuzz=False):
+        """Patch the working tree; if @record_fuzz is set, return the hunks
+        that needed fuzz, so that they can be reported again when the tree
+        is reused from the pristine cache."""
+        fuzz = []
+        for (patch, patchstrip, patchfile) in patchfiles:
             buildscript.set_action(_('Applying patch'), self, action_target=patch)
-            # patchfile can be a relative file
-            buildscript.execute('patch -p%d < "%s"'
-                                % (patchstrip, os.path.abspath(patchfile)),
+            if record_fuzz:
+                for line in _get_patch_fuzz(patchfile, patchstrip, self.raw_srcdir):
+                    fuzz.append('%s: %s' % (patch, line))
+            buildscript.execute('patch -p%d < "%s"' % (patchstrip, patchfile),
                                 cwd=self.raw_srcdir)
+        return fuzz
 
     def _quilt_checkout(self, buildscript):
         if not has_command('quilt'):
@@ -327,7 +464,10 @@ class TarballBranch(Branch):
         if self.checkout_mode == 'clobber':
             self._wipedir(buildscript, self.raw_srcdir)
         if not os.path.exists(self.srcdir):
-            self._download_and_unpack(buildscript)
+            patchfiles = self._resolve_patches(buildscript)
+            cachedir = self.get_pristine_cache_dir(patchfiles)
+            if not self._checkout_from_pristine_cache(buildscript, cachedir):
+                self._download_and_unpack(buildscript, patchfiles)
         if self.quilt:
             self._quilt_checkout(buildscript)
 
@@ -335,6 +475,13 @@ class TarballBranch(Branch):
         if os.path.exists(self._local_tarball):
             return True
         elif buildscript.config.nonetwork:
+            if self.config.pristine_cache_dir and not self.quilt:
+                try:
+                    cachedir = self.get_pristine_cache_dir(
+                            self._resolve_patches(buildscript))
+                except (BuildStateError, CommandError, RuntimeError):
+                    return False
+                return os.path.isdir(cachedir)
             return False
         return True
 
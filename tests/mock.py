@@ -102,6 +102,12 @@ class PackageDB:
             return None
         return entry.metadata['installed-date']
 
+    def outputsdate(self, package):
+        return self.installdate(package)
+
+    def outputs_unchanged(self, package):
+        return False
+
     def get(self, package):
         '''Return entry if package is installed, otherwise return None.'''
         return self.entries.get(package)
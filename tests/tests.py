@@ -21,12 +21,20 @@
 
 
 import os
+import hashlib
+import json
 import shutil
 import logging
+import struct
+import StringIO
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
+from xml.dom.minidom import parseString
 
 import __builtin__
 __builtin__.__dict__['_'] = lambda x: x
@@ -44,13 +52,21 @@ sys.modules['jhbuild.utils.systeminstall'] = sys.modules[__name__]
 sys.modules['jhbuild.utils'].systeminstall = sys.modules[__name__]
 
 from jhbuild.errors import UsageError, CommandError
-from jhbuild.modtypes import Package
+from jhbuild.modtypes import Package, DownloadableModule, get_branch
 from jhbuild.modtypes.autotools import AutogenModule
 from jhbuild.modtypes.distutils import DistutilsModule
+import jhbuild.commands.checkbranches
+import jhbuild.commands.verify
 import jhbuild.config
 import jhbuild.frontends.terminal
 import jhbuild.moduleset
 import jhbuild.utils.cmds
+import jhbuild.utils.elfutils
+import jhbuild.utils.fileutils
+import jhbuild.utils.mirrorprobe
+import jhbuild.utils.packagedb
+import jhbuild.utils.unpack
+import jhbuild.versioncontrol.git
 import jhbuild.versioncontrol.tarball
 
 def uencode(s):
@@ -397,6 +413,156 @@ class AutotoolsModTypeTestCase(BuildTestCase):
                  'foo:Checking [error]'])
 
 
+class SplitDebugTestCase(JhbuildConfigTestCase):
+    '''Splitting the debug symbols of installed binaries'''
+
+    def setUp(self):
+        super(SplitDebugTestCase, self).setUp()
+        temp_dir = self.make_temp_dir()
+        # objcopy is replaced by a script recording its arguments, and
+        # writing the input file as debug file
+        bin_dir = os.path.join(temp_dir, 'bin')
+        os.makedirs(bin_dir)
+        self.log = os.path.join(temp_dir, 'objcopy.log')
+        with open(os.path.join(bin_dir, 'objcopy'), 'w') as fp:
+            fp.write('#!/bin/sh\n'
+                     'echo "$@" >> %s\n'
+                     'for arg; do src=$dst; dst=$arg; done\n'
+                     'if [ "$1" = --only-keep-debug ]; then cp "$src" "$dst"; fi\n'
+                     % self.log)
+        os.chmod(os.path.join(bin_dir, 'objcopy'), 0755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+        self.installroot = os.path.join(temp_dir, 'prefix')
+        self.destdir_prefix = os.path.join(temp_dir, 'destdir', 'prefix')
+        os.makedirs(os.path.join(self.destdir_prefix, 'bin'))
+        with open(os.path.join(self.destdir_prefix, 'bin', 'foo'), 'w') as fp:
+            fp.write('binary')
+        self.build_id_file = os.path.join('debug', '.build-id', 'ab', 'cdef.debug')
+        os.makedirs(os.path.join(self.destdir_prefix, 'debug', '.build-id', 'ab'))
+
+    def split(self, debugfilename, **kwargs):
+        return Package('foo')._split_debug_file(
+            self.destdir_prefix, self.installroot, os.path.join('bin', 'foo'),
+            debugfilename, **kwargs)
+
+    def get_objcopy_calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as fp:
+            return [line.split() for line in fp.read().splitlines()]
+
+    def test_single_pass(self):
+        changed = self.split(self.build_id_file, single_pass=True, compress=True)
+        binary = os.path.join(self.destdir_prefix, 'bin', 'foo')
+        debuglink = binary + '.debug'
+        self.assertEqual(changed, ['bin/foo', self.build_id_file, 'bin/foo.debug'])
+        self.assertEqual(self.get_objcopy_calls(), [
+            ['--only-keep-debug', '--compress-debug-sections', binary,
+             os.path.join(self.destdir_prefix, self.build_id_file)],
+            ['--strip-all', '--discard-all', '--preserve-dates',
+             '--remove-section', '.gnu_debuglink', '--add-gnu-debuglink',
+             debuglink, binary]])
+        self.assertEqual(os.readlink(debuglink),
+                         os.path.join('..', 'debug', '.build-id', 'ab', 'cdef.debug'))
+        with open(debuglink) as fp:
+            self.assertEqual(fp.read(), 'binary')
+
+    def test_separate_passes(self):
+        self.split(self.build_id_file, compress='zlib')
+        binary = os.path.join(self.destdir_prefix, 'bin', 'foo')
+        self.assertEqual([call[0] for call in self.get_objcopy_calls()],
+                         ['--only-keep-debug', '--remove-section',
+                          '--add-gnu-debuglink', '--strip-all'])
+        self.assertEqual(self.get_objcopy_calls()[0][1],
+                         '--compress-debug-sections=zlib')
+        self.assertEqual(self.get_objcopy_calls()[2],
+                         ['--add-gnu-debuglink', binary + '.debug', binary])
+
+    def test_installed_build_id(self):
+        installed = os.path.join(self.installroot, self.build_id_file)
+        os.makedirs(os.path.dirname(installed))
+        with open(installed, 'w') as fp:
+            fp.write('installed debug file')
+        self.split(self.build_id_file, single_pass=True)
+        # the debug file of the previous install is reused
+        self.assertEqual([call[0] for call in self.get_objcopy_calls()],
+                         ['--strip-all'])
+        with open(os.path.join(self.destdir_prefix, 'bin', 'foo.debug')) as fp:
+            self.assertEqual(fp.read(), 'installed debug file')
+
+    def test_no_build_id(self):
+        debugfilename = os.path.join('debug', 'bin', 'foo.debug')
+        os.makedirs(os.path.join(self.destdir_prefix, 'debug', 'bin'))
+        self.split(debugfilename)
+        self.assertEqual(self.get_objcopy_calls()[2][1],
+                         os.path.join(self.destdir_prefix, debugfilename))
+        self.assertEqual(os.readlink(os.path.join(self.destdir_prefix, 'bin', 'foo.debug')),
+                         os.path.join(self.installroot, debugfilename))
+
+
+class VerifyCommandTestCase(BuildTestCase):
+    '''The verify command'''
+
+    def setUp(self):
+        super(VerifyCommandTestCase, self).setUp()
+        self.config.prefix = os.path.join(self.make_temp_dir(), 'prefix')
+        os.makedirs(os.path.join(self.config.prefix, 'bin'))
+        self.foo = os.path.join(self.config.prefix, 'bin', 'foo')
+        with open(self.foo, 'w') as fp:
+            fp.write('foo')
+        self.packagedb = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(self.make_temp_dir(), 'packagedb.xml'), self.config)
+        self.packagedb.add('foo', '1', [self.foo], checksums=
+                           jhbuild.utils.fileutils.FileTable(self.config.prefix).get_checksums())
+        self.moduleset = jhbuild.moduleset.ModuleSet(self.config, db=self.packagedb)
+        module = mock.MockModule('foo', branch=self.branch)
+        module.config = self.config
+        self.moduleset.add(module)
+        self.modules = [module]
+        self.config.build_targets = ['install']
+        self.config.update_build_targets()
+        self.config.build_policy = 'updated'
+        self.config.jobs = 1
+
+    def verify(self, *args):
+        output = []
+        def get_buildscript(config, module_list, module_set=None):
+            # the mock modules install nothing
+            module_set = jhbuild.moduleset.ModuleSet(config, db=mock.PackageDB())
+            self.buildscript = mock.BuildScript(config, module_list, module_set)
+            return self.buildscript
+        old_load = jhbuild.moduleset.load
+        old_get_buildscript = jhbuild.frontends.get_buildscript
+        jhbuild.moduleset.load = lambda config: self.moduleset
+        jhbuild.frontends.get_buildscript = get_buildscript
+        __builtin__.__dict__['uprint'] = output.append
+        try:
+            result = jhbuild.commands.verify.cmd_verify().execute(
+                self.config, list(args), None)
+        finally:
+            jhbuild.moduleset.load = old_load
+            jhbuild.frontends.get_buildscript = old_get_buildscript
+            del __builtin__.__dict__['uprint']
+        return result, output
+
+    def test_verify(self):
+        self.assertEqual(self.verify(), (0, []))
+        os.unlink(self.foo)
+        self.assertEqual(self.verify(), (1, ['foo: missing %s' % self.foo]))
+        self.assertEqual(self.buildscript, None)
+
+    def test_reinstall(self):
+        with open(self.foo, 'w') as fp:
+            fp.write('changed')
+        result, output = self.verify('--reinstall')
+        self.assertEqual(output, ['foo: modified %s' % self.foo])
+        # built again from the sources on disk, without updating them
+        self.assertEqual(self.buildscript.actions,
+                         ['foo:Configuring', 'foo:Building', 'foo:Installing'])
+        self.assertTrue(self.config.nonetwork)
+
+
 class BuildPolicyTestCase(BuildTestCase):
     '''Build Policy'''
 
@@ -678,6 +844,985 @@ class UtilsTest(JhbuildConfigTestCase):
         self.assertTrue(jhbuild.utils.cmds.compare_version('2', '1.2.3.4'))
         self.assertFalse(jhbuild.utils.cmds.compare_version('1.2.3.4', '2'))
 
+    def test_unpack_tar_file(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'foo-1.0')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        for i in range(20):
+            with open(os.path.join(src_dir, 'sub', 'file%d' % i), 'w') as fp:
+                fp.write('contents %d\n' % i)
+        os.chmod(os.path.join(src_dir, 'sub', 'file0'), 0755)
+        os.symlink('file1', os.path.join(src_dir, 'sub', 'link'))
+        tarball = os.path.join(temp_dir, 'foo-1.0.tar.gz')
+        pkg = tarfile.open(tarball, 'w:gz')
+        pkg.add(src_dir, 'foo-1.0')
+        pkg.close()
+
+        target_dir = os.path.join(temp_dir, 'target')
+        os.makedirs(target_dir)
+        jhbuild.utils.unpack.unpack_tar_file(tarball, target_dir, jobs=4)
+        unpacked_dir = os.path.join(target_dir, 'foo-1.0', 'sub')
+        self.assertEqual(len(os.listdir(unpacked_dir)), 21)
+        with open(os.path.join(unpacked_dir, 'file7')) as fp:
+            self.assertEqual(fp.read(), 'contents 7\n')
+        self.assertEqual(os.readlink(os.path.join(unpacked_dir, 'link')), 'file1')
+        self.assertTrue(os.access(os.path.join(unpacked_dir, 'file0'), os.X_OK))
+
+    def test_unpack_tar_file_order(self):
+        temp_dir = self.make_temp_dir()
+        tarball = os.path.join(temp_dir, 'foo-1.0.tar')
+        pkg = tarfile.open(tarball, 'w')
+        def add(name, data=None, **kwargs):
+            info = tarfile.TarInfo(name)
+            for key, value in kwargs.items():
+                setattr(info, key, value)
+            if data is not None:
+                info.size = len(data)
+                pkg.addfile(info, StringIO.StringIO(data))
+            else:
+                pkg.addfile(info)
+        add('foo-1.0', type=tarfile.DIRTYPE, mode=0755)
+        add('foo-1.0/lib64', type=tarfile.DIRTYPE, mode=0755)
+        add('foo-1.0/lib', type=tarfile.SYMTYPE, linkname='lib64')
+        add('foo-1.0/lib/libfoo.so', 'libfoo')
+        # the same path twice, the later one wins
+        add('foo-1.0/README', 'first' * 100000)
+        add('foo-1.0/README', 'second')
+        add('foo-1.0/NEWS', type=tarfile.LNKTYPE, linkname='foo-1.0/README')
+        pkg.close()
+
+        for jobs in (1, 4):
+            target_dir = os.path.join(temp_dir, 'target%d' % jobs)
+            os.makedirs(target_dir)
+            jhbuild.utils.unpack.unpack_tar_file(tarball, target_dir, jobs=jobs)
+            src_dir = os.path.join(target_dir, 'foo-1.0')
+            self.assertEqual(os.readlink(os.path.join(src_dir, 'lib')), 'lib64')
+            with open(os.path.join(src_dir, 'lib64', 'libfoo.so')) as fp:
+                self.assertEqual(fp.read(), 'libfoo')
+            for name in ('README', 'NEWS'):
+                with open(os.path.join(src_dir, name)) as fp:
+                    self.assertEqual(fp.read(), 'second')
+
+    def test_unpack_tar_pipe_errors(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'foo-1.0')
+        os.makedirs(src_dir)
+        with open(os.path.join(src_dir, 'foo.txt'), 'w') as fp:
+            fp.write('foo\n')
+        tarball = os.path.join(temp_dir, 'foo-1.0.tar.gz')
+        pkg = tarfile.open(tarball, 'w:gz')
+        pkg.add(src_dir, 'foo-1.0')
+        pkg.close()
+        target_dir = os.path.join(temp_dir, 'target')
+        os.makedirs(target_dir)
+
+        # a decompressor exiting with an error after a complete archive
+        self.assertRaises(CommandError, jhbuild.utils.unpack.unpack_tar_pipe,
+                          ['sh', '-c', 'gzip -dc "$0"; exit 3'], tarball, target_dir)
+        # an archive which cannot be read keeps its own error
+        self.assertRaises(tarfile.ReadError, jhbuild.utils.unpack.unpack_tar_pipe,
+                          ['sh', '-c', 'echo garbage; exit 3'], tarball, target_dir)
+
+    def test_clone_tree(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'src')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        with open(os.path.join(src_dir, 'sub', 'file'), 'w') as fp:
+            fp.write('contents\n')
+        os.symlink('sub/file', os.path.join(src_dir, 'link'))
+
+        dst_dir = os.path.join(temp_dir, 'dst')
+        jhbuild.utils.fileutils.TreeCloner().clone_tree(src_dir, dst_dir)
+        with open(os.path.join(dst_dir, 'sub', 'file')) as fp:
+            self.assertEqual(fp.read(), 'contents\n')
+        self.assertEqual(os.readlink(os.path.join(dst_dir, 'link')), 'sub/file')
+        self.assertNotEqual(os.stat(os.path.join(src_dir, 'sub', 'file')).st_ino,
+                            os.stat(os.path.join(dst_dir, 'sub', 'file')).st_ino)
+
+    def test_sync_tree(self):
+        temp_dir = self.make_temp_dir()
+        src_dir = os.path.join(temp_dir, 'src')
+        dst_dir = os.path.join(temp_dir, 'dst')
+        os.makedirs(os.path.join(src_dir, 'sub'))
+        for name in ('a', 'b', 'sub/c'):
+            with open(os.path.join(src_dir, name), 'w') as fp:
+                fp.write(name)
+        cloner = jhbuild.utils.fileutils.TreeCloner()
+        self.assertEqual(cloner.sync_tree(src_dir, dst_dir), 3)
+        self.assertEqual(cloner.sync_tree(src_dir, dst_dir), 0)
+
+        os.unlink(os.path.join(src_dir, 'a'))
+        with open(os.path.join(src_dir, 'sub', 'c'), 'w') as fp:
+            fp.write('changed')
+        self.assertEqual(cloner.sync_tree(src_dir, dst_dir), 1)
+        self.assertFalse(os.path.exists(os.path.join(dst_dir, 'a')))
+        with open(os.path.join(dst_dir, 'sub', 'c')) as fp:
+            self.assertEqual(fp.read(), 'changed')
+
+    def test_file_table(self):
+        temp_dir = self.make_temp_dir()
+        os.makedirs(os.path.join(temp_dir, 'bin'))
+        os.makedirs(os.path.join(temp_dir, 'share', 'empty'))
+        with open(os.path.join(temp_dir, 'bin', 'foo'), 'w') as fp:
+            fp.write('#!/bin/sh\n')
+        os.chmod(os.path.join(temp_dir, 'bin', 'foo'), 0755)
+        os.symlink('foo', os.path.join(temp_dir, 'bin', 'bar'))
+
+        table = jhbuild.utils.fileutils.FileTable(temp_dir)
+        self.assertEqual(sorted(table.get_contents()),
+                         sorted(jhbuild.utils.fileutils.accumulate_dirtree_contents(temp_dir)))
+        self.assertEqual(table.get('bin/bar').kind, 'link')
+        self.assertEqual(table.get('bin/foo').size, 10)
+        self.assertTrue(table.get('bin/foo').is_executable())
+        paths = [entry.path for entry in table]
+        self.assertTrue(paths.index('bin') < paths.index('bin/foo'))
+
+        os.makedirs(os.path.join(temp_dir, 'share', 'empty', 'sub'))
+        table.add('share/empty/sub')
+        table.remove('bin/bar')
+        self.assertEqual(sorted(table.get_contents()),
+                         ['bin/foo', 'share/empty/sub/'])
+
+    def test_process_install_files(self):
+        root = self.make_temp_dir()
+        prefix = self.make_temp_dir()
+        for dirname in ('bin', 'share/doc/foo/html'):
+            jhbuild.utils.fileutils.mkdir_with_parents(os.path.join(root, dirname))
+        os.makedirs(os.path.join(prefix, 'bin'))
+        for filename in ('bin/foo', 'bin/baz', 'share/doc/foo/README',
+                         'share/doc/foo/html/index.html'):
+            with open(os.path.join(root, filename), 'w') as fp:
+                fp.write(filename)
+        os.symlink('foo', os.path.join(root, 'bin', 'bar'))
+
+        table = jhbuild.utils.fileutils.FileTable(root)
+        errors = []
+        num_copied = Package('foo')._process_install_files(table, prefix,
+                                                           errors, jobs=2)
+        self.assertEqual(errors, [])
+        self.assertEqual(num_copied, 5)
+        self.assertEqual(os.listdir(root), [])
+        self.assertEqual(sorted(jhbuild.utils.fileutils.accumulate_dirtree_contents(prefix)),
+                         sorted(table.get_contents()))
+        self.assertEqual(os.readlink(os.path.join(prefix, 'bin', 'bar')), 'foo')
+
+    def test_mirror_parse_host(self):
+        parse_host = jhbuild.utils.mirrorprobe.parse_host
+        self.assertEqual(parse_host('https://git.gnome.org/browse/'),
+                         ('https', 'git.gnome.org', 443))
+        self.assertEqual(parse_host('git://example.com:1234/'),
+                         ('git', 'example.com', 1234))
+        self.assertEqual(parse_host('git@github.com:mujin/'),
+                         ('ssh', 'github.com', 22))
+        self.assertEqual(parse_host('/srv/git/'), None)
+        self.assertEqual(parse_host('file:///srv/git/'), None)
+
+    def test_check_version_cache(self):
+        temp_dir = self.make_temp_dir()
+        counter = os.path.join(temp_dir, 'counter')
+        script = os.path.join(temp_dir, 'fake-tool')
+        with open(script, 'w') as fp:
+            fp.write('#!/bin/sh\necho x >> %s\necho "fake-tool 1.4.2"\n' % counter)
+        os.chmod(script, 0755)
+        check_version = jhbuild.utils.cmds.check_version
+        self.assertTrue(check_version([script, '--version'],
+                                      r'fake-tool ([\d.]+)', '1.4'))
+        self.assertFalse(check_version([script, '--version'],
+                                       r'fake-tool ([\d.]+)', '1.5'))
+        with open(counter) as fp:
+            self.assertEqual(len(fp.readlines()), 1)
+
+    def test_read_elf(self):
+        read_elf = jhbuild.utils.elfutils.read_elf
+        elf = read_elf(os.path.realpath(sys.executable))
+        if elf is None:
+            raise unittest.SkipTest('python is not an ELF executable')
+        self.assertTrue(elf.type in (jhbuild.utils.elfutils.ET_EXEC,
+                                     jhbuild.utils.elfutils.ET_DYN))
+        self.assertTrue(elf.get_section('.text') is not None)
+
+        temp_dir = self.make_temp_dir()
+        for name, contents in (('text', 'not an executable\n'),
+                               ('truncated', '\x7fELF\x02\x01\x01')):
+            with open(os.path.join(temp_dir, name), 'w') as fp:
+                fp.write(contents)
+            self.assertEqual(read_elf(os.path.join(temp_dir, name)), None)
+
+    def test_parse_ld_so_cache(self):
+        strings = 'libfoo.so.1\0/usr/lib/libfoo.so.1\0'
+        data = 'glibc-ld.so.cache1.1' + struct.pack('=IIB3xI12x', 1, len(strings), 0, 0)
+        data += struct.pack('=iIIIQ', 0x303, 72, 84, 0, 0) + strings
+        self.assertEqual(jhbuild.utils.elfutils.parse_ld_so_cache(data),
+                         {'libfoo.so.1': ['/usr/lib/libfoo.so.1']})
+
+    def test_dependency_cache(self):
+        executable = os.path.realpath(sys.executable)
+        if jhbuild.utils.elfutils.read_elf(executable) is None:
+            raise unittest.SkipTest('python is not an ELF executable')
+        cachefile = os.path.join(self.make_temp_dir(), 'elfdeps.json')
+        resolver = jhbuild.utils.elfutils.DependencyResolver(cachefile)
+        dependencies = resolver.find_dependencies(executable, cache=True)
+        resolver.write_cache()
+
+        resolver = jhbuild.utils.elfutils.DependencyResolver(cachefile)
+        self.assertTrue(executable in resolver.closures)
+        self.assertEqual(resolver.find_dependencies(executable, cache=True),
+                         dependencies)
+        self.assertEqual(resolver.objects, {})
+
+    def test_unreferenced_debug_files(self):
+        temp_dir = self.make_temp_dir()
+        self.config.prefix = os.path.join(temp_dir, 'prefix')
+        debug_dir = os.path.join(self.config.prefix, 'debug', '.build-id')
+        for name in ('ab/cdef.debug', 'ab/0123.debug', '45/6789.debug'):
+            jhbuild.utils.fileutils.mkdir_with_parents(
+                os.path.dirname(os.path.join(debug_dir, name)))
+            with open(os.path.join(debug_dir, name), 'w') as fp:
+                fp.write(name)
+        db = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(temp_dir, 'packagedb.xml'), self.config)
+        db.add('foo', '1', ['bin/foo', 'debug/.build-id/ab/cdef.debug'])
+        db.add('bar', '1', ['bin/bar', 'debug/.build-id/ab/cdef.debug'])
+        self.assertEqual(sorted(db.find_unreferenced_debug_files()),
+                         [os.path.join(debug_dir, '45/6789.debug'),
+                          os.path.join(debug_dir, 'ab/0123.debug')])
+        db.uninstall('foo')
+        self.assertTrue(os.path.exists(os.path.join(debug_dir, 'ab/cdef.debug')))
+
+    def test_install_checksums(self):
+        temp_dir = self.make_temp_dir()
+        root = os.path.join(temp_dir, 'root')
+        os.makedirs(os.path.join(root, 'bin'))
+        with open(os.path.join(root, 'bin', 'foo'), 'w') as fp:
+            fp.write('foo')
+        os.chmod(os.path.join(root, 'bin', 'foo'), 0755)
+        os.symlink('foo', os.path.join(root, 'bin', 'bar'))
+        checksums = jhbuild.utils.fileutils.FileTable(root).get_checksums(jobs=2)
+        self.assertEqual(checksums, {
+            'bin/foo': [3, 0755, hashlib.sha1('foo').hexdigest()],
+            'bin/bar': [3, 0777, hashlib.sha1('foo').hexdigest()]})
+
+        db = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(temp_dir, 'packagedb.xml'), self.config)
+        self.assertFalse(db.add('foo', '1', ['bin/foo', 'bin/bar'], checksums=checksums))
+        entry = db.get('foo')
+        entry.metadata['installed-date'] -= 10
+        entry.metadata['outputs-date'] -= 10
+        entry.write()
+        outputs_date = db.outputsdate('foo')
+
+        self.assertTrue(db.add('foo', '2', ['bin/foo', 'bin/bar'], checksums=checksums))
+        self.assertEqual(db.get('foo').checksums, checksums)
+        self.assertEqual(db.outputsdate('foo'), outputs_date)
+        self.assertTrue(db.outputs_unchanged('foo'))
+
+        checksums['bin/foo'][2] = hashlib.sha1('changed').hexdigest()
+        self.assertFalse(db.add('foo', '3', ['bin/foo', 'bin/bar'], checksums=checksums))
+        self.assertFalse(db.outputs_unchanged('foo'))
+        self.assertTrue(db.outputsdate('foo') > outputs_date)
+
+    def test_verify_installed_files(self):
+        temp_dir = self.make_temp_dir()
+        self.config.prefix = os.path.join(temp_dir, 'prefix')
+        self.config.top_builddir = os.path.join(self.config.prefix, '_jhbuild')
+        os.makedirs(os.path.join(self.config.prefix, 'bin'))
+        for name in ('foo', 'bar', 'baz', 'stray'):
+            with open(os.path.join(self.config.prefix, 'bin', name), 'w') as fp:
+                fp.write(name)
+        table = jhbuild.utils.fileutils.FileTable(self.config.prefix)
+        checksums = table.get_checksums()
+        db = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(self.config.top_builddir, 'packagedb.xml'), self.config)
+        db.add('foo', '1', ['bin/foo', 'bin/bar'], checksums=checksums)
+        db.add('baz', '1', ['bin/baz'], checksums=checksums)
+        self.assertEqual(db.verify(db.get_packages(), jobs=2), {})
+
+        os.unlink(os.path.join(self.config.prefix, 'bin', 'foo'))
+        with open(os.path.join(self.config.prefix, 'bin', 'bar'), 'w') as fp:
+            fp.write('BAR')
+        self.assertEqual(db.verify(db.get_packages(), jobs=2), {
+            'foo': ([os.path.join(self.config.prefix, 'bin', 'foo')],
+                    [os.path.join(self.config.prefix, 'bin', 'bar')])})
+        self.assertEqual(db.find_orphaned_files(),
+                         [os.path.join(self.config.prefix, 'bin', 'stray')])
+
+    def test_install_snapshots(self):
+        temp_dir = self.make_temp_dir()
+        self.config.prefix = os.path.join(temp_dir, 'prefix')
+        os.makedirs(os.path.join(self.config.prefix, 'bin'))
+        db = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(temp_dir, 'packagedb.xml'), self.config)
+        foo = os.path.join(self.config.prefix, 'bin', 'foo')
+        bar = os.path.join(self.config.prefix, 'bin', 'bar')
+        for version in ('1', '2', '3'):
+            db.snapshot('foo', 2)
+            with open(foo + '.tmp', 'w') as fp:
+                fp.write(version)
+            os.rename(foo + '.tmp', foo)
+            db.add('foo', version, ['bin/foo'])
+        with open(bar, 'w') as fp:
+            fp.write('bar')
+        db.add('foo', '3', ['bin/foo', 'bin/bar'])
+        self.assertEqual([entry.version for path, entry in db.get_snapshots('foo')],
+                         ['1', '2'])
+
+        self.assertEqual(db.rollback('foo').version, '2')
+        with open(foo) as fp:
+            self.assertEqual(fp.read(), '2')
+        self.assertFalse(os.path.exists(bar))
+        self.assertEqual(db.get('foo').version, '2')
+        self.assertEqual(db.rollback('foo').version, '1')
+        self.assertEqual(db.rollback('foo'), None)
+
+    def test_install_snapshot_failed_rollback(self):
+        temp_dir = self.make_temp_dir()
+        self.config.prefix = os.path.join(temp_dir, 'prefix')
+        os.makedirs(os.path.join(self.config.prefix, 'bin'))
+        os.makedirs(os.path.join(self.config.prefix, 'lib'))
+        db = jhbuild.utils.packagedb.PackageDB(
+            os.path.join(temp_dir, 'packagedb.xml'), self.config)
+        foo = os.path.join(self.config.prefix, 'bin', 'foo')
+        libfoo = os.path.join(self.config.prefix, 'lib', 'libfoo')
+        for version in ('1', '2'):
+            db.snapshot('foo', 2)
+            for path in (foo, libfoo):
+                with open(path + '.tmp', 'w') as fp:
+                    fp.write(version)
+                os.rename(path + '.tmp', path)
+            db.add('foo', version, [foo, libfoo])
+
+        # lib/libfoo cannot be restored while lib is not a directory
+        shutil.rmtree(os.path.join(self.config.prefix, 'lib'))
+        with open(os.path.join(self.config.prefix, 'lib'), 'w') as fp:
+            fp.write('in the way')
+        self.assertRaises(EnvironmentError, db.rollback, 'foo')
+        self.assertEqual(db.get('foo').version, '2')
+        snapshotdir, entry = db.get_snapshots('foo')[-1]
+        with open(os.path.join(snapshotdir, 'files', 'bin', 'foo')) as fp:
+            self.assertEqual(fp.read(), '1')
+
+        os.unlink(os.path.join(self.config.prefix, 'lib'))
+        self.assertEqual(db.rollback('foo').version, '1')
+        for path in (foo, libfoo):
+            with open(path) as fp:
+                self.assertEqual(fp.read(), '1')
+        self.assertEqual(db.get_snapshots('foo'), [])
+
+    def test_parse_ls_remote(self):
+        refs = jhbuild.versioncontrol.git.parse_ls_remote(
+            '0123456789abcdef0123456789abcdef01234567\trefs/heads/master\n'
+            '89abcdef0123456789abcdef0123456789abcdef\trefs/heads/stable\n')
+        self.assertEqual(refs, {
+            'refs/heads/master': '0123456789abcdef0123456789abcdef01234567',
+            'refs/heads/stable': '89abcdef0123456789abcdef0123456789abcdef'})
+
+    def test_git_state(self):
+        state = jhbuild.versioncontrol.git.GitState(
+            '# branch.oid 0123456789abcdef0123456789abcdef01234567\n'
+            '# branch.head master\n'
+            '# branch.upstream origin/master\n'
+            '# branch.ab +2 -0\n'
+            '1 .M S.M. 160000 160000 160000 0123 0123 sub\n')
+        self.assertEqual(state.head, '0123456789abcdef0123456789abcdef01234567')
+        self.assertEqual(state.branch, 'master')
+        self.assertEqual(state.upstream, 'origin/master')
+        self.assertEqual(state.ahead, 2)
+        self.assertFalse(state.is_dirty())
+        self.assertTrue(state.is_dirty(ignore_submodules=False))
+
+        state = jhbuild.versioncontrol.git.GitState(
+            '# branch.oid (initial)\n'
+            '# branch.head (detached)\n'
+            '1 M. N... 100644 100644 100644 0123 4567 file.c\n')
+        self.assertEqual(state.head, None)
+        self.assertEqual(state.branch, None)
+        self.assertTrue(state.is_dirty())
+
+class ExecutingBuildScript(object):
+    '''A build script running the commands of branches, and recording
+    them.'''
+
+    def __init__(self, config):
+        self.config = config
+        self.commands = []
+
+    def execute(self, command, hint=None, cwd=None, extra_env=None):
+        self.commands.append(command)
+        jhbuild.utils.cmds.get_output(command, cwd=cwd, extra_env=extra_env)
+
+    def set_action(self, action, module, module_num=-1, action_target=None):
+        pass
+
+    def ran(self, *args):
+        return [command for command in self.commands
+                if command[:len(args)] == list(args)]
+
+
+class GitBranchTestCase(JhbuildConfigTestCase):
+    """Checkouts of a local git repository."""
+
+    def setUp(self):
+        JhbuildConfigTestCase.setUp(self)
+        os.environ['UNMANGLED_PATH'] = os.environ['PATH']
+        os.environ['UNMANGLED_LD_LIBRARY_PATH'] = os.environ.get('LD_LIBRARY_PATH', '')
+        for name in ('AUTHOR', 'COMMITTER'):
+            os.environ['GIT_%s_NAME' % name] = 'JHBuild'
+            os.environ['GIT_%s_EMAIL' % name] = 'jhbuild@example.com'
+        # submodules of local repositories
+        os.environ['GIT_CONFIG_COUNT'] = '1'
+        os.environ['GIT_CONFIG_KEY_0'] = 'protocol.file.allow'
+        os.environ['GIT_CONFIG_VALUE_0'] = 'always'
+        self.config.checkoutroot = self.make_temp_dir()
+        self.config.checkout_mode = 'update'
+        self.config.module_checkout_mode = {}
+        self.config.copy_dir = None
+        self.config.repos = {}
+        self.config.branches = {}
+        self.config.git_clone_filter = None
+        self.config.module_git_clone_filter = {}
+        self.config.dvcs_mirror_dir = None
+        self.config.dvcs_mirror_alternates = False
+        self.config.git_worktree_dir = None
+        self.config.quiet_mode = True
+        self.config.shallow_clone = False
+        self.config.fetch_max_age = 0
+        self.config.force_update = False
+        self.config.sticky_date = None
+        self.config.jobs = 1
+        self.repos_dir = self.make_temp_dir()
+        self.make_repository('hello', {'hello.c': 'int main() { return 0; }\n'})
+
+    def git(self, cwd, *args):
+        return jhbuild.utils.cmds.get_output(['git'] + list(args), cwd=cwd,
+                                             get_stderr=False)
+
+    def make_repository(self, name, files):
+        repo_dir = os.path.join(self.repos_dir, name)
+        os.makedirs(repo_dir)
+        self.git(repo_dir, 'init', '-q')
+        self.git(repo_dir, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+        self.commit(name, files)
+        return repo_dir
+
+    def commit(self, name, files):
+        repo_dir = os.path.join(self.repos_dir, name)
+        for filename, content in files.items():
+            jhbuild.utils.fileutils.mkdir_with_parents(
+                os.path.dirname(os.path.join(repo_dir, filename)))
+            with open(os.path.join(repo_dir, filename), 'w') as fp:
+                fp.write(content)
+        self.git(repo_dir, 'add', '-A')
+        self.git(repo_dir, 'commit', '-q', '-m', 'change')
+        return self.git(repo_dir, 'rev-parse', 'HEAD').strip()
+
+    def make_branch(self, name='hello', **kwargs):
+        repo = jhbuild.versioncontrol.git.GitRepository(
+            self.config, 'local', self.repos_dir + os.sep)
+        return repo.branch(name, **kwargs)
+
+    def test_dissociate(self):
+        self.config.dvcs_mirror_dir = os.path.join(self.make_temp_dir(), 'mirrors')
+        self.config.dvcs_mirror_alternates = True
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        alternates = os.path.join(branch.get_checkoutdir(), '.git', 'objects',
+                                  'info', 'alternates')
+        self.assertTrue(os.path.exists(alternates))
+        self.assertTrue(branch.dissociate(buildscript))
+        self.assertFalse(os.path.exists(alternates))
+        shutil.rmtree(self.config.dvcs_mirror_dir)
+        self.git(branch.get_checkoutdir(), 'fsck')
+        self.assertFalse(branch.dissociate(buildscript))
+
+    def test_dissociate_worktree(self):
+        self.config.dvcs_mirror_dir = os.path.join(self.make_temp_dir(), 'mirrors')
+        self.config.dvcs_mirror_alternates = True
+        self.config.git_worktree_dir = self.make_temp_dir()
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        alternates = os.path.join(self.config.git_worktree_dir, 'hello.git',
+                                  'objects', 'info', 'alternates')
+        self.assertTrue(os.path.exists(alternates))
+        self.assertTrue(branch.dissociate(buildscript))
+        self.assertFalse(os.path.exists(alternates))
+        shutil.rmtree(self.config.dvcs_mirror_dir)
+        self.git(branch.get_checkoutdir(), 'fsck')
+
+    def test_git_state_legacy(self):
+        branch = self.make_branch()
+        branch.checkout(ExecutingBuildScript(self.config))
+        self.git(branch.get_checkoutdir(), 'config', 'branch.master.merge',
+                 'refs/heads/gnome-3-30')
+        state = branch._get_git_state_legacy()
+        self.assertEqual(state.branch, 'master')
+        self.assertEqual(state.upstream, 'origin/gnome-3-30')
+        self.assertEqual(state.upstream, self.make_branch().get_git_state().upstream)
+
+    def test_remote_refs(self):
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        head = self.git(branch.get_checkoutdir(), 'rev-parse', 'HEAD').strip()
+        self.assertEqual(branch.get_upstream_commit(), head)
+        self.assertTrue(branch.is_unchanged_upstream())
+
+        self.config.sticky_date = 'none'
+        self.assertEqual(branch.get_remote_refs_uri(), None)
+        self.config.sticky_date = None
+        self.config.nonetwork = True
+        self.assertEqual(branch.get_remote_refs_uri(), None)
+        self.config.nonetwork = False
+
+        # the upstream heads are listed again after a fetch
+        head = self.commit('hello', {'hello.c': 'int main() { return 1; }\n'})
+        self.assertNotEqual(branch.get_upstream_commit(), head)
+        branch._execute_git(buildscript, ['git', 'fetch', '-q'],
+                            cwd=branch.get_checkoutdir())
+        self.assertEqual(branch.get_upstream_commit(), head)
+        self.assertFalse(branch.is_unchanged_upstream())
+
+    def test_remote_refs_mirror(self):
+        self.config.dvcs_mirror_dir = os.path.join(self.make_temp_dir(), 'mirrors')
+        branch = self.make_branch()
+        branch.checkout(ExecutingBuildScript(self.config))
+        self.commit('hello', {'hello.c': 'int main() { return 1; }\n'})
+        jhbuild.versioncontrol.git.forget_remote_refs(branch.unmirrored_module)
+
+        ls_remotes = []
+        def get_output(cmd, *args, **kwargs):
+            if cmd[:2] == ['git', 'ls-remote']:
+                ls_remotes.append(cmd)
+            return jhbuild.utils.cmds.get_output(cmd, *args, **kwargs)
+        old_get_output = jhbuild.versioncontrol.git.get_output
+        jhbuild.versioncontrol.git.get_output = get_output
+        try:
+            jhbuild.versioncontrol.git.prefetch_remote_refs([branch])
+            self.assertEqual(len(ls_remotes), 1)
+            buildscript = ExecutingBuildScript(self.config)
+            branch.checkout(buildscript)
+        finally:
+            jhbuild.versioncontrol.git.get_output = old_get_output
+        # the heads listed by the prefetch are used by the mirror update
+        self.assertEqual(len(ls_remotes), 1)
+        self.assertEqual(len(buildscript.ran('git', 'fetch')), 1)
+
+    def test_sticky_date_dirty(self):
+        self.config.sticky_date = '2099-01-01'
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        branch.move_to_sticky_date(buildscript)
+        self.assertEqual(branch.get_current_branch(), 'jhbuild-date-branch')
+        hello = os.path.join(branch.get_checkoutdir(), 'hello.c')
+        with open(hello, 'w') as fp:
+            fp.write('changed\n')
+        # a later run, on a tree edited in between
+        branch = self.make_branch()
+        branch.move_to_sticky_date(buildscript)
+        with open(hello) as fp:
+            self.assertEqual(fp.read(), 'int main() { return 0; }\n')
+
+    def test_fetch_stamp(self):
+        self.config.fetch_max_age = 3600
+        branch = self.make_branch()
+        branch.checkout(ExecutingBuildScript(self.config))
+        self.assertTrue(os.path.exists(os.path.join(
+            branch.get_checkoutdir(), '.git', 'jhbuild-last-fetch')))
+
+        # a fresh fetch stamp skips the fetch, even of new upstream commits
+        self.commit('hello', {'hello.c': 'int main() { return 1; }\n'})
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(buildscript.ran('git', 'remote', 'update'), [])
+
+        # a later run, which lists the upstream heads again
+        jhbuild.versioncontrol.git.forget_remote_refs(branch.module)
+        self.config.force_update = True
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(len(buildscript.ran('git', 'remote', 'update')), 1)
+        with open(os.path.join(branch.get_checkoutdir(), 'hello.c')) as fp:
+            self.assertEqual(fp.read(), 'int main() { return 1; }\n')
+
+    def test_clone_filter_sparse(self):
+        self.make_repository('tree', {'src/main.c': 'int main;\n',
+                                      'doc/index.txt': 'index\n',
+                                      'README': 'readme\n'})
+        branch = self.make_branch('tree', clone_filter='blob:none', sparse='src')
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        clone = buildscript.ran('git', 'clone')[0]
+        self.assertTrue('--filter=blob:none' in clone)
+        self.assertTrue('--sparse' in clone)
+        checkoutdir = branch.get_checkoutdir()
+        self.assertEqual(self.git(checkoutdir, 'sparse-checkout', 'list').split(),
+                         ['src'])
+        self.assertEqual(self.git(checkoutdir, 'config', 'core.sparseCheckoutCone').strip(),
+                         'true')
+        self.assertTrue(os.path.exists(os.path.join(checkoutdir, 'src', 'main.c')))
+        self.assertTrue(os.path.exists(os.path.join(checkoutdir, 'README')))
+        self.assertFalse(os.path.exists(os.path.join(checkoutdir, 'doc')))
+
+        # the cone follows the moduleset on update
+        branch = self.make_branch('tree', sparse='src, doc')
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(buildscript.ran('git', 'sparse-checkout', 'set'),
+                         [['git', 'sparse-checkout', 'set', '--cone', 'src', 'doc']])
+        self.assertTrue(os.path.exists(os.path.join(checkoutdir, 'doc', 'index.txt')))
+
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(buildscript.ran('git', 'sparse-checkout', 'set'), [])
+
+    def test_submodules(self):
+        self.config.dvcs_mirror_dir = os.path.join(self.make_temp_dir(), 'mirrors')
+        sub_dir = self.make_repository('sub', {'sub.c': 'int sub;\n'})
+        hello_dir = os.path.join(self.repos_dir, 'hello')
+        self.git(hello_dir, 'submodule', 'add', '-q', sub_dir, 'sub')
+        self.git(hello_dir, 'commit', '-q', '-m', 'add submodule')
+
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        checkoutdir = branch.get_checkoutdir()
+        self.assertTrue(os.path.exists(os.path.join(checkoutdir, 'sub', 'sub.c')))
+        # the submodule is cloned from its own dvcs mirror
+        mirror_dir = jhbuild.versioncontrol.git.get_git_mirror_directory(
+            self.config.dvcs_mirror_dir, None, sub_dir)
+        self.assertTrue(os.path.isdir(mirror_dir))
+        update = buildscript.ran('git', '-c')
+        self.assertEqual(update, [['git', '-c', 'url.%s.insteadOf=%s' % (mirror_dir, sub_dir),
+                                   'submodule', 'update', '--init']])
+        self.assertTrue(os.path.exists(os.path.join(
+            checkoutdir, '.git', 'jhbuild-submodules')))
+
+        # unchanged submodule commits are not updated again
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual([c for c in buildscript.commands if 'submodule' in c], [])
+
+        self.commit('sub', {'sub.c': 'int sub = 1;\n'})
+        self.git(os.path.join(hello_dir, 'sub'), 'pull', '-q')
+        self.git(hello_dir, 'commit', '-q', '-a', '-m', 'update submodule')
+        jhbuild.versioncontrol.git.forget_remote_refs(branch.unmirrored_module)
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(len([c for c in buildscript.commands if 'submodule' in c]), 1)
+        with open(os.path.join(checkoutdir, 'sub', 'sub.c')) as fp:
+            self.assertEqual(fp.read(), 'int sub = 1;\n')
+
+    def test_worktrees(self):
+        self.config.git_worktree_dir = self.make_temp_dir()
+        hello_dir = os.path.join(self.repos_dir, 'hello')
+        self.git(hello_dir, 'branch', 'gnome/3-30')
+        store = os.path.join(self.config.git_worktree_dir, 'hello.git')
+
+        master = self.make_branch()
+        master.checkout(ExecutingBuildScript(self.config))
+        self.assertEqual(master.get_checkoutdir(),
+                         os.path.join(self.config.git_worktree_dir, 'hello', 'master'))
+        self.assertEqual(self.git(store, 'rev-parse', '--is-bare-repository').strip(),
+                         'true')
+        self.assertTrue(os.path.exists(os.path.join(master.get_checkoutdir(), 'hello.c')))
+
+        stable = self.make_branch(revision='gnome/3-30')
+        buildscript = ExecutingBuildScript(self.config)
+        stable.checkout(buildscript)
+        self.assertEqual(stable.get_checkoutdir(),
+                         os.path.join(self.config.git_worktree_dir, 'hello', 'gnome_3-30'))
+        self.assertEqual(stable.get_current_branch(), 'gnome/3-30')
+        # the second branch reuses the store rather than cloning again
+        self.assertEqual(buildscript.ran('git', 'clone'), [])
+        worktrees = [line.split()[1] for line in
+                     self.git(store, 'worktree', 'list', '--porcelain').splitlines()
+                     if line.startswith('worktree ')]
+        self.assertEqual(sorted(worktrees[1:]), sorted([master.get_checkoutdir(),
+                                                        stable.get_checkoutdir()]))
+
+    def checkbranches(self, refs, *args):
+        repo = jhbuild.versioncontrol.git.GitRepository(
+            self.config, 'gnome', 'https://git.example.com/')
+        self.config.partial_build = False
+        module_set = jhbuild.moduleset.ModuleSet(self.config, db=mock.PackageDB())
+        for name in sorted(refs):
+            module_set.add(mock.MockModule(name, branch=repo.branch(name)))
+        module_set.add(mock.MockModule('pinned',
+                                       branch=repo.branch('pinned', revision='stable')))
+
+        lock = threading.Lock()
+        queries = {'running': 0, 'max': 0}
+        def get_remote_refs(uri):
+            with lock:
+                queries['running'] += 1
+                queries['max'] = max(queries['max'], queries['running'])
+            time.sleep(0.05)
+            with lock:
+                queries['running'] -= 1
+            return refs[uri.split('/')[-1]]
+
+        output = []
+        stdout = StringIO.StringIO()
+        old_get_remote_refs = jhbuild.commands.checkbranches.get_remote_refs
+        old_load = jhbuild.moduleset.load
+        old_stdout = sys.stdout
+        jhbuild.commands.checkbranches.get_remote_refs = get_remote_refs
+        jhbuild.moduleset.load = lambda config: module_set
+        __builtin__.__dict__['uprint'] = output.append
+        sys.stdout = stdout
+        try:
+            jhbuild.commands.checkbranches.cmd_checkbranches().execute(
+                self.config, ['--branch', 'gnome-3-30'] + list(args) +
+                sorted(refs) + ['pinned'], None)
+        finally:
+            sys.stdout = old_stdout
+            del __builtin__.__dict__['uprint']
+            jhbuild.moduleset.load = old_load
+            jhbuild.commands.checkbranches.get_remote_refs = old_get_remote_refs
+        return output, stdout.getvalue(), queries['max']
+
+    def test_checkbranches(self):
+        refs = {'branched': {'refs/heads/master': '0123',
+                             'refs/heads/gnome-3-30': '4567'},
+                'unbranched': {'refs/heads/master': '89ab'},
+                'unreachable': None}
+        output, stdout, max_queries = self.checkbranches(refs, '--max-per-host', '1')
+        self.assertEqual(output, [
+            'branched is missing branch definition for gnome-3-30',
+            'unreachable: could not list branches of https://git.example.com/unreachable'])
+        # all repositories are on the same host
+        self.assertEqual(max_queries, 1)
+
+        output, stdout, max_queries = self.checkbranches(refs, '--json')
+        self.assertEqual(output, [])
+        self.assertEqual(json.loads(stdout), [
+            {'module': 'branched', 'repository': 'https://git.example.com/branched',
+             'branch': 'gnome-3-30', 'status': 'missing'},
+            {'module': 'unbranched', 'repository': 'https://git.example.com/unbranched',
+             'branch': 'gnome-3-30', 'status': 'ok'},
+            {'module': 'unreachable', 'repository': 'https://git.example.com/unreachable',
+             'branch': 'gnome-3-30', 'status': 'error'}])
+        self.assertTrue(max_queries > 1)
+
+class TarballBranchTestCase(JhbuildConfigTestCase):
+    """Checkouts of local tarballs."""
+
+    def setUp(self):
+        JhbuildConfigTestCase.setUp(self)
+        temp_dir = self.make_temp_dir()
+        self.config.checkoutroot = os.path.join(temp_dir, 'checkout')
+        self.config.tarballdir = os.path.join(temp_dir, 'tarballs')
+        self.config.pristine_cache_dir = os.path.join(temp_dir, 'pristine')
+        self.config.pristine_cache_hardlinks = False
+        self.config.checkout_mode = 'update'
+        self.config.module_checkout_mode = {}
+        self.config.copy_dir = None
+        self.config.repos = {}
+        self.config.branches = {}
+        self.config.modulesets_dir = None
+        self.config.jobs = 1
+        os.makedirs(self.config.checkoutroot)
+        os.makedirs(self.config.tarballdir)
+        self.make_tarball('a\nb\nc\nd\ne\nf\ng\n')
+        self.patches_dir = os.path.join(temp_dir, 'patches')
+        os.makedirs(self.patches_dir)
+        # the context of the hunk does not match exactly
+        with open(os.path.join(self.patches_dir, 'foo.patch'), 'w') as fp:
+            fp.write('--- a/foo.txt\n+++ b/foo.txt\n'
+                     '@@ -2,5 +2,5 @@\n x\n c\n-d\n+D\n e\n f\n')
+
+    def make_tarball(self, content):
+        tarball = os.path.join(self.config.tarballdir, 'foo-1.0.tar.gz')
+        pkg = tarfile.open(tarball, 'w:gz')
+        info = tarfile.TarInfo('foo-1.0/foo.txt')
+        info.size = len(content)
+        pkg.addfile(info, StringIO.StringIO(content))
+        pkg.close()
+        with open(tarball, 'rb') as fp:
+            return 'sha256:' + hashlib.sha256(fp.read()).hexdigest()
+
+    def make_branch(self, **kwargs):
+        repo = jhbuild.versioncontrol.tarball.TarballRepository(
+            self.config, 'local', 'http://example.com/')
+        repo.moduleset_uri = self.patches_dir + os.sep
+        branch = repo.branch('foo', '1.0', module='foo-1.0.tar.gz', **kwargs)
+        branch.patches = [('foo.patch', 1)]
+        return branch
+
+    def test_raw_srcdir(self):
+        repo = jhbuild.versioncontrol.tarball.TarballRepository(
+            self.config, 'local', 'http://example.com/')
+        for module in ('foo-1.0.tar.xz', 'foo-1.0.txz', 'foo-1.0.tar.zst',
+                       'foo-1.0.tzst', 'foo-1.0.tgz', 'foo-1.0.zip'):
+            branch = repo.branch('foo', '1.0', module=module)
+            self.assertEqual(branch.raw_srcdir,
+                             os.path.join(self.config.checkoutroot, 'foo-1.0'))
+
+    def read_source(self, branch):
+        with open(os.path.join(branch.srcdir, 'foo.txt')) as fp:
+            return fp.read()
+
+    def test_patches(self):
+        branch = self.make_branch()
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(self.read_source(branch), 'a\nb\nc\nD\ne\nf\ng\n')
+        self.assertEqual(len([command for command in buildscript.commands
+                              if command.startswith('patch -p1 ')]), 1)
+        cachedir = branch.get_pristine_cache_dir(branch._resolve_patches(buildscript))
+        with open(cachedir + '.fuzz') as fp:
+            self.assertEqual(fp.read(),
+                             'foo.patch: foo.txt: Hunk #1 succeeded at 2 with fuzz 1.\n')
+
+        # the patched tree comes from the pristine cache the second time
+        shutil.rmtree(branch.srcdir)
+        buildscript = ExecutingBuildScript(self.config)
+        branch.checkout(buildscript)
+        self.assertEqual(self.read_source(branch), 'a\nb\nc\nD\ne\nf\ng\n')
+        self.assertEqual(buildscript.commands, [])
+
+    def test_pristine_cache_rerolled_tarball(self):
+        source_hash = self.make_tarball('a\nb\nc\nd\ne\nf\ng\n')
+        branch = self.make_branch(hash=source_hash)
+        branch.checkout(ExecutingBuildScript(self.config))
+        shutil.rmtree(branch.srcdir)
+
+        source_hash = self.make_tarball('a\nb\nc\nd\ne\nf\nh\n')
+        branch = self.make_branch(hash=source_hash)
+        branch.checkout(ExecutingBuildScript(self.config))
+        self.assertEqual(self.read_source(branch), 'a\nb\nc\nD\ne\nf\nh\n')
+
+class MirrorRepository(object):
+
+    def __init__(self, config, href):
+        self.config = config
+        self.name = href
+        self.href = href
+        self.mirrors = {}
+
+    def branch_from_xml(self, name, branchnode, repositories, default_repo):
+        return MirrorBranch(self)
+
+
+class MirrorBranch(object):
+
+    def __init__(self, repository, failing=False):
+        self.repository = repository
+        self.failing = failing
+        self.checkouts = 0
+
+    def checkout(self, buildscript):
+        self.checkouts += 1
+        if self.failing:
+            raise CommandError('checkout failed')
+
+    force_checkout = checkout
+
+
+class MirroredModule(DownloadableModule):
+
+    def __init__(self, config, branch):
+        self.config = config
+        self.branch = branch
+
+
+class MirrorTestCase(JhbuildConfigTestCase):
+    """The 'fastest' mirror policy."""
+
+    latencies = {
+        'https://origin.example.com/': 0.3,
+        'https://fast.example.com/': 0.1,
+        'https://down.example.com/': None,
+        }
+
+    def setUp(self):
+        JhbuildConfigTestCase.setUp(self)
+        self.config.nonetwork = False
+        self.config.mirror_policy = 'fastest'
+        self.config.module_mirror_policy = {}
+        self.probed = []
+        self.prober = jhbuild.utils.mirrorprobe.MirrorProber(
+                os.path.join(self.make_temp_dir(), 'mirrors.json'), 60)
+        self.prober.probe = self.probe
+        self._old_prober = jhbuild.utils.mirrorprobe._prober
+        jhbuild.utils.mirrorprobe._prober = self.prober
+
+    def tearDown(self):
+        jhbuild.utils.mirrorprobe._prober = self._old_prober
+        JhbuildConfigTestCase.tearDown(self)
+
+    def probe(self, uri):
+        self.probed.append(uri)
+        return self.latencies[uri]
+
+    def make_module(self, *hrefs, **kwargs):
+        failing = kwargs.get('failing', ())
+        branches = [MirrorBranch(MirrorRepository(self.config, href),
+                                 failing=href in failing)
+                    for href in hrefs]
+        branches[0].fallback_branches = branches[1:]
+        return MirroredModule(self.config, branches[0])
+
+    def test_parse_does_not_probe(self):
+        repo = MirrorRepository(self.config, 'https://origin.example.com/')
+        repo.mirrors['fast'] = MirrorRepository(self.config,
+                                                'https://fast.example.com/')
+        node = parseString('<autotools id="foo"><branch/></autotools>').documentElement
+        branch = get_branch(node, {'origin': repo}, 'origin', self.config)
+        self.assertEqual(self.probed, [])
+        self.assertEqual(branch.repository, repo)
+        self.assertEqual([b.repository for b in branch.fallback_branches],
+                         [repo.mirrors['fast']])
+
+    def test_select_fastest(self):
+        module = self.make_module('https://origin.example.com/',
+                                  'https://down.example.com/',
+                                  'https://fast.example.com/')
+        module.checkout_with_fallback(None)
+        self.assertEqual(module.branch.repository.href,
+                         'https://fast.example.com/')
+        self.assertEqual([b.repository.href for b in module.branch.fallback_branches],
+                         ['https://origin.example.com/', 'https://down.example.com/'])
+        self.assertEqual(module.branch.checkouts, 1)
+        self.assertEqual(sorted(self.probed), sorted(self.latencies))
+
+    def test_nonetwork_does_not_probe(self):
+        self.config.nonetwork = True
+        module = self.make_module('https://origin.example.com/',
+                                  'https://fast.example.com/')
+        module.checkout_with_fallback(None)
+        self.assertEqual(self.probed, [])
+        self.assertEqual(module.branch.repository.href,
+                         'https://origin.example.com/')
+
+    def test_fallback(self):
+        module = self.make_module('https://origin.example.com/',
+                                  'https://fast.example.com/',
+                                  failing=('https://fast.example.com/',))
+        fast_branch = module.branch.fallback_branches[0]
+        module.checkout_with_fallback(None)
+        self.assertEqual(fast_branch.checkouts, 1)
+        self.assertEqual(module.branch.repository.href,
+                         'https://origin.example.com/')
+        self.assertEqual(module.branch.checkouts, 1)
+        self.assertEqual(self.prober.get_latency('https://fast.example.com/',
+                                                 nonetwork=True), None)
+
+        # updates and forced checkouts fall back the same way
+        module = self.make_module('https://fast.example.com/',
+                                  'https://origin.example.com/',
+                                  failing=('https://fast.example.com/',))
+        module.mirror_selected = True
+        module.checkout_with_fallback(None, force=True)
+        self.assertEqual(module.branch.repository.href,
+                         'https://origin.example.com/')
+
+        module = self.make_module('https://fast.example.com/',
+                                  failing=('https://fast.example.com/',))
+        self.assertRaises(CommandError, module.checkout_with_fallback, None)
+
 def get_installed_pkgconfigs(config):
     ''' overload jhbuild.utils.get_installed_pkgconfigs'''
     return {'syspkgalpha'   : '2',